@@ -10,7 +10,7 @@ setuptools.setup(
     entry_points={
         'console_scripts': ['hydra-cluster=hydra.cluster.api:main'],
     },
-    install_requires=['Flask', 'docker', 'redis'],
+    install_requires=['Flask', 'docker', 'gunicorn', 'redis'],
     setup_requires=['wheel', 'pytest-runner'],
-    tests_require=['pytest', 'pytest-mock']
+    tests_require=['pytest', 'pytest-mock', 'fakeredis[lua]']
 )
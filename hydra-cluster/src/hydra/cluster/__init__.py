@@ -1,13 +1,48 @@
+import concurrent.futures
 import docker
-import json
+import functools
 import logging
-import random
+import os
 import redis
 import socket
 import threading
+import time
 import typing
 
-from .haproxy import HAProxy
+from .autoscale import Autoscaler, parse_policy
+from .changes import NODE, StateChanges
+from .events import EventWatcher
+from .haproxy import CONFIG_LOCK_KEY, CONFIG_LOCK_TIMEOUT, RESERVED_PROXIES, HAProxy, HAProxyStats, server_name
+from .images import ImageSeeder, mirror_args
+from .inventory import Node, NodeInventory
+from .jobs import JobQueue, step
+from .leader import LeaderElection
+from .metrics import EVENT_BACKLOG, EXEC_SECONDS, REGISTRY as METRICS, REPLICAS, instrument_docker, \
+    instrument_redis, locked, operation
+from .pool import WarmPool
+from .registry import ServiceRegistry, node_names
+from .reservations import RESERVATION_LINGER, SlotReservations
+from .resources import CapacityTracker, Resources, docker_args, parse_resources, requested
+from .scheduler import NodeLoad, cpu_percent, get_scheduler, memory_fraction
+from .timeseries import StatsCollector
+
+
+# Upper bound of replicas started concurrently (`docker run` inside nodes) against Docker daemon.
+DEPLOY_WORKERS = int(os.environ.get('HYDRA_DEPLOY_WORKERS', 8))
+
+# How long (seconds) deploy waits for its replicas to start.
+DEPLOY_TIMEOUT = float(os.environ.get('HYDRA_DEPLOY_TIMEOUT', 300))
+
+# Upper bound of nodes (privileged `docker:dind` containers) started concurrently by bulk provisioning.
+NODE_WORKERS = int(os.environ.get('HYDRA_NODE_WORKERS', 8))
+
+# How long (seconds) bulk provisioning waits for its nodes to start.
+NODE_TIMEOUT = float(os.environ.get('HYDRA_NODE_TIMEOUT', 300))
+
+# Claim of a node name handed out by an API process (SET NX), so that processes never pick the same name. It's kept
+# until the node is started and visible in inventories of all processes, or dropped if the node fails to start.
+NODE_NAME_KEY = 'hydra:node-name:{}'
+NODE_NAME_TTL = int(NODE_TIMEOUT) + 60
 
 
 class ClusterError(Exception):
@@ -25,15 +60,44 @@ class HydraCluster(object):
     NODE_DOWN_EVENTS = ['destroy', 'die', 'kill', 'stop']
     NODE_IMAGE = 'docker:dind'
 
-    __lock = threading.Lock()
-
     def __init__(self):
         self._node = None
         self._network = None
         self._haproxy = None
         self._service_registry = None
-
-        self._docker_client = docker.from_env()
+        self._registry = None
+        self._reservations = None
+        self._events = None
+        self._deploy_executor = None
+        self._node_executor = None
+        self._inventory = None
+        self._pool = None
+        self._seeder = None
+        self._capacity = None
+        self._jobs = None
+        self._election = None
+        self._changes = None
+        self._collector = None
+        self._autoscaler = None
+
+        # Set in the process which runs controllers (node down handling, migrations, warm pool).
+        self._controller = threading.Event()
+
+        # Container ids of nodes which are already handled as down.
+        self._down_nodes = set()
+
+        self._node_lock = threading.Lock()
+
+        # Per service alias locks, placement of different services runs in parallel.
+        self._service_locks = {}
+        self._service_locks_lock = threading.Lock()
+
+        # (alias, node name) of replicas which timed out while starting. Their slots and capacity are kept until their
+        # containers are removed.
+        self._abandoned = set()
+        self._abandoned_lock = threading.Lock()
+
+        self._docker_client = instrument_docker(docker.from_env())
 
     @property
     def node(self):
@@ -52,143 +116,639 @@ class HydraCluster(object):
             self._network = self._docker_client.networks.get(nw)
         return self._network
 
+    @property
+    def inventory(self) -> NodeInventory:
+        if not self._inventory:
+            self._inventory = NodeInventory(
+                self._docker_client, self.network.name, self.is_node, on_change=self.on_node_change)
+        return self._inventory
+
+    @property
+    def pool(self) -> WarmPool:
+        if not self._pool:
+            self._pool = WarmPool(
+                self._docker_client, self.network.name, self.name, self.run_node, redis_=self.service_registry)
+        return self._pool
+
     @property
     def nodes(self) -> iter:
-        return filter(
-            lambda n: n.name.startswith('node-'),
-            self._docker_client.containers.list(filters={'network': self.network.name})
-        )
+        return (n.container for n in self.inventory.nodes())
 
     @property
     def node_state(self) -> iter:
-        for n in self.nodes:
+        return self.node_states(self.inventory.nodes())
+
+    def node_states(self, nodes: typing.Iterable[Node]) -> iter:
+        return (n.state() for n in nodes)
+
+    def node_allocation(self, nodes: typing.Iterable[Node]) -> iter:
+        """
+        Yields allocated resources and capacity of `nodes`. They change with holds of deploys in progress, which
+        don't change state version, so they aren't part of the versioned cluster state.
+        """
+        allocated = self.capacity.allocated()
+        for n in nodes:
+            capacity = self.capacity.cached_capacity(n.name)
             yield dict(
                 name=n.name,
-                ip=n.attrs['NetworkSettings']['Networks'][self.network.name]['IPAddress']
+                allocated=allocated.get(n.name, Resources()).to_dict(),
+                capacity=capacity.to_dict() if capacity else None
             )
 
+    @property
+    def jobs(self) -> JobQueue:
+        if not self._jobs:
+            self._jobs = JobQueue(self.service_registry, client_errors=(ValueError, NotEnoughNodes))
+        return self._jobs
+
+    @property
+    def capacity(self) -> CapacityTracker:
+        if not self._capacity:
+            self._capacity = CapacityTracker(self.registry, self.service_registry)
+        return self._capacity
+
     @property
     def service_registry(self) -> redis.Redis:
-        # TODO: Redis should be wrapped behind facade which woulnd't reveal Redis specific interfaces.
         if not self._service_registry:
-            self._service_registry = redis.Redis(
+            self._service_registry = instrument_redis(redis.Redis(
                 host='redis.{}'.format(self.network.name),
                 port=6379
-            )
+            ))
         return self._service_registry
 
+    @property
+    def changes(self) -> StateChanges:
+        if not self._changes:
+            self._changes = StateChanges(self.service_registry)
+        return self._changes
+
+    @property
+    def registry(self) -> ServiceRegistry:
+        if not self._registry:
+            self._registry = ServiceRegistry(self.service_registry, changes=self.changes)
+        return self._registry
+
+    @property
+    def reservations(self) -> SlotReservations:
+        if not self._reservations:
+            self._reservations = SlotReservations(self.service_registry)
+        return self._reservations
+
+    @property
+    def events(self) -> EventWatcher:
+        if not self._events:
+            self._events = EventWatcher(self._docker_client)
+            EVENT_BACKLOG.function = lambda: self._events.backlog
+        return self._events
+
+    @property
+    def deploy_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        # Separate from event handler pool. Handlers (migrations) wait for deploys, sharing a pool could deadlock.
+        if not self._deploy_executor:
+            self._deploy_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=DEPLOY_WORKERS, thread_name_prefix='hydra-deploy')
+        return self._deploy_executor
+
+    @property
+    def seeder(self) -> ImageSeeder:
+        if not self._seeder:
+            self._seeder = ImageSeeder(self._docker_client, self.deploy_executor)
+        return self._seeder
+
+    @property
+    def node_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        if not self._node_executor:
+            self._node_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=NODE_WORKERS, thread_name_prefix='hydra-node')
+        return self._node_executor
+
     @property
     def haproxy(self) -> HAProxy:
         if not self._haproxy:
-            self._haproxy = HAProxy('haproxy.{}'.format(self.network.name), self._docker_client)
+            self._haproxy = HAProxy(
+                'haproxy.{}'.format(self.network.name), self._docker_client,
+                config_lock=self.service_registry.lock(
+                    CONFIG_LOCK_KEY, timeout=CONFIG_LOCK_TIMEOUT, blocking_timeout=CONFIG_LOCK_TIMEOUT))
         return self._haproxy
 
+    @property
+    def collector(self) -> StatsCollector:
+        if not self._collector:
+            self._collector = StatsCollector(self.haproxy)
+        return self._collector
+
+    @property
+    def autoscaler(self) -> Autoscaler:
+        if not self._autoscaler:
+            self._autoscaler = Autoscaler(
+                self.registry.all, self.service_stats, self.scale_service, lambda: self.is_controller)
+        return self._autoscaler
+
+    def service_stats(self, alias: str, window: float) -> typing.Optional[dict]:
+        return next(iter(self.collector.aggregates(window, lambda name: name == alias)), None)
+
     @property
     def services(self) -> iter:
-        return map(json.loads, self.service_registry.mget(self.service_registry.keys()))
+        return iter(self.registry.all())
 
     def get_service_config(self, alias) -> dict:
-        try:
-            return json.loads(self.service_registry.get(alias))
-        except:
-            return dict(name=alias, nodes=[])
+        return self.registry.get(alias) or dict(name=alias, nodes=[])
 
     def get_node_services(self, node_name):
-        for service in self.services:
-            nodes = service.get('nodes', [])
-            if any([True for node in nodes if node['name'] == node_name]):
-                yield service
+        return iter(self.registry.node_services(node_name))
 
     def unlink_service_from_node(self, alias, node_name):
-        srv_cfg = self.get_service_config(alias)
-        srv_cfg['nodes'] = [node for node in srv_cfg['nodes'] if node['name'] != node_name]
-        # TODO: Redis interfaces leaking in.
-        self.service_registry.set(alias, json.dumps(srv_cfg))
-
-    def migrate_services(self, reason, node_name: str):
+        self.registry.remove_replica(alias, node_name)
+
+    @operation('migrate_services')
+    def migrate_services(self, reason, node_name: str) -> dict:
+        """
+        Redeploys all replicas of failed node `node_name`. Placement of all displaced replicas is planned at once
+        against a single snapshot of nodes, proxy and registry state, replicas are then started concurrently.
+        """
+        started_at = time.monotonic()
         logging.info('Starting service relocation from node {}. Reason: {}'.format(node_name, str(reason)))
 
-        for service in self.get_node_services(node_name):
-            self.unlink_service_from_node(service['name'], node_name)
-            for node in [node for node in service['nodes'] if node['name'] == node_name]:
-                logging.info('Trying to redeploy service {} on another node.'.format(service['name']))
-                try:
-                    self.deploy_service(
-                        service['name'],
-                        node['service_image'],
-                        node['node_port'],
-                        node['service_port'],
-                        replicas=1
-                    )
-                    logging.info('Service {!r} deployed on node {!r}.'.format(service['name'], node['name']))
-                except Exception as error:
-                    logging.error('Could not redeploy service {} on another node.'.format(service['name']))
-                    logging.error(error)
+        services = list(self.get_node_services(node_name))
 
-    def node_down_monitor(self, node_name: str, handlers: typing.List[typing.Callable], events: typing.List[str]):
-        node_events = self._docker_client.events(
-            filters={'container': node_name, 'event': events})
+        # Unlink all services from failed node in one round trip.
+        with self.registry.batch() as batch:
+            for service in services:
+                batch.remove_replica(service['name'], node_name)
 
-        for e in node_events:
-            for handler in handlers:
-                threading.Thread(target=handler, args=(e, node_name,)).start()
-            # Stop reading events for node <node_name> after first down event.
-            node_events.close()
-            break
+        displaced = [
+            (service['name'], dict(replica))
+            for service in services for replica in service['nodes'] if replica['name'] == node_name
+        ]
 
-        logging.warning('Exiting node down monitor for {}.'.format(threading.current_thread().name))
+        # Single snapshot for the whole plan.
+        nodes_ = [n for n in self.nodes if n.name != node_name]
+        stats = self.haproxy.stats()
+        schedulers = {alias: get_scheduler(service.get('strategy')) for alias, service in
+                      ((s['name'], s) for s in services)}
+        loads = self.node_loads(nodes_, any(s.needs_stats for s in schedulers.values()))
+        requests = {alias: requested(replica.get('resources')) for alias, replica in displaced}
 
-    def next_node_name(self) -> str:
-        i = max([int(n.name.split('.')[0].split('-')[1]) for n in self.nodes] or [0]) + 1
-        return 'node-{}.{}'.format(i, self.name)
+        plan, unplaced = self.plan_placement([alias for alias, _ in displaced], nodes_, stats, loads, requests)
+        specs = {alias: replica for alias, replica in displaced}
 
-    def get_free_nodes(self, alias: str) -> iter:
-        srv_cfg = self.get_service_config(alias)
-        srv_nodes = srv_cfg.get('nodes', [])
+        started, failed = [], [dict(service=alias, error='No free node.') for alias in unplaced]
+        try:
+            started, not_started = self.start_replicas([(alias, node, specs[alias]) for alias, node in plan])
+            failed.extend(not_started)
+            if started:
+                self.commit_replicas(started)
+        finally:
+            self.release_placement(plan, started)
+
+        REPLICAS.inc(len(started), result='recovered')
+        REPLICAS.inc(len(failed), result='lost')
+        for alias, replica in started:
+            logging.info('Service {!r} redeployed on node {!r}.'.format(alias, replica['name']))
+        for f in failed:
+            logging.error('Could not redeploy service {!r} on another node: {}'.format(f['service'], f['error']))
+
+        report = dict(
+            node=node_name,
+            reason=str(reason),
+            displaced=len(displaced),
+            recovered=len(started),
+            failed=failed,
+            seconds=round(time.monotonic() - started_at, 3)
+        )
+        logging.info('Relocation from node {} done in {}s, recovered {} of {} replicas.'.format(
+            node_name, report['seconds'], report['recovered'], report['displaced']))
+
+        return report
 
-        def node_filter(name):
-            return lambda item: item['name'] == name
+    def node_ip(self, name: str) -> typing.Optional[str]:
+        node = self.inventory.get(name)
+        return node.ip if node else None
 
-        for n in self.nodes:
+    def is_node(self, name: str) -> bool:
+        return name.startswith('node-') and name.endswith('.' + self.name)
+
+    @property
+    def is_controller(self) -> bool:
+        return self._controller.is_set()
+
+    def on_node_down(self, event: dict):
+        if not self.is_controller:
+            return
+
+        # Node emits several down events (kill, die, stop, destroy), only first one is handled.
+        with locked(self._node_lock, 'node'):
+            if event['id'] in self._down_nodes:
+                return
+            self._down_nodes.add(event['id'])
+
+        self.migrate_services(event.get('Action'), event['Actor']['Attributes']['name'])
+
+    def start_monitoring(self, elect: bool = False):
+        """
+        Starts monitoring of all cluster nodes with a single event stream. Every API process keeps its node
+        inventory current. Node down events and warm pool are handled only by the controller process. With `elect`
+        the controller is elected among API processes (server workers), otherwise this process is the controller.
+        """
+        # Inventory is updated in the watcher thread, so a migration never plans with nodes which are already gone.
+        self.events.subscribe(
+            NodeInventory.START_EVENTS + NodeInventory.STOP_EVENTS, self.inventory.on_event, self.is_node, inline=True)
+        self.events.subscribe(HydraCluster.NODE_DOWN_EVENTS, self.on_node_down, self.is_node)
+        if self.pool.size > 0:
+            self.events.subscribe(WarmPool.STOP_EVENTS, self.on_standby_event, self.pool.is_standby)
+            # Standby node handed out by another API process is renamed to node name.
+            self.events.subscribe(['rename'], self.on_standby_event, self.is_node)
+        self.events.start()
+        METRICS.publish(self.service_registry)
+        # Every process samples proxy stats on its own, one `show stat` per interval over its runtime API session.
+        self.collector.start()
+
+        if elect:
+            self._election = LeaderElection(self.service_registry, self.start_controllers, self.stop_controllers)
+            self._election.start()
+        else:
+            self.start_controllers()
+
+    def start_controllers(self):
+        """
+        Makes this process the controller. Services of nodes which went missing while nobody was monitoring (API
+        restart) are migrated.
+        """
+        self._controller.set()
+        self.pool.start()
+        self.autoscaler.start()
+
+        existing = {n.name for n in self.nodes}
+        for name in self.registry.node_names() - existing:
+            self.events.submit(self.migrate_services, 'missing', name)
+
+    def stop_controllers(self):
+        self._controller.clear()
+        if self._pool:
+            self._pool.stop()
+
+    def on_node_change(self, action: str, state: dict):
+        # Every process sees the same node events, only the controller records them.
+        if self.is_controller:
+            try:
+                self.changes.record(NODE, action, state['name'], state)
+            except redis.RedisError as error:
+                logging.warning('Could not record change of node {}: {}'.format(state['name'], error))
+
+    def on_standby_event(self, event: dict):
+        if self.is_controller:
+            self.pool.on_event(event)
+
+    def service_lock(self, alias: str) -> threading.Lock:
+        with self._service_locks_lock:
+            return self._service_locks.setdefault(alias, threading.Lock())
+
+    def allocate_node_names(self, count: int) -> typing.List[str]:
+        """
+        Hands out `count` node names above the highest node in inventory. Every name is claimed in Redis, so names
+        are unique across API processes. Names claimed by others (their nodes are starting) are skipped.
+        """
+        names = []
+        ordinal = max([n.ordinal for n in self.inventory.nodes()] or [0])
+        while len(names) < count:
+            ordinal += 1
+            name = 'node-{}.{}'.format(ordinal, self.name)
+            if self.service_registry.set(NODE_NAME_KEY.format(name), self.name, nx=True, ex=NODE_NAME_TTL):
+                names.append(name)
+        return names
+
+    def release_node_name(self, name: str):
+        # Node didn't start, its name can be handed out again.
+        try:
+            self.service_registry.delete(NODE_NAME_KEY.format(name))
+        except redis.RedisError as error:
+            logging.warning('Could not release name of node {}: {}'.format(name, error))
+
+    def get_free_nodes(self, alias: str, nodes: list = None, stats: HAProxyStats = None) -> iter:
+        """
+        Yields nodes where service `alias` can be placed. Pass `nodes` and `stats` to plan against a snapshot. Proxy
+        slot of node is free if it's in maintenance or doesn't exist yet (it's added when replica is committed).
+        """
+        srv_nodes = {n['name'] for n in self.registry.cache.get(alias, {}).get('nodes', [])}
+
+        # One proxy snapshot per placement decision.
+        stats = stats or self.haproxy.stats()
+        free_slots = stats.servers(alias, 'MAINT')
+
+        for n in (self.nodes if nodes is None else nodes):
             # nodeN -> node-N ...
-            k = n.name.split('.')[0].replace('-', '')
-            free_on_proxy = next(self.haproxy.get_free_node(alias, k), None) is not None
-            free_on_cluster = srv_cfg is None or next(filter(node_filter(n.name), srv_nodes), None) is None
+            k = server_name(n.name)
+            free_on_proxy = k in free_slots or stats.get(alias, k) is None
+            free_on_cluster = n.name not in srv_nodes
 
             if free_on_proxy and free_on_cluster:
                 yield n
 
-    def create_node(self):
-        with HydraCluster.__lock:
-            name = self.next_node_name()
-            node = self._docker_client.containers.run(
-                HydraCluster.NODE_IMAGE,
-                name=name,
-                hostname=name,
-                privileged=True,
-                network=self.network.name,
-                tty=True,
-                stdin_open=True,
-                detach=True,
-                remove=True
-            )
+    def plan_placement(
+            self, aliases: typing.List[str], nodes: list, stats: HAProxyStats,
+            loads: typing.Dict[str, NodeLoad] = None, requests: typing.Dict[str, Resources] = None):
+        """
+        Places one replica per item of `aliases` and reserves slots for them. Nodes are ranked by placement strategy
+        of every service against `loads`, which are updated with replicas placed by this plan. Nodes without room
+        for resources requested by service (`requests`) are skipped. Returns list of (alias, node) and list of
+        aliases which couldn't be placed.
+        """
+        plan, unplaced = [], []
+        loads = dict(loads or self.node_loads(nodes))
+        requests = requests or {}
+
+        for alias in aliases:
+            taken = {node.name for a, node in plan if a == alias}
+            request = requests.get(alias, Resources())
+            candidates = [n for n in self.get_free_nodes(alias, nodes, stats) if n.name not in taken]
+            candidates = self.capacity.fits(candidates, request)
+            scheduler = get_scheduler(self.registry.cache.get(alias, {}).get('strategy'))
+            candidates = scheduler.rank(alias, candidates, loads)
+
+            reserved = self.reservations.reserve(alias, [n.name for n in candidates], 1)
+            node = next((n for n in candidates if reserved and n.name == reserved[0]), None)
+            if node and not self.capacity.hold(alias, node, request):
+                # Node filled up since it was checked.
+                self.reservations.release(alias, reserved)
+                node = None
+            if not node:
+                unplaced.append(alias)
+                continue
+
+            load = loads.get(node.name) or NodeLoad(node.name)
+            loads[node.name] = NodeLoad(node.name, load.replicas + 1, load.cpu, load.memory)
+            plan.append((alias, node))
+
+        return plan, unplaced
+
+    def node_loads(self, nodes: list, with_stats: bool = False) -> typing.Dict[str, NodeLoad]:
+        """
+        Returns scheduler inputs of `nodes`: count of replicas of all services from registry and, `with_stats`,
+        CPU and memory usage of node containers read from Docker stats in parallel.
+        """
+        replicas = {}
+        for cfg in self.registry.all():
+            for replica in cfg.get('nodes', []):
+                replicas[replica['name']] = replicas.get(replica['name'], 0) + 1
+
+        usage = {}
+        if with_stats:
+            futures = {self.deploy_executor.submit(n.stats, stream=False): n.name for n in nodes}
+            for future, name in futures.items():
+                try:
+                    stats = future.result(timeout=DEPLOY_TIMEOUT)
+                    usage[name] = (cpu_percent(stats), memory_fraction(stats))
+                except Exception as error:
+                    logging.warning('Could not read stats of node {}: {}'.format(name, error))
+
+        return {
+            n.name: NodeLoad(n.name, replicas.get(n.name, 0), *usage.get(n.name, (None, None)))
+            for n in nodes
+        }
 
-            # Start node down monitor ...
-            threading.Thread(
-                target=self.node_down_monitor,
-                args=(node.name, [self.migrate_services], HydraCluster.NODE_DOWN_EVENTS,),
-                name=node.name
-            ).start()
+    def _remove_abandoned(self, alias: str, node, _future):
+        # Removes container of replica which timed out while starting once its start is done, then releases its
+        # slot and capacity.
+        try:
+            self.stop_replica(alias, node)
+        finally:
+            with self._abandoned_lock:
+                self._abandoned.discard((alias, node.name))
+            self.capacity.release(alias, node.name)
+            self.reservations.release(alias, [node.name])
+
+    def release_placement(self, plan: list, started: list):
+        placed = {(alias, replica['name']) for alias, replica in started}
+        with self._abandoned_lock:
+            # Released once their containers are removed.
+            plan = [(alias, node) for alias, node in plan if (alias, node.name) not in self._abandoned]
+        for alias in {alias for alias, _ in plan}:
+            names = [node.name for a, node in plan if a == alias]
+            for name in names:
+                self.capacity.release(alias, name, linger=RESERVATION_LINGER if (alias, name) in placed else 0)
+            self.reservations.release(alias, [n for n in names if (alias, n) in placed], linger=RESERVATION_LINGER)
+            self.reservations.release(alias, [n for n in names if (alias, n) not in placed])
 
-            return node
+    def create_node(self):
+        # Only name allocation is serialized, nodes are started in parallel.
+        return self.start_node(self.allocate_node_names(1)[0])
+
+    def create_nodes(self, count: int) -> typing.Tuple[list, list]:
+        """
+        Starts `count` nodes concurrently on node executor. Names are allocated up front, ordinals are consecutive
+        unless another process allocates names at the same time. Returns once all nodes are running (or failed),
+        started nodes ordered by name and list of failures. Raises ClusterError if no node started.
+        """
+        if not isinstance(count, int) or count < 1:
+            raise ValueError('Count of nodes must be positive integer.')
+
+        names = self.allocate_node_names(count)
+        futures = {self.node_executor.submit(self.start_node, name): name for name in names}
+        with step('start nodes'):
+            _, not_done = concurrent.futures.wait(futures, timeout=NODE_TIMEOUT)
+
+        started, failed = [], []
+        for future, name in futures.items():
+            if future in not_done:
+                if future.cancel():
+                    # Never ran, so it won't release its name.
+                    self.release_node_name(name)
+                error = 'Timed out after {}s.'.format(NODE_TIMEOUT)
+            elif future.exception():
+                error = str(future.exception())
+            else:
+                started.append(future.result())
+                continue
+
+            logging.error('Could not start node {}: {}'.format(name, error))
+            failed.append(dict(name=name, error=error))
+
+        if not started:
+            raise ClusterError('No node started: {}'.format('; '.join(f['error'] for f in failed)))
+
+        logging.info('Started {} of {} nodes.'.format(len(started), count))
+        return started, failed
+
+    @operation('start_node')
+    def start_node(self, name: str):
+        """
+        Starts node `name` previously handed out by `allocate_node_names`. Node is taken from warm pool if there's
+        a ready one, otherwise it's started cold.
+        """
+        try:
+            node = self.pool.acquire(name) if self.pool.size > 0 else None
+            if not node:
+                node = self.run_node(name)
+                # Network settings are filled in once container runs.
+                node.reload()
+        except Exception:
+            self.release_node_name(name)
+            raise
+
+        self.inventory.add(node)
+        return node
+
+    def run_node(self, name: str):
+        return self._docker_client.containers.run(
+            HydraCluster.NODE_IMAGE,
+            name=name,
+            hostname=name,
+            privileged=True,
+            network=self.network.name,
+            tty=True,
+            stdin_open=True,
+            detach=True,
+            remove=True,
+            command=mirror_args() or None
+        )
 
-    def deploy_service(self, alias: str, image: str, node_port: int, service_port: int, replicas: int = 1) -> dict:
+    @operation('deploy_service')
+    def deploy_service(
+            self, alias: str, image: str, node_port: int, service_port: int, replicas: int = 1,
+            strategy: str = None, resources: dict = None, autoscale: dict = None) -> dict:
+        """
+        Deploys `replicas` of service `alias`. `resources` may have `limits` and `reservations`, each with `cpus`
+        and `memory`, which are passed to `docker run` and accounted against node capacity. `autoscale` policy is
+        stored with the service, existing policy is kept if not given.
+        """
         logging.info('Deploying %s replicas of service %r with image %r.', replicas, alias, image)
 
+        resources, scheduler = self.validate_service(alias, image, node_port, service_port, strategy, resources)
+        request = requested(resources)
+        fields = dict(strategy=scheduler.name, resources=resources)
+        policy = parse_policy(autoscale)
+        if policy:
+            fields['autoscale'] = policy
+
+        with step('place'):
+            nodes_, reserved = self._place_service(alias, replicas, scheduler, request)
+
+        plan = [(alias, n) for n in nodes_ if n.name in reserved]
+        spec = dict(service_image=image, node_port=node_port, service_port=service_port)
+        if resources:
+            spec['resources'] = resources
+        started = []
+
+        try:
+            srv_cfg = self.get_service_config(alias)
+
+            started, failed = self.start_replicas([(alias, node, spec) for _, node in plan])
+
+            if not started:
+                raise ClusterError('Service {!r} could not be started on any node. {}'.format(
+                    alias, ' '.join('{name}: {error}'.format(**f) for f in failed)))
+
+            with step('commit'):
+                self.commit_replicas(started, **fields)
+
+            srv_cfg['nodes'].extend(replica for _, replica in started)
+            srv_cfg['endpoints'] = [self.haproxy.url + '/' + alias]
+            srv_cfg['deploy'] = dict(
+                requested=replicas,
+                started=len(started),
+                failed=[dict(name=f['name'], error=f['error']) for f in failed]
+            )
+            return srv_cfg
+        finally:
+            self.release_placement(plan, started)
+
+    @operation('scale_service')
+    def scale_service(self, alias: str, replicas: int) -> dict:
+        """
+        Adds replicas of service `alias` on free nodes or removes surplus ones until it has `replicas`. Fewer replicas
+        are added if there aren't enough free nodes. Returns added and removed node names.
+        """
+        cfg = self.registry.get(alias)
+        if not cfg or not cfg['nodes']:
+            raise ClusterError('Service {!r} has no replicas to scale from.'.format(alias))
+
+        current = len(cfg['nodes'])
+        added, removed = [], []
+
+        if replicas > current:
+            spec = cfg['nodes'][0]
+            request = requested(spec.get('resources'))
+            free = len(self.capacity.fits(list(self.get_free_nodes(alias)), request))
+            count = min(replicas - current, free)
+            if count < replicas - current:
+                logging.warning('Only {} free nodes to scale service {!r} up.'.format(free, alias))
+            if count > 0:
+                deployed = self.deploy_service(
+                    alias, spec['service_image'], spec['node_port'], spec['service_port'], count,
+                    strategy=cfg.get('strategy'), resources=spec.get('resources'))
+                added = [n['name'] for n in deployed['nodes'] if n['name'] not in node_names(cfg)]
+        elif replicas < current:
+            removed = self.remove_replicas(alias, current - replicas)
+
+        return dict(service=alias, replicas=current + len(added) - len(removed), added=added, removed=removed)
+
+    def remove_replicas(self, alias: str, count: int) -> typing.List[str]:
+        """
+        Removes `count` replicas of service `alias` from the busiest nodes. Their proxy slots are put into maintenance
+        first so that no new requests reach them, then they are unlinked and stopped.
+        """
+        with locked(self.service_lock(alias), 'service'):
+            cfg = self.registry.get(alias) or dict(nodes=[])
+            loads = self.node_loads([n for n in self.nodes])
+            victims = sorted(
+                cfg['nodes'], key=lambda r: (loads[r['name']].replicas if r['name'] in loads else -1, r['name']),
+                reverse=True)[:count]
+
+            self.haproxy.unregister([(alias, r['name']) for r in victims])
+            with self.registry.batch() as batch:
+                for r in victims:
+                    batch.remove_replica(alias, r['name'])
+
+        self.stop_replicas([(alias, r['name']) for r in victims])
+
+        REPLICAS.inc(len(victims), result='removed')
+        logging.info('Removed {} replicas of service {!r}.'.format(len(victims), alias))
+        return [r['name'] for r in victims]
+
+    def stop_replicas(self, replicas: typing.List[typing.Tuple[str, str]]):
+        """
+        Stops and removes containers of replicas (alias, node name) inside their nodes.
+        """
+        for alias, node_name in replicas:
+            node = self.inventory.get(node_name)
+            if node:
+                self.stop_replica(alias, node.container)
+
+    def stop_replica(self, alias: str, node) -> bool:
+        try:
+            exit_code, output = node.exec_run(['docker', 'rm', '-f', '{}.{}'.format(alias, node.name)])
+        except Exception as error:
+            exit_code, output = 1, error
+        if exit_code > 0:
+            logging.warning('Could not stop service {!r} on {}: {}'.format(alias, node.name, output))
+            return False
+        return True
+
+    def set_autoscale(self, alias: str, policy: typing.Optional[dict]) -> typing.Optional[dict]:
+        """
+        Sets (or with None removes) autoscaling policy of deployed service. Raises KeyError for unknown service.
+        """
+        if not self.registry.get(alias):
+            raise KeyError(alias)
+        policy = parse_policy(policy)
+        with self.registry.batch() as batch:
+            batch.set_fields(alias, autoscale=policy)
+        return policy
+
+    def validate_service(
+            self, alias: str, image: str, node_port: int, service_port: int, strategy: str = None,
+            resources: dict = None):
+        """
+        Validates deploy arguments, raises ValueError. Returns normalized resources and scheduler of the service.
+        """
         if alias and not alias.isalnum():
             msg = 'Alias has to be alphanumeric.'
             logging.error(msg)
             raise ValueError(msg)
+        if alias in RESERVED_PROXIES:
+            msg = 'Alias {!r} is reserved by proxy.'.format(alias)
+            logging.error(msg)
+            raise ValueError(msg)
         if not image:
             msg = 'Image name needed.'
             logging.error(msg)
@@ -198,58 +758,134 @@ class HydraCluster(object):
             logging.error(msg)
             raise ValueError(msg)
 
-        with HydraCluster.__lock:
-            nodes_ = list(self.get_free_nodes(alias))
-            node_count = len(nodes_)
-
-            logging.info('Count of free nodes is {}'.format(node_count))
-
-            if replicas > node_count:
-                raise NotEnoughNodes('Available nodes is {}.'.format(node_count))
-
-            # Spread strategy is just to shuffle nodes :)
-            random.shuffle(nodes_)
-
-            srv_cfg = self.get_service_config(alias)
-
-            def deploy():
-                node = nodes_.pop()
-                service_node_name = '{}.{}'.format(alias, node.name)
-
-                cmd = [
-                    'docker', 'run',
-                    '-tid', '--rm',
-                    '-p', '{}:{}'.format(node_port, service_port),
-                    '--name', service_node_name,
-                    image
-                ]
-
-                # Start service on given node.
-                exit_code, output = node.exec_run(cmd)
-                if exit_code > 0:
-                    raise ClusterError(output)
-
-                logging.info('Service {!r} started on {}:{}.'.format(alias, node.name, node_port))
-
-                # TODO: If service hasn't been yet configured on HAProxy then do it dynamically.
-                self.haproxy.register_service(alias, node.name, node_port)
-
-                srv_node_info = dict(
-                    name=node.name,
-                    service_image=image,
-                    node_port=node_port,
-                    service_port=service_port
-                )
-
-                srv_cfg['nodes'].append(srv_node_info)
-
-            threads = [threading.Thread(target=deploy) for _ in range(0, replicas)]
-            [t.start() for t in threads]
-            [t.join() for t in threads]
-
-            srv_cfg['endpoints'] = [self.haproxy.url + '/' + alias]
-
-            # TODO: Redis interface is leaking in.
-            self.service_registry.set(alias, json.dumps(srv_cfg))
-
-            return srv_cfg
+        resources = parse_resources(**(resources or {}))
+        scheduler = get_scheduler(strategy or self.registry.cache.get(alias, {}).get('strategy'))
+        return resources, scheduler
+
+    def _place_service(self, alias: str, replicas: int, scheduler, request: Resources) -> tuple:
+        # Returns ranked free nodes and names of nodes with reserved slot and capacity for all `replicas`.
+        # Loads are read before taking the lock, Docker stats are slow.
+        loads = self.node_loads(list(self.nodes), scheduler.needs_stats)
+
+        with locked(self.service_lock(alias), 'service'):
+            nodes_ = self.capacity.fits(list(self.get_free_nodes(alias)), request)
+            nodes_ = scheduler.rank(alias, nodes_, loads)
+
+            # Slots are reserved before the lock is released, deploys can run in parallel from here on.
+            reserved = self.reservations.reserve(alias, [n.name for n in nodes_], replicas)
+
+            # Capacity is held atomically, other services may have filled the node since it was checked.
+            full = [n.name for n in nodes_ if n.name in reserved and not self.capacity.hold(alias, n, request)]
+            if full:
+                self.reservations.release(alias, full)
+                reserved = [name for name in reserved if name not in full]
+
+            logging.info('Count of free nodes is {}, reserved {}.'.format(len(nodes_), len(reserved)))
+
+            if replicas > len(reserved):
+                for name in reserved:
+                    self.capacity.release(alias, name)
+                self.reservations.release(alias, reserved)
+                raise NotEnoughNodes('Available nodes is {}.'.format(len(reserved)))
+
+        return nodes_, reserved
+
+    def start_replicas(self, assignments: typing.List[tuple]) -> typing.Tuple[list, list]:
+        """
+        Starts replicas concurrently on deploy executor. `assignments` is a list of (alias, node, spec) where spec
+        has `service_image`, `node_port` and `service_port`. Images are seeded on all target nodes first. Returns list
+        of started (alias, replica) and list of failures.
+        """
+        targets = {}
+        for _, node, spec in assignments:
+            targets.setdefault(spec['service_image'], {})[node.name] = node
+        with step('seed'):
+            for image, nodes_ in targets.items():
+                self.seeder.seed(image, list(nodes_.values()))
+
+        futures = {
+            self.deploy_executor.submit(
+                self.start_replica, alias, node, spec['service_image'], spec['node_port'], spec['service_port'],
+                spec.get('resources')
+            ): (alias, node)
+            for alias, node, spec in assignments
+        }
+        with step('start'):
+            _, not_done = concurrent.futures.wait(futures, timeout=DEPLOY_TIMEOUT)
+
+        started, failed = [], []
+        for future, (alias, node) in futures.items():
+            if future in not_done:
+                if not future.cancel():
+                    # Already running, `docker run` may still create the container.
+                    with self._abandoned_lock:
+                        self._abandoned.add((alias, node.name))
+                    future.add_done_callback(functools.partial(self._remove_abandoned, alias, node))
+                error = 'Timed out after {}s.'.format(DEPLOY_TIMEOUT)
+            elif future.exception():
+                error = str(future.exception())
+            else:
+                started.append((alias, future.result()))
+                continue
+
+            logging.error('Could not start service {!r} on {}: {}'.format(alias, node.name, error))
+            failed.append(dict(service=alias, name=node.name, error=error))
+
+        REPLICAS.inc(len(started), result='started')
+        REPLICAS.inc(len(failed), result='failed')
+        return started, failed
+
+    def commit_replicas(self, started: typing.List[tuple], **fields):
+        """
+        Registers started (alias, replica) on HAProxy and in service registry, one round trip to each. Backends and
+        slots missing on HAProxy are added first. `fields` are set on configuration of every service.
+        """
+        try:
+            self.haproxy.ensure_slots([(alias, r['name']) for alias, r in started])
+            self.haproxy.register(
+                [(alias, r['name'], r['node_port'], self.node_ip(r['name'])) for alias, r in started])
+        except Exception as error:
+            # Replicas which can't be reached through the proxy aren't recorded, so nothing else would remove them.
+            logging.error('Could not register replicas on proxy, stopping them: {}'.format(error))
+            self.stop_replicas([(alias, r['name']) for alias, r in started])
+            raise
+
+        url = self.haproxy.url
+        aliases = list(dict.fromkeys(alias for alias, _ in started))
+
+        # Only started replicas are added, replicas added concurrently by others stay intact.
+        with self.registry.batch() as batch:
+            for alias in aliases:
+                batch.set_fields(alias, endpoints=[url + '/' + alias], **fields)
+                batch.add_replicas(alias, [r for a, r in started if a == alias])
+
+    def start_replica(
+            self, alias: str, node, image: str, node_port: int, service_port: int, resources: dict = None) -> dict:
+        service_node_name = '{}.{}'.format(alias, node.name)
+
+        cmd = [
+            'docker', 'run',
+            '-tid', '--rm',
+            '-p', '{}:{}'.format(node_port, service_port),
+            '--name', service_node_name,
+            *docker_args(resources),
+            image
+        ]
+
+        # Start service on given node.
+        with EXEC_SECONDS.time(command='docker run'):
+            exit_code, output = node.exec_run(cmd)
+        if exit_code > 0:
+            raise ClusterError(output)
+
+        logging.info('Service {!r} started on {}:{}.'.format(alias, node.name, node_port))
+
+        replica = dict(
+            name=node.name,
+            service_image=image,
+            node_port=node_port,
+            service_port=service_port
+        )
+        if resources:
+            replica['resources'] = resources
+        return replica
@@ -1,49 +1,348 @@
+import json
 import logging
+import os
+import threading
+import time
+import typing
 
-from flask import Flask, request, jsonify, url_for
-from . import HydraCluster, NotEnoughNodes
+from flask import Flask, Response, request, jsonify, url_for
+from . import HydraCluster
+from .autoscale import parse_policy
+from .changes import VersionGone
+from .inventory import ordinal
+from .listing import Page, json_array, json_object, matches, parse_fields, parse_limit
+from .metrics import REGISTRY as METRICS
+from .timeseries import STATS_WINDOW
 
-FLASK_DEBUG = True
+# Development server (Flask reloader, debugger, DEBUG log in hydra-cluster.log) instead of the production one.
+FLASK_DEBUG = os.environ.get('HYDRA_API_DEBUG', '').lower() in ('1', 'true', 'yes')
 API_PORT = 8080
 
-logging.basicConfig(filename='hydra-cluster.log', level=logging.DEBUG)
+# Log level of the production server, log goes to stderr (docker logs).
+LOG_LEVEL = os.environ.get('HYDRA_LOG_LEVEL', 'INFO').upper()
+
+# Longest wait (seconds) of long-poll of /changes and lifetime of its event stream, client reconnects after it.
+WATCH_TIMEOUT = float(os.environ.get('HYDRA_WATCH_TIMEOUT', 30))
+STREAM_TIMEOUT = float(os.environ.get('HYDRA_STREAM_TIMEOUT', 300))
+# Most clients of /changes waiting at once in a process, each holds a request thread (HYDRA_API_THREADS), the rest
+# get 503, so that watchers don't starve other requests.
+MAX_WATCHERS = int(os.environ.get('HYDRA_MAX_WATCHERS', 2))
 
 api = Flask(__name__)
-cluster = HydraCluster()
 
+_cluster = None
+_cluster_pid = None
+_cluster_lock = threading.Lock()
+_watchers = threading.BoundedSemaphore(max(MAX_WATCHERS, 1))
 
-@api.route('/node', methods=['POST'])
-def node():
-    # TODO check if we have enough nodes on HAProxy
-    node_ = cluster.create_node()
-    d = dict(
+
+def get_cluster() -> HydraCluster:
+    """
+    Cluster of this process. It's created on first use, so that every server worker (forked process) has its own
+    Docker and Redis connections and threads.
+    """
+    global _cluster, _cluster_pid
+    with _cluster_lock:
+        if _cluster is None or _cluster_pid != os.getpid():
+            _cluster = HydraCluster()
+            _cluster_pid = os.getpid()
+        return _cluster
+
+
+def node_info(node_) -> dict:
+    return dict(
         name=node_.name,
         image=node_.attrs['Config']['Image'],
         state=node_.attrs['State']
     )
-    return jsonify(d)
+
+
+def accepted(job: dict):
+    job = dict(job, url=url_for(job_state.__name__, job_id=job['id'], _external=True))
+    return jsonify(job), 202, {'Location': job['url']}
+
+
+def create_node():
+    return node_info(get_cluster().create_node())
+
+
+def create_nodes(count: int):
+    nodes, failed = get_cluster().create_nodes(count)
+    return dict(nodes=[node_info(n) for n in nodes], failed=failed)
+
+
+@api.route('/node', methods=['POST'])
+def node():
+    # TODO check if we have enough nodes on HAProxy
+    cluster = get_cluster()
+    content = request.get_json(silent=True) or {}
+
+    if 'count' not in content:
+        return accepted(cluster.jobs.submit('create_node', create_node))
+
+    count = content.get('count')
+    if not isinstance(count, int) or isinstance(count, bool) or count < 1:
+        return jsonify(dict(error='Count of nodes must be positive integer.')), 400
+
+    return accepted(cluster.jobs.submit('create_nodes', create_nodes, count))
+
+
+@api.route('/jobs/<job_id>', methods=['GET'])
+def job_state(job_id: str):
+    job = get_cluster().jobs.get(job_id)
+    if not job:
+        return jsonify(dict(error='Job {} not found.'.format(job_id))), 404
+    return jsonify(job)
+
+
+def not_modified(version: int):
+    if request.if_none_match.contains(str(version)):
+        return Response(status=304, headers={'ETag': '"{}"'.format(version)})
+    return None
+
+
+def streamed(chunks, version: int) -> Response:
+    response = Response(chunks, mimetype='application/json')
+    response.set_etag(str(version))
+    return response
+
+
+def listing_args() -> dict:
+    """
+    Query of listings: filters `node` and `service` (name or pattern), `cursor`, `limit` and `fields`.
+    """
+    return dict(
+        node=request.args.get('node'),
+        service=request.args.get('service'),
+        cursor=request.args.get('cursor'),
+        limit=request.args.get('limit'),
+        fields=parse_fields(request.args.get('fields'))
+    )
+
+
+def node_page(cluster: HydraCluster, node: str = None, service: str = None, cursor: str = None,
+              limit: int = None) -> Page:
+    nodes = [n for n in cluster.inventory.nodes() if matches(n.name, node)]
+    if service:
+        hosting = {r['name'] for cfg in cluster.services if matches(cfg['name'], service) for r in cfg['nodes']}
+        nodes = [n for n in nodes if n.name in hosting]
+    return Page(nodes, lambda n: n.name, ordinal, cursor=cursor, limit=limit or len(nodes) or 1)
+
+
+def service_page(cluster: HydraCluster, node: str = None, service: str = None, cursor: str = None,
+                 limit: int = None) -> Page:
+    services = [cfg for cfg in cluster.services if matches(cfg['name'], service)]
+    if node:
+        services = [cfg for cfg in services if any(matches(r['name'], node) for r in cfg['nodes'])]
+    return Page(services, lambda cfg: cfg['name'], cursor=cursor, limit=limit or len(services) or 1)
+
+
+def next_url(endpoint, page: Page, fields: typing.Optional[set] = None):
+    if page.next is None:
+        return None
+    args = dict(request.args.to_dict(), cursor=page.next)
+    args.pop('fields', None)
+    if fields:
+        args['fields'] = ','.join(sorted(fields))
+    return url_for(endpoint, _external=True, **args)
 
 
 @api.route('/state', methods=['GET'])
 def state():
-    d = {
-        'name': cluster.name,
-        'nodes': list(cluster.node_state),
-        'api': {
+    """
+    Whole cluster state streamed out. Accepts filters of listings; `limit` caps nodes and services, the rest is
+    available from /nodes and /services (`next`). `fields` selects sections and fields of their items, e.g.
+    `fields=version,nodes.name,services`.
+    """
+    cluster = get_cluster()
+    try:
+        args = listing_args()
+        limit = parse_limit(args.pop('limit'), default=None)
+        fields = args.pop('fields') or {}
+        args.pop('cursor')
+
+        # Version is read before the state, so that state is never older than its ETag.
+        version = cluster.changes.version()
+        unchanged = not_modified(version)
+        if unchanged:
+            return unchanged
+
+        nodes = node_page(cluster, limit=limit, **args)
+        services = service_page(cluster, limit=limit, **args)
+    except ValueError as error:
+        return jsonify(dict(error=str(error))), 400
+
+    sections = [
+        ('name', cluster.name),
+        ('version', version),
+        ('nodes', lambda: json_array(cluster.node_states(nodes), fields.get('nodes'))),
+        ('api', {
             'node': url_for(node.__name__, _external=True),
             'state': url_for(state.__name__, _external=True),
-            'service': url_for(service.__name__, _external=True)
-        },
-        'services': list(cluster.services)
-    }
+            'service': url_for(service.__name__, _external=True),
+            'pool': url_for(pool.__name__, _external=True),
+            'capacity': url_for(capacity.__name__, _external=True),
+            'changes': url_for(changes.__name__, _external=True),
+            'nodes': url_for(nodes_list.__name__, _external=True),
+            'services': url_for(services_list.__name__, _external=True)
+        }),
+        ('services', lambda: json_array(services, fields.get('services'))),
+        ('next', {'nodes': next_url(nodes_list.__name__, nodes, fields.get('nodes')),
+                  'services': next_url(services_list.__name__, services, fields.get('services'))})
+    ]
+    if fields:
+        sections = [(k, v) for k, v in sections if k in fields]
 
     # TODO: Show also HAProxy state
 
-    return jsonify(d)
+    return streamed(json_object(sections), version)
+
+
+def listing(endpoint, page_of, items_of) -> Response:
+    cluster = get_cluster()
+    try:
+        args = listing_args()
+        args['limit'] = parse_limit(args['limit'])
+        # `fields=name,ip` selects fields of items.
+        fields = set(args.pop('fields') or ()) or None
+
+        version = cluster.changes.version()
+        unchanged = not_modified(version)
+        if unchanged:
+            return unchanged
+
+        page = page_of(cluster, **args)
+    except ValueError as error:
+        return jsonify(dict(error=str(error))), 400
+
+    return streamed(json_object([
+        ('version', version),
+        ('items', lambda: json_array(items_of(cluster, page), fields)),
+        ('next', next_url(endpoint, page, fields))
+    ]), version)
+
+
+@api.route('/nodes', methods=['GET'])
+def nodes_list():
+    return listing(nodes_list.__name__, node_page, lambda cluster, page: cluster.node_states(page))
+
+
+@api.route('/services', methods=['GET'])
+def services_list():
+    return listing(services_list.__name__, service_page, lambda cluster, page: page)
+
+
+def since_version() -> int:
+    value = request.headers.get('Last-Event-ID', request.args.get('since', 0))
+    try:
+        version = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('Version must be an integer.')
+    if version < 0:
+        raise ValueError('Version must not be negative.')
+    return version
+
+
+def stream_changes(cluster: HydraCluster, version: int):
+    deadline = time.monotonic() + STREAM_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            timeout = min(WATCH_TIMEOUT, deadline - time.monotonic())
+            version, delta = cluster.changes.since(version, timeout=timeout)
+        except VersionGone:
+            yield 'event: gone\ndata: {}\n\n'.format(json.dumps(dict(version=version)))
+            return
+        for change in delta:
+            yield 'id: {}\ndata: {}\n\n'.format(change['version'], json.dumps(change))
+        if not delta:
+            # Keeps connection alive through proxies.
+            yield ': keep-alive\n\n'
+
+
+@api.route('/changes', methods=['GET'])
+def changes():
+    """
+    Changes of cluster state after version `since` (or Last-Event-ID). Long-poll returning JSON, or Server-Sent
+    Events stream with `Accept: text/event-stream`. 410 if the changes aren't kept anymore, re-read /state then, 503 if
+    too many clients wait for changes already.
+    """
+    cluster = get_cluster()
+    try:
+        version = since_version()
+        timeout = min(float(request.args.get('timeout', WATCH_TIMEOUT)), WATCH_TIMEOUT)
+    except ValueError as error:
+        return jsonify(dict(error=str(error))), 400
+
+    if not _watchers.acquire(blocking=False):
+        return jsonify(dict(error='Too many clients watching changes, retry later.')), 503, {'Retry-After': '5'}
+
+    if request.accept_mimetypes.best == 'text/event-stream':
+        response = Response(stream_changes(cluster, version), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        # Released when the server closes the response, even if the stream never started.
+        response.call_on_close(_watchers.release)
+        return response
+
+    try:
+        current, delta = cluster.changes.since(version, timeout=max(timeout, 0))
+    except VersionGone:
+        return jsonify(dict(error='Changes since version {} are gone, read /state.'.format(version))), 410
+    finally:
+        _watchers.release()
+    return jsonify(dict(version=current, changes=delta))
+
+
+@api.route('/stats', methods=['GET'])
+def stats():
+    """
+    Aggregates of HAProxy stats per service and replica over the last `window` seconds, `service` filters services
+    by name or pattern.
+    """
+    cluster = get_cluster()
+    try:
+        window = float(request.args.get('window', STATS_WINDOW))
+        if window <= 0:
+            raise ValueError()
+    except ValueError:
+        return jsonify(dict(error='Window must be a positive number of seconds.')), 400
+
+    pattern = request.args.get('service')
+    return jsonify(dict(
+        interval=cluster.collector.interval,
+        window=window,
+        services=cluster.collector.aggregates(window, lambda name: matches(name, pattern))
+    ))
+
+
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Metrics of all API processes in Prometheus text format.
+    """
+    text = METRICS.render(get_cluster().service_registry)
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+
+@api.route('/capacity', methods=['GET'])
+def capacity():
+    """
+    Allocated resources and capacity of nodes, `node` filters nodes by name or pattern. Deploys in progress change
+    them without a new state version, so unlike /state and /nodes the response has no ETag.
+    """
+    cluster = get_cluster()
+    nodes = sorted((n for n in cluster.inventory.nodes() if matches(n.name, request.args.get('node'))),
+                   key=lambda n: ordinal(n.name))
+    return jsonify(dict(nodes=list(cluster.node_allocation(nodes))))
+
+
+@api.route('/pool', methods=['GET'])
+def pool():
+    return jsonify(get_cluster().pool.stats())
 
 
 @api.route('/service', methods=['POST'])
 def service():
+    cluster = get_cluster()
     content = request.get_json()
 
     service_alias = content.get('alias')
@@ -51,15 +350,66 @@ def service():
     node_port = content.get('node_port')
     service_port = content.get('service_port')
     replicas = content.get('replicas', 1)
+    strategy = content.get('strategy')
+    resources = dict(limits=content.get('limits'), reservations=content.get('reservations'))
+    autoscale = content.get('autoscale')
 
     try:
-        service_state = cluster.deploy_service(
-            service_alias, service_image, node_port, service_port, replicas)
-        logging.info('Service %r deployed.', service_alias)
-        return jsonify(service_state)
-    except (ValueError, NotEnoughNodes) as error:
+        cluster.validate_service(service_alias, service_image, node_port, service_port, strategy, resources)
+        if not isinstance(replicas, int) or isinstance(replicas, bool) or replicas < 1:
+            raise ValueError('Count of replicas must be positive integer.')
+        policy = parse_policy(autoscale)
+        if policy and not policy['min'] <= replicas <= policy['max']:
+            raise ValueError('Replicas must be between min and max of autoscaling.')
+    except ValueError as error:
         return jsonify(dict(error=str(error))), 400
 
+    # Deploy runs as a job, outcome (or 400 for NotEnoughNodes, 500 for ClusterError) is reported by /jobs/<id>.
+    job = cluster.jobs.submit(
+        'deploy_service', cluster.deploy_service,
+        service_alias, service_image, node_port, service_port, replicas, strategy=strategy, resources=resources,
+        autoscale=autoscale)
+    logging.info('Deploy of service %r queued as job %s.', service_alias, job['id'])
+    return accepted(job)
+
+
+@api.route('/service/<alias>/scale', methods=['POST'])
+def scale(alias: str):
+    cluster = get_cluster()
+    replicas = (request.get_json(silent=True) or {}).get('replicas')
+    if not isinstance(replicas, int) or isinstance(replicas, bool) or replicas < 1:
+        return jsonify(dict(error='Count of replicas must be positive integer.')), 400
+    if not cluster.registry.get(alias):
+        return jsonify(dict(error='Service {} not found.'.format(alias))), 404
+
+    return accepted(cluster.jobs.submit('scale_service', cluster.scale_service, alias, replicas))
+
+
+@api.route('/service/<alias>/autoscale', methods=['PUT'])
+def autoscale(alias: str):
+    """
+    Sets autoscaling policy of service, `null` turns autoscaling off.
+    """
+    try:
+        policy = get_cluster().set_autoscale(alias, request.get_json(silent=True))
+    except KeyError:
+        return jsonify(dict(error='Service {} not found.'.format(alias))), 404
+    except ValueError as error:
+        return jsonify(dict(error=str(error))), 400
+    return jsonify(dict(service=alias, autoscale=policy))
+
 
 def main():
+    if not FLASK_DEBUG:
+        from .server import serve
+        logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s')
+        serve(api, get_cluster)
+        return
+
+    logging.basicConfig(filename='hydra-cluster.log', level=logging.DEBUG)
+
+    # With debug on, Flask reloader runs the app in a child process. Monitor nodes only there.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        get_cluster().start_monitoring()
+
     api.run(host='0.0.0.0', port=API_PORT, debug=FLASK_DEBUG)
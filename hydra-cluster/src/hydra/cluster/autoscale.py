@@ -0,0 +1,155 @@
+import logging
+import math
+import os
+import threading
+import time
+import typing
+
+# How often (seconds) the controller evaluates autoscaling policies of services.
+AUTOSCALE_INTERVAL = float(os.environ.get('HYDRA_AUTOSCALE_INTERVAL', 15))
+
+# Relative deviation from target which doesn't cause scaling.
+TOLERANCE = 0.1
+
+# Targets of policy and the sampled stat of the service backend (see timeseries) each is compared with. `req_rate`
+# (requests per second, rate of backend `req_tot`) and `qcur` are per replica, `rtime` is average response time (ms).
+TARGETS = {'req_rate': 'req_rate', 'qcur': 'qcur', 'rtime': 'rtime'}
+
+DEFAULTS = dict(min=1, cooldown_up=60, cooldown_down=300, window=60)
+
+
+def parse_policy(policy: typing.Optional[dict]) -> typing.Optional[dict]:
+    """
+    Validates and normalizes autoscaling policy of service. Returns None if there's none.
+
+    Policy has `max` replicas and at least one target (`req_rate`, `qcur`, `rtime`), optionally `min` replicas,
+    `cooldown_up` and `cooldown_down` (seconds since last scaling) and `window` (seconds of stats).
+    """
+    if not policy:
+        return None
+    if not isinstance(policy, dict):
+        raise ValueError('Autoscaling policy must be an object.')
+
+    unknown = set(policy) - set(DEFAULTS) - set(TARGETS) - {'max'}
+    if unknown:
+        raise ValueError('Unknown autoscaling settings {}.'.format(', '.join(sorted(unknown))))
+
+    parsed = dict(DEFAULTS)
+    for key, value in policy.items():
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise ValueError('Autoscaling setting {} must be a non-negative number.'.format(key))
+        parsed[key] = value
+
+    if not isinstance(parsed.get('max'), int) or not isinstance(parsed['min'], int):
+        raise ValueError('Autoscaling needs integer min and max replicas.')
+    if parsed['min'] < 1 or parsed['max'] < parsed['min']:
+        raise ValueError('Autoscaling needs 1 <= min <= max replicas.')
+    if not any(parsed.get(t) for t in TARGETS):
+        raise ValueError('Autoscaling needs a target, one of {}.'.format(', '.join(sorted(TARGETS))))
+    if parsed['window'] <= 0:
+        raise ValueError('Autoscaling window must be positive.')
+    return parsed
+
+
+def desired_replicas(policy: dict, current: int, stats: typing.Optional[dict]) -> int:
+    """
+    Replica count wanted by `policy` for service with `current` replicas and aggregated backend `stats`. Every
+    target scales replicas proportionally (current * observed / target), the largest count wins. Without stats the
+    count is only kept within min and max.
+    """
+    wanted = current
+    if current and stats and stats.get('samples'):
+        counts = []
+        for target, stat in TARGETS.items():
+            if not policy.get(target):
+                continue
+            observed = (stats.get(stat) or {}).get('avg')
+            if observed is None:
+                continue
+            if target in ('req_rate', 'qcur'):
+                observed = observed / current
+            ratio = observed / policy[target]
+            counts.append(current if abs(ratio - 1) <= TOLERANCE else int(math.ceil(current * ratio)))
+        if counts:
+            wanted = max(counts)
+
+    return min(max(wanted, policy['min']), policy['max'])
+
+
+class Autoscaler(object):
+    """
+    Control loop which keeps replica counts of services with autoscaling policy at the count wanted by the policy.
+
+    Scaling up waits `cooldown_up` since the last scale up, scaling down `cooldown_down` since the last scaling of
+    the service in either direction. Loop runs only while `is_active` (controller process).
+    """
+
+    def __init__(
+            self, services: typing.Callable[[], typing.List[dict]],
+            stats: typing.Callable[[str, float], typing.Optional[dict]],
+            scale: typing.Callable[[str, int], typing.Any], is_active: typing.Callable[[], bool] = lambda: True,
+            interval: float = AUTOSCALE_INTERVAL):
+        self._services = services
+        self._stats = stats
+        self._scale = scale
+        self._is_active = is_active
+        self.interval = interval
+        self._scaled_up = {}
+        self._scaled = {}
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._thread or self.interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._run, name='autoscaler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            if not self._is_active():
+                continue
+            try:
+                self.evaluate()
+            except Exception as error:
+                logging.warning('Autoscaling failed: {}'.format(error))
+
+    def evaluate(self, now: float = None) -> typing.Dict[str, int]:
+        """
+        One round of the loop. Returns services scaled with their new replica counts.
+        """
+        now = time.monotonic() if now is None else now
+        decisions = {}
+
+        for cfg in self._services():
+            policy = cfg.get('autoscale')
+            if not policy:
+                continue
+            alias = cfg['name']
+            current = len(cfg.get('nodes', []))
+            wanted = desired_replicas(policy, current, self._stats(alias, policy['window']))
+
+            if wanted > current:
+                if now - self._scaled_up.get(alias, -math.inf) < policy['cooldown_up']:
+                    continue
+                self._scaled_up[alias] = now
+            elif wanted < current:
+                if now - self._scaled.get(alias, -math.inf) < policy['cooldown_down']:
+                    continue
+            else:
+                continue
+
+            self._scaled[alias] = now
+            logging.info('Autoscaling service {!r} from {} to {} replicas.'.format(alias, current, wanted))
+            try:
+                self._scale(alias, wanted)
+                decisions[alias] = wanted
+            except Exception as error:
+                logging.error('Could not scale service {!r} to {} replicas: {}'.format(alias, wanted, error))
+
+        return decisions
@@ -0,0 +1,87 @@
+import json
+import os
+import redis
+import typing
+
+from .registry import decode
+
+# Cluster state version, incremented by every recorded change.
+VERSION_KEY = 'hydra:state:version'
+
+# Stream of changes, entry id of change is `<version>-0`.
+STREAM_KEY = 'hydra:state:changes'
+
+# Approximate count of changes kept in the stream. Clients which are further behind have to re-read /state.
+STREAM_MAXLEN = int(os.environ.get('HYDRA_CHANGES_MAXLEN', 10000))
+
+# Increment version and append change under it in one step, so versions in the stream are strictly increasing.
+RECORD_SCRIPT = """
+local version = redis.call('incr', KEYS[1])
+redis.call('xadd', KEYS[2], 'MAXLEN', '~', ARGV[1], version .. '-0', 'change', ARGV[2])
+return version
+"""
+
+NODE = 'node'
+SERVICE = 'service'
+
+
+class VersionGone(Exception):
+    """
+    Changes since requested version aren't kept anymore.
+    """
+
+
+def version_of(entry_id) -> int:
+    return int(decode(entry_id).split('-')[0])
+
+
+class StateChanges(object):
+    """
+    Versioned log of cluster state changes (node added or removed, service replica added or removed, service
+    updated) in Redis, shared by all API processes.
+    """
+
+    def __init__(self, redis_: redis.Redis, maxlen: int = STREAM_MAXLEN):
+        self._redis = redis_
+        self._maxlen = maxlen
+        self._record = redis_.register_script(RECORD_SCRIPT)
+
+    def version(self) -> int:
+        return int(self._redis.get(VERSION_KEY) or 0)
+
+    def record(self, kind: str, action: str, name: str, data=None, client=None):
+        """
+        Records change of `kind` (node or service) `name`. With `client` (pipeline) the change is recorded as part of
+        its transaction.
+        """
+        change = json.dumps(dict(kind=kind, action=action, name=name, data=data))
+        return self._record(keys=[VERSION_KEY, STREAM_KEY], args=[self._maxlen, change], client=client)
+
+    def _after(self, version: int, count: int = None) -> list:
+        # Entry ids are `<version>-0`, so `<version>-1` excludes the change of `version` itself.
+        return self._redis.xrange(STREAM_KEY, min='{}-1'.format(version), count=count)
+
+    def since(self, version: int, timeout: float = 0, count: int = None) -> typing.Tuple[int, typing.List[dict]]:
+        """
+        Returns current version and changes after `version`. If there are none yet, waits up to `timeout` seconds
+        for them. Raises VersionGone if some of the changes aren't in the stream anymore.
+        """
+        entries = self._after(version, count)
+        if not entries and timeout > 0:
+            # BLOCK 0 would wait forever.
+            block = max(int(timeout * 1000), 1)
+            streams = self._redis.xread({STREAM_KEY: '{}-0'.format(version)}, count=count, block=block)
+            entries = streams[0][1] if streams else []
+
+        current = self.version()
+        if not entries and current != version:
+            # Change may have been recorded since the stream was read.
+            entries = self._after(version, count)
+
+        # Every version has its change, a gap means changes were trimmed (or Redis was reset).
+        if (entries and version_of(entries[0][0]) != version + 1) or (not entries and current != version):
+            raise VersionGone(version)
+
+        changes = [dict(json.loads(decode(fields[b'change'])), version=version_of(entry_id))
+                   for entry_id, fields in entries]
+        return (changes[-1]['version'] if changes else version), changes
@@ -0,0 +1,112 @@
+import concurrent.futures
+import docker
+import logging
+import os
+import threading
+import time
+import typing
+
+# Upper bound of concurrently running event handlers.
+EVENT_WORKERS = int(os.environ.get('HYDRA_EVENT_WORKERS', 4))
+
+# Pause before re-opening broken event stream (seconds).
+RECONNECT_DELAY = 1.0
+
+Handler = typing.Callable[[dict], None]
+
+
+class EventWatcher(object):
+    """
+    Single Docker event stream for all containers of the cluster.
+
+    Events are matched against subscriptions (container name predicate and actions) and matching handlers are run
+    on a bounded thread pool. Cheap `inline` handlers (e.g. inventory updates) run right away in the watcher thread,
+    before any pooled handler of the same event, so that they never wait behind slow handlers. If the stream breaks it's re-opened from the time of the last seen event, so handlers
+    may see some events twice.
+    """
+
+    def __init__(self, docker_client: docker.DockerClient, workers: int = EVENT_WORKERS):
+        self._docker_client = docker_client
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hydra-event')
+        self._subscriptions = []
+        self._stream = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._since = None
+        self._backlog = 0
+        self._lock = threading.Lock()
+
+    @property
+    def backlog(self) -> int:
+        """
+        Count of dispatched handlers which haven't completed yet.
+        """
+        return self._backlog
+
+    def subscribe(
+            self, actions: typing.List[str], handler: Handler, name_filter: typing.Callable[[str], bool],
+            inline: bool = False):
+        self._subscriptions.append((set(actions), name_filter, handler, inline))
+
+    def start(self):
+        if self._thread:
+            return
+        self._since = int(time.time())
+        self._thread = threading.Thread(target=self._run, name='event-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._stream:
+            self._stream.close()
+        self._executor.shutdown(wait=False)
+
+    def dispatch(self, event: dict):
+        name = event.get('Actor', {}).get('Attributes', {}).get('name', '')
+        action = event.get('Action') or event.get('status')
+
+        matching = [(handler, inline) for actions, name_filter, handler, inline in self._subscriptions
+                    if action in actions and name_filter(name)]
+        for handler, inline in matching:
+            if inline:
+                try:
+                    handler(event)
+                except Exception as error:
+                    logging.error('Event handler failed: {}'.format(error))
+        for handler, inline in matching:
+            if not inline:
+                self.submit(handler, event)
+
+    def submit(self, fn: typing.Callable, *args) -> concurrent.futures.Future:
+        with self._lock:
+            self._backlog += 1
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: concurrent.futures.Future):
+        with self._lock:
+            self._backlog -= 1
+        if future.exception():
+            logging.error('Event handler failed: {}'.format(future.exception()))
+
+    def _run(self):
+        actions = sorted(set().union(*[actions for actions, _, _, _ in self._subscriptions]))
+
+        while not self._stopped.is_set():
+            try:
+                self._stream = self._docker_client.events(
+                    decode=True,
+                    since=self._since,
+                    filters={'type': 'container', 'event': actions}
+                )
+                for event in self._stream:
+                    self._since = event.get('time', self._since)
+                    self.dispatch(event)
+            except Exception as error:
+                if not self._stopped.is_set():
+                    logging.warning('Docker event stream broken: {}'.format(error))
+
+            self._stopped.wait(RECONNECT_DELAY)
+
+        logging.warning('Exiting event watcher.')
@@ -1,8 +1,17 @@
-import csv
+import contextlib
 import docker
 import io
+import itertools
 import logging
+import os
+import re
 import socket
+import tarfile
+import threading
+import time
+import typing
+
+from .metrics import HAPROXY_SECONDS
 
 FIELDNAMES = [
     '# pxname', 'svname', 'qcur', 'qmax', 'scur', 'smax', 'slim', 'stot', 'bin', 'bout', 'dreq', 'dresp', 'ereq',
@@ -20,78 +29,555 @@ FIELDNAMES = [
 PORT = 8888
 STATS_PORT = 9999
 
+# HAProxy closes idle CLI sessions after `stats timeout` (30s in haproxy/haproxy.cfg).
+# Reconnect proactively a bit before that instead of hitting a closed socket.
+IDLE_TIMEOUT = 25
+
+# Timeout (seconds) of connecting to and of every read from runtime API. A stalled session is closed, it would block
+# all other commands.
+SOCKET_TIMEOUT = float(os.environ.get('HYDRA_HAPROXY_TIMEOUT', 10))
+
+# Post-command prompt of an interactive (`prompt` mode) CLI session.
+PROMPT = b'\n> '
+
+# Receive buffer of runtime API session. `show stat` of a big cluster is several hundred KB.
+BUFFER_SIZE = 256 * 1024
+
+# Stat columns needed to find free server slots.
+STATS_COLUMNS = ('pxname', 'svname', 'status')
+
+# `show stat <iid> <type> <sid>` - all proxies (-1), servers only (type 4), all servers (-1).
+SHOW_STAT_SERVERS = 'show stat -1 4 -1'
+
+# How long (seconds) `show stat` snapshot is reused for placement decisions. Own `set server` writes invalidate it.
+STATS_TTL = 2.0
+
+# Configuration of proxy container and the file its server state (addresses, maintenance) is kept in over reloads.
+# Both need to be in sync with haproxy/haproxy.cfg.
+CONFIG_FILE = '/usr/local/etc/haproxy/haproxy.cfg'
+STATE_FILE = '/var/lib/haproxy/server-state'
+
+# Everything after this line of configuration is rendered by Hydra.
+SERVICES_MARKER = '# Hydra services, everything below is generated by Hydra API.'
+
+# Server slots (nodeN) of a service backend are rendered in steps of this size.
+SLOTS = int(os.environ.get('HYDRA_PROXY_SLOTS', 10))
+
+# How long (seconds) to wait for reloaded proxy to serve the new configuration.
+RELOAD_TIMEOUT = float(os.environ.get('HYDRA_PROXY_RELOAD_TIMEOUT', 30))
+
+# Lock of proxy configuration shared by API processes, held for `CONFIG_LOCK_TIMEOUT` seconds at most.
+CONFIG_LOCK_KEY = 'hydra:haproxy:config'
+CONFIG_LOCK_TIMEOUT = RELOAD_TIMEOUT + 60
+
+# Proxies of the static part of configuration, these can't be service aliases.
+RESERVED_PROXIES = {'stats', 'fe_main'}
+
+FRONTEND = """frontend fe_main
+	bind *:{port}
+"""
+
+ROUTE = """	acl {alias} path /{alias}
+	acl {alias} path_beg /{alias}/
+	use_backend {alias} if {alias}
+"""
+
+BACKEND = """backend {alias}
+	balance roundrobin
+	option httpchk HEAD /
+	http-request set-uri %[url,regsub(^/{alias},/,)] if {{ path_beg /{alias} }}
+	server-template node 1-{slots} 0.0.0.0:{port} check disabled
+"""
+
+
+class HAProxyError(Exception):
+    pass
+
+
+class HAProxyRuntime(object):
+    """
+    Persistent interactive session to HAProxy runtime API (admin socket).
+
+    Session is put into `prompt` mode so that multiple commands can be sent over the same connection. Every command
+    reply is terminated by the prompt. Session is shared between threads, commands are serialized by a lock.
+    """
+
+    def __init__(self, socket_file: str, idle_timeout: float = IDLE_TIMEOUT, buffer_size: int = BUFFER_SIZE,
+                 timeout: float = SOCKET_TIMEOUT):
+        self._socket_file = socket_file
+        self._idle_timeout = idle_timeout
+        self._timeout = timeout
+        self._socket = None
+        self._chunk = bytearray(buffer_size)
+        self._view = memoryview(self._chunk)
+        self._pending = bytearray()
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(self._timeout)
+        s.connect(self._socket_file)
+        self._socket = s
+        self._pending = bytearray()
+
+        s.sendall(b'prompt\n')
+        self._read_reply()
+
+    def _disconnect(self):
+        if self._socket:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+        self._socket = None
+
+    def _ensure_connected(self):
+        if not self._socket or time.monotonic() - self._last_used > self._idle_timeout:
+            self._disconnect()
+            self._connect()
+
+    def _reply_lines(self) -> typing.Iterator[bytes]:
+        """
+        Yields lines of a single reply until the prompt. Socket is read into reusable buffer, only unconsumed tail
+        of received data is kept between reads.
+        """
+        buf = self._pending
+        pos = 0
+
+        try:
+            while True:
+                # Prompt at the beginning of a line ends the reply. Next reply of a pipelined batch may follow it.
+                if buf.startswith(b'> ', pos):
+                    pos += 2
+                    return
+
+                nl = buf.find(b'\n', pos)
+                if nl >= 0:
+                    yield bytes(buf[pos:nl])
+                    pos = nl + 1
+                    continue
+
+                del buf[:pos]
+                pos = 0
+
+                n = self._socket.recv_into(self._chunk)
+                if not n:
+                    raise ConnectionError('HAProxy closed runtime API session.')
+                buf += self._view[:n]
+        finally:
+            del buf[:pos]
+
+    def _read_reply(self) -> str:
+        return '\n'.join(line.decode('ascii') for line in self._reply_lines())
+
+    def _execute(self, cmds: typing.List[str]) -> typing.List[str]:
+        self._ensure_connected()
+
+        # Pipeline whole batch, HAProxy processes lines in order and replies to each of them.
+        with HAPROXY_SECONDS.time(command=' '.join(cmds[0].split()[:2]) if cmds else ''):
+            self._socket.sendall(''.join('{}\n'.format(cmd) for cmd in cmds).encode('ascii'))
+            replies = [self._read_reply() for _ in cmds]
+
+        self._last_used = time.monotonic()
+        return replies
+
+    @staticmethod
+    def _check(cmds):
+        for cmd in cmds:
+            if '\n' in cmd:
+                raise HAProxyError('Runtime API command can\'t contain line breaks: {!r}'.format(cmd))
+
+    def execute(self, *cmds: str) -> typing.List[str]:
+        self._check(cmds)
+
+        with self._lock:
+            try:
+                return self._execute(list(cmds))
+            except socket.timeout:
+                # Reply may still come, session can't be reused. Stalled proxy isn't retried.
+                self._disconnect()
+                raise HAProxyError('HAProxy runtime API did not reply within {}s.'.format(self._timeout))
+            except (ConnectionError, OSError) as error:
+                # Session might have been closed by HAProxy (timeout, reload). Commands sent by Hydra are
+                # idempotent or their replies tolerate a replay (`add server` of an existing server), so retry once
+                # over a fresh session.
+                logging.warning('HAProxy runtime API session lost ({}). Reconnecting.'.format(error))
+                self._disconnect()
+                try:
+                    return self._execute(list(cmds))
+                except (ConnectionError, OSError) as error:
+                    self._disconnect()
+                    raise HAProxyError(error)
+
+    def stream(self, cmd: str) -> typing.Iterator[str]:
+        """
+        Yields reply lines of `cmd` as they are read from the socket.
+
+        Session is locked until the generator is exhausted or closed. Unread part of the reply is drained on close.
+        """
+        self._check([cmd])
+
+        with self._lock:
+            try:
+                self._ensure_connected()
+                # Includes time the consumer spends between lines.
+                with HAPROXY_SECONDS.time(command=' '.join(cmd.split()[:2])):
+                    self._socket.sendall('{}\n'.format(cmd).encode('ascii'))
+
+                    lines = self._reply_lines()
+                    try:
+                        for line in lines:
+                            yield line.decode('ascii')
+                    finally:
+                        for _ in lines:
+                            pass
+
+                self._last_used = time.monotonic()
+            except (ConnectionError, OSError) as error:
+                self._disconnect()
+                raise HAProxyError(error)
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+
+def server_name(node_name: str) -> str:
+    """
+    Name of backend server (slot) of cluster node, `node-N.network` -> `nodeN`.
+    """
+    return node_name.split('.')[0].replace('-', '')
+
+
+def slot_number(svname: str) -> int:
+    match = re.match(r'^node(\d+)$', svname)
+    return int(match.group(1)) if match else 0
+
+
+def render_services(backends: typing.Dict[str, int], port: int = PORT) -> str:
+    """
+    Renders routing of frontend and backends of services {alias: server slots}. Slots are rounded up to SLOTS.
+    """
+    aliases = sorted(backends)
+    parts = [SERVICES_MARKER + '\n', FRONTEND.format(port=port)]
+    parts.extend(ROUTE.format(alias=alias) for alias in aliases)
+    parts.extend(
+        BACKEND.format(alias=alias, port=port, slots=max(-(-backends[alias] // SLOTS), 1) * SLOTS)
+        for alias in aliases)
+    return ''.join(parts)
+
+
+def render_config(current: str, backends: typing.Dict[str, int]) -> str:
+    """
+    Replaces services part of configuration `current`, its static part (global, defaults, stats) is kept.
+    """
+    static, marker, _ = current.partition(SERVICES_MARKER)
+    if not marker:
+        raise HAProxyError('Proxy configuration has no services marker {!r}.'.format(SERVICES_MARKER))
+    return static + render_services(backends)
+
+
+def tar_file(path: str, content: str) -> bytes:
+    data = content.encode('utf-8')
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        info = tarfile.TarInfo(os.path.basename(path))
+        info.size = len(data)
+        info.mode = 0o644
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def untar_file(chunks: typing.Iterable[bytes], path: str) -> str:
+    with tarfile.open(fileobj=io.BytesIO(b''.join(chunks))) as tar:
+        return tar.extractfile(os.path.basename(path)).read().decode('utf-8')
+
+
+def parse_stat(lines: typing.Iterable[str], columns: typing.Sequence[str]) -> typing.Iterator[dict]:
+    """
+    Parses `show stat` CSV lazily. Only requested `columns` are materialized for every row.
+
+    Column positions are taken from the header line emitted by HAProxy (`# pxname,svname,...`). If the header is
+    missing then FIELDNAMES is assumed.
+    """
+    lines = iter(lines)
+
+    header = next(lines, '')
+    if header.startswith('# '):
+        names = header[2:].split(',')
+    else:
+        names = [name.lstrip('# ') for name in FIELDNAMES]
+        lines = itertools.chain([header], lines)
+
+    try:
+        indices = [names.index(column) for column in columns]
+    except ValueError as error:
+        raise HAProxyError('Unknown stat column: {}'.format(error))
+
+    # Don't split the rest of the row beyond the last requested column.
+    maxsplit = max(indices) + 1
+
+    for line in lines:
+        if not line:
+            continue
+        values = line.split(',', maxsplit)
+        yield {column: values[i] for column, i in zip(columns, indices)}
+
+
+class HAProxyStats(object):
+    """
+    Snapshot of `show stat` indexed by (pxname, svname) and by (pxname, status).
+    """
+
+    def __init__(self, rows: typing.Iterable[dict]):
+        self.created = time.monotonic()
+        self._rows = {}
+        self._by_proxy = {}
+        self._by_status = {}
+
+        for row in rows:
+            pxname, svname = row['pxname'], row['svname']
+            self._rows[(pxname, svname)] = row
+            self._by_proxy.setdefault(pxname, []).append(row)
+            self._by_status.setdefault((pxname, row['status']), set()).add(svname)
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.created
+
+    def get(self, pxname: str, svname: str) -> typing.Optional[dict]:
+        return self._rows.get((pxname, svname))
+
+    def servers(self, pxname: str, status: str) -> typing.Set[str]:
+        return self._by_status.get((pxname, status), set())
+
+    def rows(self, pxname: str) -> typing.List[dict]:
+        return self._by_proxy.get(pxname, [])
+
+    def proxies(self) -> typing.Dict[str, typing.List[dict]]:
+        return self._by_proxy
+
 
 class HAProxy(object):
 
     def __init__(
             self, host: str, docker_client: docker.DockerClient,
-            socket_file: str = '/var/run/haproxy/admin.sock'):
+            socket_file: str = '/var/run/haproxy/admin.sock', stats_ttl: float = STATS_TTL,
+            config_lock: typing.ContextManager = None):
         self._socket_file = socket_file
         self._host = host
         self._docker_client = docker_client
+        self._runtime = HAProxyRuntime(socket_file)
+        self._stats_ttl = stats_ttl
+        self._stats = None
+        self._stats_lock = threading.Lock()
+        self._url = None
+        # Serializes changes of backends, pass a lock shared by all API processes.
+        self._config_lock = config_lock or threading.Lock()
+        # Unknown until the first `add server`, HAProxy older than 2.5 has no dynamic servers.
+        self._dynamic_servers = None
 
     @property
     def url(self) -> str:
-        node_ = self._docker_client.containers.get(self._host)
-        ip = node_.attrs['NetworkSettings']['Ports']['{}/tcp'.format(PORT)][0]['HostIp']
-        port = node_.attrs['NetworkSettings']['Ports']['{}/tcp'.format(PORT)][0]['HostPort']
-        return 'http://{}:{}'.format(ip, port)
+        # Published port of proxy container doesn't change during its lifetime.
+        if not self._url:
+            node_ = self._docker_client.containers.get(self._host)
+            ip = node_.attrs['NetworkSettings']['Ports']['{}/tcp'.format(PORT)][0]['HostIp']
+            port = node_.attrs['NetworkSettings']['Ports']['{}/tcp'.format(PORT)][0]['HostPort']
+            self._url = 'http://{}:{}'.format(ip, port)
+        return self._url
 
     def send(self, cmd) -> str:
-        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        s.connect(self._socket_file)
+        return self.send_batch([cmd])[0]
+
+    def send_batch(self, cmds: typing.List[str]) -> typing.List[str]:
+        """
+        Send commands to HAProxy in one round trip. Returns replies in the same order as commands.
+        """
+        if not cmds:
+            return []
+
+        try:
+            return self._runtime.execute(*cmds)
+        finally:
+            if any(cmd.startswith(('set server', 'add server')) for cmd in cmds):
+                self.invalidate_stats()
+
+    def stats(self, max_age: float = None) -> HAProxyStats:
+        """
+        Returns `show stat` snapshot. Snapshot is reused while it's younger than `max_age` (defaults to stats TTL).
+        """
+        max_age = self._stats_ttl if max_age is None else max_age
+
+        with self._stats_lock:
+            if self._stats is None or self._stats.age > max_age:
+                self._stats = HAProxyStats(self.stat_rows(STATS_COLUMNS))
+            return self._stats
+
+    def stat_rows(self, columns: typing.Sequence[str], cmd: str = SHOW_STAT_SERVERS) -> typing.Iterator[dict]:
+        """
+        Streams server rows of `show stat` with only the requested columns.
+        """
+        return parse_stat(self._runtime.stream(cmd), columns)
+
+    def invalidate_stats(self):
+        with self._stats_lock:
+            self._stats = None
+
+    def register(self, replicas: typing.List[tuple]):
+        """
+        Register replicas (alias, node name, service port[, node address]) of any services on HAProxy in one round
+        trip. Node address is resolved from node name if not given.
+        """
+        cmds = []
+
+        for alias, node_name, service_port, *addr in replicas:
+            node_addr = addr[0] if addr and addr[0] else socket.gethostbyname(node_name)
+
+            # Point respective backend node to point to service endpoint.
+            # The name format of backend node in HAProxy is nodeN.
+            # The name format of cluster node is node-N.network.
+            be_node = server_name(node_name)
+            params = dict(
+                alias=alias,
+                node=be_node,
+                addr=node_addr,
+                port=service_port
+            )
+            cmds.append('set server {alias}/{node} addr {addr} port {port}'.format(**params))
+
+            # Put backend node into rotation.
+            cmds.append('set server {alias}/{node} state ready'.format(**params))
+
+        for cmd, res in zip(cmds, self.send_batch(cmds)):
+            logging.info('%s: %s', cmd, res)
+
+    def unregister(self, replicas: typing.List[typing.Tuple[str, str]]):
+        """
+        Puts backend nodes of replicas (alias, node name) back into maintenance (free slot) in one round trip.
+        """
+        cmds = ['set server {}/{} state maint'.format(alias, server_name(node_name)) for alias, node_name in replicas]
+        for cmd, res in zip(cmds, self.send_batch(cmds)):
+            logging.info('%s: %s', cmd, res)
+
+    @staticmethod
+    def _missing(stats: HAProxyStats, replicas: typing.List[typing.Tuple[str, str]]) \
+            -> typing.Tuple[typing.Set[str], typing.Set[typing.Tuple[str, str]]]:
+        backends = {alias for alias, _ in replicas if not stats.rows(alias)}
+        slots = {
+            (alias, server_name(node_name)) for alias, node_name in replicas
+            if alias not in backends and stats.get(alias, server_name(node_name)) is None
+        }
+        return backends, slots
+
+    def ensure_slots(self, replicas: typing.List[typing.Tuple[str, str]]):
+        """
+        Makes sure backends of services and their server slots of replicas (alias, node name) exist. Missing slots
+        are added with runtime API (HAProxy 2.5+). New backends, or slots if proxy has no dynamic servers, are rendered
+        into configuration and proxy is reloaded seamlessly.
+        """
+        if not any(self._missing(self.stats(), replicas)):
+            return
+
+        with self._config_lock:
+            # Another process may have added them meanwhile.
+            backends, slots = self._missing(self.stats(max_age=0), replicas)
+            if not backends and not slots:
+                return
+
+            if slots and not backends and self._dynamic_servers is not False:
+                slots = self._add_servers(sorted(slots))
+            if backends or slots:
+                aliases = backends | {alias for alias, _ in slots}
+                highest = {}
+                for alias, node_name in replicas:
+                    if alias in aliases:
+                        highest[alias] = max(highest.get(alias, 0), slot_number(server_name(node_name)))
+                self.reload(aliases, highest)
+
+    def _add_servers(self, slots: typing.List[typing.Tuple[str, str]]) -> typing.Set[typing.Tuple[str, str]]:
+        """
+        Adds server slots in maintenance with runtime API. Returns slots which couldn't be added.
+        """
+        cmds = []
+        for alias, svname in slots:
+            cmds.append('add server {}/{} 0.0.0.0:{} check'.format(alias, svname, PORT))
+            # Checks of dynamic servers are off until enabled.
+            cmds.append('enable health {}/{}'.format(alias, svname))
+
+        failed = set()
+        replies = self.send_batch(cmds)
+        for (alias, svname), reply in zip(slots, replies[::2]):
+            # Replayed command after lost reply or concurrent add finds the server already there.
+            if reply.startswith('New server registered') or 'already exists' in reply.lower():
+                self._dynamic_servers = True
+                logging.info('Added server slot {}/{}.'.format(alias, svname))
+            else:
+                logging.warning('Could not add server slot {}/{}: {}'.format(alias, svname, reply))
+                failed.add((alias, svname))
+
+        if failed and 'Unknown command' in ' '.join(replies):
+            self._dynamic_servers = False
+        return failed
+
+    @property
+    def container(self):
+        return self._docker_client.containers.get(self._host)
+
+    def read_file(self, path: str) -> str:
+        chunks, _ = self.container.get_archive(path)
+        return untar_file(chunks, path)
+
+    def write_file(self, path: str, content: str):
+        if not self.container.put_archive(os.path.dirname(path), tar_file(path, content)):
+            raise HAProxyError('Could not write {} to proxy.'.format(path))
+
+    def _exec(self, cmd: typing.List[str]) -> str:
+        exit_code, output = self.container.exec_run(cmd)
+        output = output.decode('utf-8', 'replace') if isinstance(output, bytes) else str(output)
+        if exit_code:
+            raise HAProxyError('{} failed: {}'.format(' '.join(cmd), output.strip()))
+        return output
+
+    def reload(self, aliases: typing.Set[str] = frozenset(), slots: typing.Dict[str, int] = None):
+        """
+        Renders backends of all services on proxy plus new `aliases` into its configuration, with at least `slots`
+        {alias: highest slot number} servers, and reloads it seamlessly. Master process of proxy (master-worker
+        mode of the image) starts new workers which take over listening sockets (`expose-fd listeners`), old
+        workers finish their connections. Addresses and states of servers are carried over in the server state file.
+        """
+        stats = self.stats(max_age=0)
+        backends = {}
+        for pxname, rows in stats.proxies().items():
+            if pxname not in RESERVED_PROXIES:
+                backends[pxname] = max([slot_number(r['svname']) for r in rows] or [0])
+        for alias in aliases:
+            backends[alias] = max(backends.get(alias, 0), (slots or {}).get(alias, 0), SLOTS)
 
-        cmd = bytes('{}\n'.format(cmd), 'ascii')
+        config = render_config(self.read_file(CONFIG_FILE), backends)
+        staged = CONFIG_FILE + '.new'
+        self.write_file(staged, config)
+        self._exec(['haproxy', '-c', '-f', staged])
+        self._exec(['mv', staged, CONFIG_FILE])
 
-        s.send(cmd)
+        # Dumped right before reload, new workers load it while starting.
+        self.write_file(STATE_FILE, self.send('show servers state'))
+        logging.info('Reloading proxy with backends {}.'.format(', '.join(sorted(backends))))
+        self.container.kill(signal='SIGUSR2')
+        # Session is connected to the old worker, which only finishes its connections now.
+        self._runtime.close()
 
-        data = s.recv(1024)
-        res = ''
+        self._wait_reloaded(backends)
 
+    def _wait_reloaded(self, backends: typing.Dict[str, int], timeout: float = RELOAD_TIMEOUT):
+        deadline = time.monotonic() + timeout
         while True:
-            res += data.decode('ascii')
-            data = s.recv(1024)
-            if not data:
-                break
-
-        s.close()
-
-        return res
-
-    def backend_nodes(self, service_name) -> list:
-        cmd = 'show stat'
-
-        def _filter(item):
-            return item['svname'].startswith('node') and item['# pxname'] == service_name
-
-        with io.StringIO(self.send(cmd)) as stat:
-            reader = csv.DictReader(stat, delimiter=',', fieldnames=FIELDNAMES)
-            return list(filter(_filter, reader))
-
-    def get_free_nodes(self, service_name) -> iter:
-        return filter(lambda item: item['status'] == 'MAINT', self.backend_nodes(service_name))
-
-    def get_free_node(self, service_name, node_name) -> iter:
-        return filter(lambda item: item['svname'] == node_name, self.get_free_nodes(service_name))
-
-    def register_service(self, alias, node_name, service_port):
-        node_addr = socket.gethostbyname(node_name)
-
-        # Point respective backend node to point to service endpoint.
-        # The name format of backend node in HAProxy is nodeN.
-        # The name format of cluster node is node-N.network.
-        be_node = node_name.split('.')[0].replace('-', '')
-        params = dict(
-            alias=alias,
-            node=be_node,
-            addr=node_addr,
-            port=service_port
-        )
-        set_server_addr = 'set server {alias}/{node} addr {addr} port {port}'.format(**params)
-        res = self.send(set_server_addr)
-        logging.info(res)
-
-        # Put backend node into rotation.
-        set_ready = 'set server {alias}/{node} state ready'.format(**params)
-        res = self.send(set_ready)
-        logging.info(res)
+            with contextlib.suppress(HAProxyError):
+                stats = self.stats(max_age=0)
+                if all(stats.get(alias, 'node{}'.format(max(n, 1))) for alias, n in backends.items()):
+                    return
+            if time.monotonic() > deadline:
+                raise HAProxyError('Proxy did not reload within {}s.'.format(timeout))
+            time.sleep(0.2)
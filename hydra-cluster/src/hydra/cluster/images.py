@@ -0,0 +1,171 @@
+import collections
+import concurrent.futures
+import docker
+import docker.errors
+import logging
+import os
+import tarfile
+import tempfile
+import threading
+import typing
+import uuid
+
+from .metrics import EXEC_SECONDS
+
+# Registry mirror nodes pull through, e.g. http://registry.<cluster>:5000. Started by `hydra-ctl cluster start
+# --registry-mirror`.
+REGISTRY_MIRROR = os.environ.get('HYDRA_REGISTRY_MIRROR')
+
+# How long (seconds) replicas wait for their image to be seeded on nodes.
+SEED_TIMEOUT = float(os.environ.get('HYDRA_SEED_TIMEOUT', 300))
+
+# Where image archive is copied inside of node.
+ARCHIVE_DIR = '/tmp'
+ARCHIVE_NAME = 'hydra-image-{}.tar'
+
+# Count of host images whose `docker save` is kept on disk of API for further deploys.
+SAVED_IMAGES = int(os.environ.get('HYDRA_SAVED_IMAGES', 4))
+
+# Size of chunks (bytes) of saved image streamed to nodes.
+CHUNK_SIZE = 1024 * 1024
+
+# Saved host image, `docker save` output in file `path` of `size` bytes.
+Saved = collections.namedtuple('Saved', 'path size')
+
+
+def mirror_args(mirror: typing.Optional[str] = REGISTRY_MIRROR) -> typing.List[str]:
+    """
+    Arguments of inner Docker daemon of node for pulling through `mirror`.
+    """
+    if not mirror:
+        return []
+    return ['--registry-mirror', mirror, '--insecure-registry', mirror.split('://')[-1]]
+
+
+class ImageSeeder(object):
+    """
+    Seeds image on nodes in parallel before replicas are started.
+
+    Image present in Docker of the cluster host (e.g. locally built one) is saved once to disk and streamed to every
+    node which doesn't have it yet. Other images are pulled by nodes themselves, through registry mirror if configured,
+    so a registry is hit once per image and not once per replica.
+    """
+
+    def __init__(self, docker_client: docker.DockerClient, executor: concurrent.futures.Executor,
+                 timeout: float = SEED_TIMEOUT, cache_size: int = SAVED_IMAGES):
+        self._docker_client = docker_client
+        self._executor = executor
+        self._timeout = timeout
+        self._cache_size = cache_size
+        # Saved images by image id, oldest first.
+        self._saved = collections.OrderedDict()
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def save(self, image: str) -> typing.Optional[Saved]:
+        """
+        Returns `docker save` of host image spooled to a file, None if host doesn't have the image. Saves are cached
+        by image id, so a tag pointing to a new build is saved again.
+        """
+        try:
+            img = self._docker_client.images.get(image)
+        except docker.errors.ImageNotFound:
+            return None
+
+        with self._lock:
+            lock = self._locks.setdefault(img.id, threading.Lock())
+        # Deploys of the same image wait for one save, other images are saved meanwhile.
+        with lock:
+            with self._lock:
+                if img.id in self._saved:
+                    self._saved.move_to_end(img.id)
+                    return self._saved[img.id]
+
+            with tempfile.NamedTemporaryFile(prefix='hydra-image-', suffix='.tar', delete=False) as f:
+                try:
+                    for chunk in img.save(named=True):
+                        f.write(chunk)
+                except Exception:
+                    os.remove(f.name)
+                    raise
+            saved = Saved(f.name, os.path.getsize(f.name))
+
+            with self._lock:
+                self._saved[img.id] = saved
+                while len(self._saved) > max(self._cache_size, 1):
+                    _, evicted = self._saved.popitem(last=False)
+                    # Nodes still reading it keep their open file.
+                    os.remove(evicted.path)
+            return saved
+
+    @staticmethod
+    def archive(saved: Saved, name: str) -> typing.Iterator[bytes]:
+        """
+        Streams tar archive (for `put_archive`) with saved image stored as `name`, without reading it into memory.
+        """
+        info = tarfile.TarInfo(name)
+        info.size = saved.size
+        yield info.tobuf(format=tarfile.USTAR_FORMAT)
+        with open(saved.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                yield chunk
+        # Member data is padded to whole blocks, archive ends with two empty blocks.
+        yield tarfile.NUL * (-saved.size % tarfile.BLOCKSIZE) + tarfile.NUL * 2 * tarfile.BLOCKSIZE
+
+    def seed(self, image: str, nodes: list) -> typing.List[dict]:
+        """
+        Makes `image` present on all `nodes`. Returns failures, replicas on failed nodes may still pull the image
+        themselves.
+        """
+        present = self._executor.map(lambda n: self.has_image(n, image), nodes)
+        missing = [n for n, has in zip(nodes, present) if not has]
+        if not missing:
+            return []
+
+        try:
+            saved = self.save(image)
+        except (docker.errors.APIError, OSError) as error:
+            logging.warning('Could not save image {!r} of host, nodes pull it: {}'.format(image, error))
+            saved = None
+        futures = {self._executor.submit(self.seed_node, n, image, saved): n for n in missing}
+        _, not_done = concurrent.futures.wait(futures, timeout=self._timeout)
+
+        failed = []
+        for future, node in futures.items():
+            if future in not_done:
+                future.cancel()
+                error = 'Timed out after {}s.'.format(self._timeout)
+            elif future.exception():
+                error = str(future.exception())
+            else:
+                continue
+
+            logging.warning('Could not seed image {!r} on {}: {}'.format(image, node.name, error))
+            failed.append(dict(name=node.name, error=error))
+
+        logging.info('Image {!r} seeded on {} of {} nodes.'.format(image, len(missing) - len(failed), len(missing)))
+        return failed
+
+    @staticmethod
+    def has_image(node, image: str) -> bool:
+        try:
+            with EXEC_SECONDS.time(command='docker image inspect'):
+                exit_code, _ = node.exec_run(['docker', 'image', 'inspect', image])
+            return exit_code == 0
+        except Exception:
+            return False
+
+    def seed_node(self, node, image: str, saved: typing.Optional[Saved]):
+        if saved:
+            # Every upload has its own name, loads of the same image on a node don't remove each other's archive.
+            name = ARCHIVE_NAME.format(uuid.uuid4().hex)
+            node.put_archive(ARCHIVE_DIR, self.archive(saved, name))
+            path = '{}/{}'.format(ARCHIVE_DIR, name)
+            cmd = ['sh', '-c', 'docker load -i {0} && rm -f {0}'.format(path)]
+        else:
+            cmd = ['docker', 'pull', image]
+
+        with EXEC_SECONDS.time(command='docker load' if saved else 'docker pull'):
+            exit_code, output = node.exec_run(cmd)
+        if exit_code > 0:
+            raise RuntimeError(output)
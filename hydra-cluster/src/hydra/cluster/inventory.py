@@ -0,0 +1,109 @@
+import docker
+import docker.errors
+import logging
+import threading
+import typing
+
+
+def ordinal(name: str) -> int:
+    # node-N.<cluster> -> N
+    return int(name.split('.')[0].split('-')[1])
+
+
+class Node(object):
+    """
+    Cluster node as seen by inventory.
+    """
+
+    def __init__(self, container, network_name: str):
+        self.container = container
+        self.name = container.name
+        self.ordinal = ordinal(self.name)
+        self.ip = container.attrs['NetworkSettings']['Networks'][network_name]['IPAddress']
+        self.status = container.status
+
+    def state(self) -> dict:
+        return dict(name=self.name, ip=self.ip)
+
+
+class NodeInventory(object):
+    """
+    In-process inventory of cluster nodes.
+
+    Inventory is built once from Docker and then kept current from container events, so reading it doesn't hit
+    Docker API. `on_change` is called with action ('added', 'removed' or 'changed') and node state whenever a node
+    actually changes in the inventory, repeated events of the same change are not reported.
+    """
+
+    # Standby nodes of warm pool become nodes by rename.
+    START_EVENTS = ['rename', 'start']
+    STOP_EVENTS = ['destroy', 'die', 'kill', 'stop']
+
+    def __init__(
+            self, docker_client: docker.DockerClient, network_name: str, is_node: typing.Callable[[str], bool],
+            on_change: typing.Callable[[str, dict], None] = None):
+        self._docker_client = docker_client
+        self._network_name = network_name
+        self._is_node = is_node
+        self._on_change = on_change
+        self._nodes = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        containers = self._docker_client.containers.list(filters={'network': self._network_name})
+        return {c.name: Node(c, self._network_name) for c in containers if self._is_node(c.name)}
+
+    @property
+    def _inventory(self) -> dict:
+        with self._lock:
+            if self._nodes is None:
+                self._nodes = self._load()
+            return self._nodes
+
+    def nodes(self) -> typing.List[Node]:
+        return sorted(self._inventory.values(), key=lambda n: n.ordinal)
+
+    def get(self, name: str) -> typing.Optional[Node]:
+        return self._inventory.get(name)
+
+    def add(self, container):
+        node = Node(container, self._network_name)
+        with self._lock:
+            if self._nodes is None:
+                return
+            previous = self._nodes.get(node.name)
+            self._nodes[node.name] = node
+
+        if previous is None:
+            self._changed('added', node.state())
+        elif previous.state() != node.state():
+            self._changed('changed', node.state())
+
+    def remove(self, name: str):
+        with self._lock:
+            if self._nodes is None:
+                return
+            node = self._nodes.pop(name, None)
+
+        if node:
+            self._changed('removed', node.state())
+
+    def _changed(self, action: str, state: dict):
+        if self._on_change:
+            self._on_change(action, state)
+
+    def on_event(self, event: dict):
+        name = event['Actor']['Attributes']['name']
+        action = event.get('Action')
+
+        if action in NodeInventory.STOP_EVENTS:
+            self.remove(name)
+        elif action in NodeInventory.START_EVENTS:
+            try:
+                self.add(self._docker_client.containers.get(event['id']))
+            except (docker.errors.NotFound, KeyError) as error:
+                logging.warning('Could not add node {} to inventory: {}'.format(name, error))
+
+    def reset(self):
+        with self._lock:
+            self._nodes = None
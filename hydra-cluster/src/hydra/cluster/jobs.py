@@ -0,0 +1,180 @@
+import concurrent.futures
+import contextlib
+import json
+import logging
+import os
+import redis
+import socket
+import threading
+import time
+import typing
+import uuid
+
+from .registry import decode
+
+# Upper bound of jobs (deploys, node provisioning) running concurrently in one API process.
+JOB_WORKERS = int(os.environ.get('HYDRA_JOB_WORKERS', 4))
+
+# How long (seconds) finished jobs can be queried.
+JOB_TTL = int(os.environ.get('HYDRA_JOB_TTL', 24 * 3600))
+
+# How often (seconds) a process refreshes `heartbeat` of its queued and running jobs. Job whose heartbeat is older
+# than HYDRA_JOB_LEASE is failed on read, its process died (or restarted) and won't finish it.
+JOB_HEARTBEAT = float(os.environ.get('HYDRA_JOB_HEARTBEAT', 10))
+JOB_LEASE = float(os.environ.get('HYDRA_JOB_LEASE', 60))
+
+# Job record, hash where every attribute is a JSON encoded field.
+JOB_KEY = 'hydra:job:{}'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+_current = threading.local()
+
+
+@contextlib.contextmanager
+def step(name: str):
+    """
+    Records timing of step `name` on the job running in the current thread. Outside of a job it does nothing.
+    """
+    job = getattr(_current, 'job', None)
+    if job is None:
+        yield
+        return
+
+    job.begin_step(name)
+    try:
+        yield
+    except Exception:
+        job.end_step(name, FAILED)
+        raise
+    job.end_step(name, 'done')
+
+
+class Job(object):
+    """
+    Running job. Every change is written through to Redis, so any API process can report its state.
+    """
+
+    def __init__(self, queue: 'JobQueue', job_id: str, kind: str):
+        self._queue = queue
+        self.id = job_id
+        self.kind = kind
+        self.steps = []
+        self._started = {}
+
+    def update(self, **fields):
+        self._queue.save(self.id, **fields)
+
+    def begin_step(self, name: str):
+        self._started[name] = time.monotonic()
+        self.steps.append(dict(name=name, status=RUNNING, seconds=None))
+        self.update(steps=self.steps)
+
+    def end_step(self, name: str, status: str):
+        for s in self.steps:
+            if s['name'] == name and s['status'] == RUNNING:
+                s['status'] = status
+                s['seconds'] = round(time.monotonic() - self._started.pop(name), 3)
+        self.update(steps=self.steps)
+
+
+class JobQueue(object):
+    """
+    Runs long operations in the background and keeps their state in Redis under `hydra:job:<id>`.
+
+    Jobs fail with `code` 400 if they raise one of `client_errors` and 500 on any other error. Unfinished jobs carry
+    `owner` (process running them) and its `heartbeat`, they fail with `code` 500 once the heartbeat is older than
+    `lease`.
+    """
+
+    def __init__(
+            self, redis_: redis.Redis, workers: int = JOB_WORKERS, ttl: int = JOB_TTL,
+            client_errors: typing.Tuple[type, ...] = (ValueError,),
+            heartbeat: float = JOB_HEARTBEAT, lease: float = JOB_LEASE):
+        self._redis = redis_
+        self._ttl = ttl
+        self._client_errors = client_errors
+        self._heartbeat = heartbeat
+        self._lease = lease
+        self._owner = '{}.{}'.format(socket.gethostname(), os.getpid())
+        self._active = set()
+        self._active_lock = threading.Lock()
+        self._beater = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hydra-job')
+
+    def save(self, job_id: str, **fields):
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.hset(JOB_KEY.format(job_id), mapping={k: json.dumps(v) for k, v in fields.items()})
+        pipe.expire(JOB_KEY.format(job_id), self._ttl)
+        pipe.execute()
+
+    def get(self, job_id: str) -> typing.Optional[dict]:
+        fields = self._redis.hgetall(JOB_KEY.format(job_id))
+        if not fields:
+            return None
+        job = {decode(k): json.loads(v) for k, v in fields.items()}
+        if job['status'] in (QUEUED, RUNNING) and time.time() - job.get('heartbeat', job['submitted']) > self._lease:
+            error = 'Process {} running the job stopped.'.format(job.get('owner'))
+            job.update(status=FAILED, code=500, error=error, finished=time.time())
+            self.save(job_id, status=FAILED, code=500, error=error, finished=job['finished'])
+        return job
+
+    def submit(self, kind: str, fn: typing.Callable, *args, **kwargs) -> dict:
+        """
+        Queues `fn(*args, **kwargs)` and returns the job record. Result of `fn` has to be JSON serializable.
+        """
+        job = Job(self, uuid.uuid4().hex, kind)
+        now = time.time()
+        record = dict(id=job.id, kind=kind, status=QUEUED, submitted=now, owner=self._owner, heartbeat=now, steps=[])
+        self.save(job.id, **record)
+        with self._active_lock:
+            self._active.add(job.id)
+        self._start_heartbeat()
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return record
+
+    def _start_heartbeat(self):
+        if self._beater or self._heartbeat <= 0:
+            return
+        self._beater = threading.Thread(target=self._beat_forever, name='job-heartbeat', daemon=True)
+        self._beater.start()
+
+    def _beat_forever(self):
+        while True:
+            time.sleep(self._heartbeat)
+            try:
+                self.beat()
+            except redis.RedisError as error:
+                logging.warning('Could not refresh heartbeat of jobs: {}'.format(error))
+
+    def beat(self):
+        """
+        Refreshes heartbeat of jobs queued or running in this process.
+        """
+        with self._active_lock:
+            active = list(self._active)
+        now = time.time()
+        for job_id in active:
+            self.save(job_id, heartbeat=now)
+
+    def _run(self, job: Job, fn: typing.Callable, args: tuple, kwargs: dict):
+        started = time.time()
+        job.update(status=RUNNING, started=started)
+        _current.job = job
+        try:
+            result = fn(*args, **kwargs)
+            job.update(status=SUCCEEDED, code=200, result=result, finished=time.time(),
+                       seconds=round(time.time() - started, 3))
+        except Exception as error:
+            code = 400 if isinstance(error, self._client_errors) else 500
+            if code == 500:
+                logging.exception('Job {} ({}) failed.'.format(job.id, job.kind))
+            job.update(status=FAILED, code=code, error=str(error), finished=time.time(),
+                       seconds=round(time.time() - started, 3))
+        finally:
+            _current.job = None
+            with self._active_lock:
+                self._active.discard(job.id)
@@ -0,0 +1,89 @@
+import logging
+import redis
+import threading
+import typing
+import uuid
+
+# Lease of the API process which runs cluster controllers (node monitoring, migrations, warm pool).
+LEADER_KEY = 'hydra:leader'
+
+# Lease lifetime (milliseconds). Leader renews it every third of it, others try to take it over as often.
+LEADER_TTL = 15000
+
+# Extend lease only if it's still held by the given owner.
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class LeaderElection(object):
+    """
+    Elects one of API processes (e.g. server workers) as leader with a lease in Redis (SET NX PX).
+
+    `on_elected` is called once the lease is taken, `on_lost` when it couldn't be renewed in time.
+    """
+
+    def __init__(
+            self, redis_: redis.Redis, on_elected: typing.Callable[[], None],
+            on_lost: typing.Callable[[], None] = None, key: str = LEADER_KEY, ttl: int = LEADER_TTL):
+        self._redis = redis_
+        self._on_elected = on_elected
+        self._on_lost = on_lost
+        self._key = key
+        self._ttl = ttl
+        self._owner = uuid.uuid4().hex
+        self._renew = redis_.register_script(RENEW_SCRIPT)
+        self._leader = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._leader
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name='leader-election', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._leader:
+            self._leader = False
+            try:
+                # Let own lease expire right away, so that another process takes over soon.
+                self._renew(keys=[self._key], args=[self._owner, 1])
+            except redis.RedisError as error:
+                logging.warning('Could not release leader lease: {}'.format(error))
+
+    def campaign(self):
+        """
+        One round of election: renews own lease or tries to take free one.
+        """
+        try:
+            if self._leader:
+                held = bool(self._renew(keys=[self._key], args=[self._owner, self._ttl]))
+            else:
+                held = bool(self._redis.set(self._key, self._owner, nx=True, px=self._ttl))
+        except redis.RedisError as error:
+            logging.warning('Leader election failed: {}'.format(error))
+            held = False
+
+        if held and not self._leader:
+            self._leader = True
+            logging.info('Elected as leader {}.'.format(self._owner))
+            self._on_elected()
+        elif not held and self._leader:
+            self._leader = False
+            logging.warning('Lost leader lease {}.'.format(self._owner))
+            if self._on_lost:
+                self._on_lost()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.campaign()
+            self._stopped.wait(self._ttl / 3000.0)
@@ -0,0 +1,104 @@
+import fnmatch
+import itertools
+import json
+import os
+import typing
+
+# Page size of listings if not given and its upper bound.
+PAGE_LIMIT = int(os.environ.get('HYDRA_PAGE_LIMIT', 100))
+MAX_PAGE_LIMIT = int(os.environ.get('HYDRA_MAX_PAGE_LIMIT', 1000))
+
+
+def parse_limit(value, default: int = PAGE_LIMIT) -> int:
+    if value is None or value == '':
+        return default
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('Limit must be an integer.')
+    if limit < 1:
+        raise ValueError('Limit must be positive.')
+    return min(limit, MAX_PAGE_LIMIT)
+
+
+def parse_fields(value: typing.Optional[str]) -> typing.Optional[typing.Dict[str, typing.Optional[set]]]:
+    """
+    Parses field selector like `name,nodes.name,services` into {'name': None, 'nodes': {'name'}, 'services': None},
+    None selects all fields of a section. Returns None if nothing is selected (all fields).
+    """
+    if not value:
+        return None
+
+    selected = {}
+    for token in value.split(','):
+        token = token.strip()
+        if not token:
+            continue
+        section, _, field = token.partition('.')
+        if field:
+            if selected.get(section, set()) is not None:
+                selected.setdefault(section, set()).add(field)
+        else:
+            selected[section] = None
+    return selected or None
+
+
+def select(item: dict, fields: typing.Optional[typing.Iterable[str]]) -> dict:
+    if fields is None:
+        return item
+    return {k: v for k, v in item.items() if k in fields}
+
+
+def matches(name: str, pattern: typing.Optional[str]) -> bool:
+    """
+    Name filter, exact name or shell style pattern (e.g. `hello*`).
+    """
+    return not pattern or fnmatch.fnmatchcase(name, pattern)
+
+
+class Page(object):
+    """
+    Page of items sorted by `key` of their names. Cursor is the name of the last item of previous page, so pages stay
+    consistent if items are added or removed in between. Items are passed through as they are, e.g. cheap inventory
+    entries whose full state is built only for the page.
+    """
+
+    def __init__(self, items: typing.Iterable, name: typing.Callable[[typing.Any], str],
+                 key: typing.Callable[[str], typing.Any] = str, cursor: typing.Optional[str] = None,
+                 limit: int = PAGE_LIMIT):
+        items = sorted(items, key=lambda i: key(name(i)))
+        if cursor:
+            try:
+                after = key(cursor)
+            except (IndexError, ValueError):
+                raise ValueError('Invalid cursor {!r}.'.format(cursor))
+            items = itertools.dropwhile(lambda i: key(name(i)) <= after, items)
+        self._items = list(itertools.islice(items, limit + 1))
+        self.next = name(self._items[limit - 1]) if len(self._items) > limit else None
+        del self._items[limit:]
+
+    def __iter__(self) -> typing.Iterator:
+        return iter(self._items)
+
+
+def json_array(items: typing.Iterable[dict], fields: typing.Optional[typing.Iterable[str]] = None) \
+        -> typing.Iterator[str]:
+    yield '['
+    for i, item in enumerate(items):
+        yield (',' if i else '') + json.dumps(select(item, fields))
+    yield ']'
+
+
+def json_object(parts: typing.Iterable[typing.Tuple[str, typing.Any]]) -> typing.Iterator[str]:
+    """
+    Streams JSON object of (key, value) pairs. Value is either JSON serializable or a callable returning chunks of
+    JSON (e.g. `json_array`), which is evaluated only when the chunks are sent.
+    """
+    yield '{'
+    for i, (key, value) in enumerate(parts):
+        yield (',' if i else '') + json.dumps(key) + ':'
+        if callable(value):
+            yield from value()
+        else:
+            yield json.dumps(value)
+    yield '}'
@@ -0,0 +1,344 @@
+import bisect
+import contextlib
+import json
+import logging
+import os
+import re
+import redis
+import threading
+import time
+import typing
+import urllib.parse
+import uuid
+
+from .registry import decode
+
+# How often (seconds) every API process publishes its metrics to Redis, /metrics sums metrics of all processes.
+METRICS_INTERVAL = float(os.environ.get('HYDRA_METRICS_INTERVAL', 10))
+
+# Metrics snapshot of one API process, expires if the process is gone.
+METRICS_KEY = 'hydra:metrics:{}'
+
+# Upper bounds (seconds) of latency histogram buckets.
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def label_key(labels: dict) -> str:
+    return json.dumps(sorted(labels.items()))
+
+
+def format_labels(key: str, extra: typing.Sequence[tuple] = ()) -> str:
+    pairs = [tuple(p) for p in json.loads(key)] + list(extra)
+    if not pairs:
+        return ''
+    escaped = ('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+def format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter(object):
+    """
+    Monotonic counter per label set.
+
+    Updates aren't locked to keep them cheap on hot paths. Under the GIL an increment may be lost only if two threads
+    update the very same label set at the same instant, which is acceptable for monitoring.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = label_key(labels)
+        try:
+            self._values[key] += amount
+        except KeyError:
+            with self._lock:
+                self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self) -> dict:
+        return dict(self._values)
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+
+class Gauge(Counter):
+    """
+    Value read by `function` at the time of collection.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str, function: typing.Callable[[], float] = None):
+        super().__init__(name, description)
+        self.function = function
+
+    def snapshot(self) -> dict:
+        if self.function is None:
+            return {}
+        try:
+            return {label_key({}): float(self.function())}
+        except Exception as error:
+            logging.warning('Could not read gauge {}: {}'.format(self.name, error))
+            return {}
+
+
+class Histogram(object):
+    """
+    Latency histogram per label set, sample is [count per bucket..., count, sum]. Updates aren't locked, see Counter.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets: typing.Sequence[float] = BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = label_key(labels)
+        sample = self._values.get(key)
+        if sample is None:
+            with self._lock:
+                sample = self._values.setdefault(key, [0] * (len(self.buckets) + 2) + [0.0])
+        sample[bisect.bisect_left(self.buckets, value)] += 1
+        sample[-2] += 1
+        sample[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def snapshot(self) -> dict:
+        return {k: list(v) for k, v in self._values.items()}
+
+    @staticmethod
+    def merge(a, b):
+        return [x + y for x, y in zip(a, b)]
+
+
+class MetricsRegistry(object):
+    """
+    In-process metrics. Snapshots of other API processes published to Redis are merged on collection.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._id = uuid.uuid4().hex
+        self._publisher = None
+        self._publisher_pid = None
+
+    @property
+    def _origin(self) -> str:
+        # Server workers are forked after import, pid tells them apart.
+        return '{}.{}'.format(self._id, os.getpid())
+
+    def _add(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, description: str) -> Counter:
+        return self._add(Counter(name, description))
+
+    def gauge(self, name: str, description: str, function: typing.Callable[[], float] = None) -> Gauge:
+        gauge = self._add(Gauge(name, description))
+        if function:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name: str, description: str, buckets: typing.Sequence[float] = BUCKETS) -> Histogram:
+        return self._add(Histogram(name, description, buckets))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {m.name: m.snapshot() for m in metrics}
+
+    def publish(self, redis_: redis.Redis, interval: float = METRICS_INTERVAL):
+        """
+        Publishes snapshot of this process to Redis every `interval` seconds in the background.
+        """
+        if self._publisher and self._publisher_pid == os.getpid():
+            return
+
+        def run():
+            while True:
+                try:
+                    redis_.set(METRICS_KEY.format(self._origin), json.dumps(self.snapshot()),
+                               ex=max(int(interval * 3), 1))
+                except redis.RedisError as error:
+                    logging.warning('Could not publish metrics: {}'.format(error))
+                time.sleep(interval)
+
+        self._publisher = threading.Thread(target=run, name='metrics-publisher', daemon=True)
+        self._publisher_pid = os.getpid()
+        self._publisher.start()
+
+    def collect(self, redis_: redis.Redis = None) -> dict:
+        """
+        Snapshot of this process summed with the latest snapshots of other processes found in Redis.
+        """
+        merged = self.snapshot()
+        if redis_ is None:
+            return merged
+
+        try:
+            keys = [k for k in redis_.scan_iter(match=METRICS_KEY.format('*'), count=100)
+                    if decode(k) != METRICS_KEY.format(self._origin)]
+            others = [json.loads(v) for v in (redis_.mget(keys) if keys else []) if v]
+        except redis.RedisError as error:
+            logging.warning('Could not read metrics of other processes: {}'.format(error))
+            others = []
+
+        with self._lock:
+            metrics = dict(self._metrics)
+        for snapshot in others:
+            for name, samples in snapshot.items():
+                metric = metrics.get(name)
+                if not metric:
+                    continue
+                target = merged.setdefault(name, {})
+                for key, value in samples.items():
+                    target[key] = metric.merge(target[key], value) if key in target else value
+        return merged
+
+    def render(self, redis_: redis.Redis = None) -> str:
+        """
+        Metrics in Prometheus text exposition format.
+        """
+        collected = self.collect(redis_)
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+
+        lines = []
+        for m in metrics:
+            lines.append('# HELP {} {}'.format(m.name, m.description))
+            lines.append('# TYPE {} {}'.format(m.name, m.kind))
+            for key, value in sorted(collected.get(m.name, {}).items()):
+                if m.kind != 'histogram':
+                    lines.append('{}{} {}'.format(m.name, format_labels(key), format_value(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(m.buckets) + ['+Inf'], value):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else format_value(bound)
+                    lines.append('{}_bucket{} {}'.format(m.name, format_labels(key, [('le', le)]), cumulative))
+                lines.append('{}_count{} {}'.format(m.name, format_labels(key), format_value(value[-2])))
+                lines.append('{}_sum{} {}'.format(m.name, format_labels(key), format_value(value[-1])))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+DOCKER_SECONDS = REGISTRY.histogram('hydra_docker_api_seconds', 'Docker API requests of cluster host.')
+EXEC_SECONDS = REGISTRY.histogram('hydra_exec_run_seconds', 'Commands run inside nodes (exec_run).')
+HAPROXY_SECONDS = REGISTRY.histogram('hydra_haproxy_command_seconds', 'HAProxy runtime API round trips.')
+REDIS_SECONDS = REGISTRY.histogram('hydra_redis_seconds', 'Redis round trips.')
+LOCK_WAIT_SECONDS = REGISTRY.histogram('hydra_lock_wait_seconds', 'Wait for locks of deploy path.')
+OPERATION_SECONDS = REGISTRY.histogram('hydra_operation_seconds', 'Duration of cluster operations.')
+
+OPERATIONS = REGISTRY.counter('hydra_operations_total', 'Cluster operations (deploys, node starts, migrations).')
+REPLICAS = REGISTRY.counter('hydra_replicas_total', 'Replicas started, failed, recovered or lost by migration.')
+EVENT_BACKLOG = REGISTRY.gauge('hydra_event_backlog', 'Dispatched node event handlers not completed yet.')
+
+
+@contextlib.contextmanager
+def operation(name: str):
+    """
+    Times cluster operation `name` and counts its outcome.
+    """
+    started = time.monotonic()
+    result = 'failed'
+    try:
+        yield
+        result = 'succeeded'
+    finally:
+        OPERATION_SECONDS.observe(time.monotonic() - started, operation=name)
+        OPERATIONS.inc(operation=name, result=result)
+
+
+@contextlib.contextmanager
+def locked(lock, name: str):
+    """
+    Acquires `lock` recording the wait.
+    """
+    started = time.monotonic()
+    with lock:
+        LOCK_WAIT_SECONDS.observe(time.monotonic() - started, lock=name)
+        yield
+
+
+# API version prefix of paths of Docker API.
+_VERSION = re.compile(r'^/v[0-9.]+')
+
+
+def docker_call(method: str, url: str) -> str:
+    """
+    Low cardinality label of Docker API request, e.g. `POST containers/{id}/start`.
+    """
+    path = _VERSION.sub('', urllib.parse.urlsplit(url).path)
+    parts = [p for p in path.split('/') if p]
+    if not parts:
+        return method
+    if len(parts) > 2:
+        parts = [parts[0], '{id}', parts[-1]]
+    elif len(parts) == 2 and parts[1] not in ('json', 'create', 'prune', 'load', 'events'):
+        parts = [parts[0], '{id}']
+    return '{} {}'.format(method, '/'.join(parts))
+
+
+def instrument_docker(client):
+    """
+    Times every request of Docker `client`.
+    """
+    request = client.api.request
+
+    def timed(method, url, *args, **kwargs):
+        with DOCKER_SECONDS.time(call=docker_call(method, url)):
+            return request(method, url, *args, **kwargs)
+
+    client.api.request = timed
+    return client
+
+
+def instrument_redis(client: redis.Redis) -> redis.Redis:
+    """
+    Times every command and pipeline of Redis `client`.
+    """
+    execute_command = client.execute_command
+    pipeline = client.pipeline
+
+    def timed_command(*args, **options):
+        with REDIS_SECONDS.time(command=str(args[0]).split()[0].upper()):
+            return execute_command(*args, **options)
+
+    def timed_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def timed_execute(*a, **kw):
+            with REDIS_SECONDS.time(command='PIPELINE'):
+                return execute(*a, **kw)
+
+        pipe.execute = timed_execute
+        return pipe
+
+    client.execute_command = timed_command
+    client.pipeline = timed_pipeline
+    return client
@@ -0,0 +1,232 @@
+import concurrent.futures
+import docker
+import docker.errors
+import logging
+import os
+import redis
+import threading
+import time
+import typing
+import uuid
+
+# Count of booted standby nodes kept ready for hand out. Zero disables the pool.
+WARM_POOL_SIZE = int(os.environ.get('HYDRA_WARM_POOL_SIZE', 0))
+
+# Upper bound of standby nodes booted concurrently.
+WARM_POOL_WORKERS = int(os.environ.get('HYDRA_WARM_POOL_WORKERS', 2))
+
+# How long (seconds) standby node may take until its inner Docker daemon answers.
+READY_TIMEOUT = float(os.environ.get('HYDRA_NODE_READY_TIMEOUT', 60))
+READY_INTERVAL = 0.5
+
+STANDBY_NAME = 'standby-{}.{}'
+
+# Claim of standby node (by container id), so that only one API process hands it out.
+CLAIM_KEY = 'hydra:standby:{}'
+CLAIM_TTL = 3600
+
+RunNode = typing.Callable[[str], typing.Any]
+
+
+def wait_ready(container, timeout: float = READY_TIMEOUT, interval: float = READY_INTERVAL):
+    """
+    Waits until Docker daemon inside of node `container` answers. Raises TimeoutError otherwise.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        exit_code, _ = container.exec_run('docker info')
+        if exit_code == 0:
+            return
+        if time.monotonic() >= deadline:
+            raise TimeoutError('Docker daemon of {} not ready after {}s.'.format(container.name, timeout))
+        time.sleep(interval)
+
+
+class WarmPool(object):
+    """
+    Pool of booted standby nodes whose inner Docker daemon is ready.
+
+    Standby nodes run under `standby-<id>.<cluster>` names, so they are not cluster nodes yet. Acquired node is
+    renamed to the requested node name (its hostname stays) and pool is refilled in the background.
+
+    Pool is filled by the controller process (`start`) until it loses the role (`stop`). Other API processes acquire
+    standby nodes found in Docker.
+    With Redis every standby node is claimed before hand out, so it's never handed out twice.
+    """
+
+    STOP_EVENTS = ['destroy', 'die', 'kill', 'stop']
+
+    def __init__(
+            self, docker_client: docker.DockerClient, network_name: str, cluster_name: str, run_node: RunNode,
+            size: int = WARM_POOL_SIZE, workers: int = WARM_POOL_WORKERS, redis_: redis.Redis = None):
+        self._docker_client = docker_client
+        self._redis = redis_
+        self._network_name = network_name
+        self._cluster_name = cluster_name
+        self._run_node = run_node
+        self._size = size
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(workers, 1), thread_name_prefix='hydra-pool')
+        self._ready = []
+        self._starting = 0
+        self._started = False
+        self._lock = threading.Lock()
+        self._stats = dict(acquired=0, missed=0, booted=0, failed=0, boot_seconds=0.0)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def is_standby(self, name: str) -> bool:
+        return name.startswith('standby-') and name.endswith('.' + self._cluster_name)
+
+    def start(self):
+        """
+        Adopts standby nodes left by previous API process and fills the pool up.
+        """
+        if self._size <= 0:
+            return
+        if self._started:
+            self.refill()
+            return
+        self._started = True
+
+        containers = self._docker_client.containers.list(filters={'network': self._network_name})
+        standby = [c for c in containers if self.is_standby(c.name)]
+        with self._lock:
+            self._starting += len(standby)
+        for container in standby:
+            self._executor.submit(self._boot, container.name, container)
+
+        self.refill()
+
+    def stop(self):
+        """
+        Stops filling the pool, another process is the controller now. Ready standby nodes stay in Docker, they're
+        adopted by the new controller or acquired by any process.
+        """
+        with self._lock:
+            self._started = False
+            self._ready = []
+
+    def refill(self):
+        with self._lock:
+            if not self._started:
+                return
+            missing = max(self._size - len(self._ready) - self._starting, 0)
+            self._starting += missing
+
+        for _ in range(missing):
+            self._executor.submit(self._boot, STANDBY_NAME.format(uuid.uuid4().hex[:12], self._cluster_name))
+
+    def _boot(self, name: str, container=None):
+        started = time.monotonic()
+        try:
+            container = container or self._run_node(name)
+            wait_ready(container)
+        except Exception as error:
+            logging.warning('Could not boot standby node {}: {}'.format(name, error))
+            with self._lock:
+                self._starting -= 1
+                self._stats['failed'] += 1
+            if container:
+                self._discard(container)
+            return
+
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self._starting -= 1
+            kept = self._started
+            if kept:
+                self._ready.append(container)
+                self._stats['booted'] += 1
+                self._stats['boot_seconds'] += elapsed
+        if not kept:
+            # Pool was stopped while booting, the new controller fills its own pool.
+            self._discard(container)
+            return
+        logging.info('Standby node {} ready in {:.2f}s.'.format(name, elapsed))
+
+    def _discard(self, container):
+        try:
+            container.remove(force=True)
+        except docker.errors.APIError as error:
+            logging.warning('Could not remove standby node {}: {}'.format(container.name, error))
+
+    def claim(self, container) -> bool:
+        if not self._redis:
+            return True
+        return bool(self._redis.set(CLAIM_KEY.format(container.id), container.name, nx=True, ex=CLAIM_TTL))
+
+    def _next_ready(self):
+        if self._started:
+            with self._lock:
+                return self._ready.pop(0) if self._ready else None
+
+        # Not the controller, look for unclaimed standby nodes booted by it.
+        if self._size <= 0 or not self._redis:
+            return None
+        containers = self._docker_client.containers.list(filters={'network': self._network_name})
+        for c in containers:
+            if self.is_standby(c.name) and not self._redis.exists(CLAIM_KEY.format(c.id)):
+                try:
+                    wait_ready(c, timeout=0)
+                    return c
+                except (TimeoutError, docker.errors.APIError):
+                    continue
+        return None
+
+    def acquire(self, name: str):
+        """
+        Hands out ready node renamed to `name`. Returns None if the pool is empty.
+        """
+        container = None
+
+        while True:
+            standby = self._next_ready()
+            if standby is None:
+                with self._lock:
+                    self._stats['missed'] += 1
+                break
+            if not self.claim(standby):
+                # Handed out by another API process.
+                continue
+
+            try:
+                standby.rename(name)
+                standby.reload()
+                container = standby
+                with self._lock:
+                    self._stats['acquired'] += 1
+                break
+            except docker.errors.APIError as error:
+                # Standby died since it was booted.
+                logging.warning('Could not acquire standby node {}: {}'.format(standby.name, error))
+
+        # Only the controller refills the pool.
+        self.refill()
+        return container
+
+    def on_event(self, event: dict):
+        """
+        Drops standby node which went down or was handed out by another API process (renamed) from the pool.
+        """
+        if event.get('Action') not in WarmPool.STOP_EVENTS + ['rename']:
+            return
+
+        with self._lock:
+            before = len(self._ready)
+            self._ready = [c for c in self._ready if c.id != event['id']]
+            removed = before != len(self._ready)
+
+        if removed:
+            logging.info('Standby node {} left the pool ({}).'.format(event['Actor']['Attributes']['name'],
+                                                                     event['Action']))
+            self.refill()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats, size=self._size, ready=len(self._ready), starting=self._starting)
+        booted = stats.pop('boot_seconds')
+        stats['avg_boot_seconds'] = round(booted / stats['booted'], 3) if stats['booted'] else None
+        return stats
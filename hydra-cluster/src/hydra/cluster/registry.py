@@ -0,0 +1,279 @@
+import copy
+import json
+import logging
+import redis
+import threading
+import typing
+
+# Every process writing to the registry publishes aliases of changed services here.
+CHANNEL = 'hydra:registry'
+
+# Service configuration per alias. Hash where every top level attribute of configuration is a JSON encoded field
+# and every replica is a JSON encoded field `node:<node name>`.
+SERVICE_KEY = 'hydra:service:{}'
+REPLICA_FIELD = 'node:{}'
+
+# Reverse index, set of service aliases per node.
+NODE_KEY = 'hydra:node:{}'
+
+# Count hint of keys per SCAN step.
+SCAN_BATCH = 500
+
+
+def decode(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def node_names(cfg: typing.Optional[dict]) -> typing.Set[str]:
+    return {node['name'] for node in (cfg or {}).get('nodes', [])}
+
+
+def encode_config(cfg: dict) -> dict:
+    fields = {key: json.dumps(value) for key, value in cfg.items() if key != 'nodes'}
+    fields.update({REPLICA_FIELD.format(node['name']): json.dumps(node) for node in cfg.get('nodes', [])})
+    return fields
+
+
+def decode_config(fields: dict) -> typing.Optional[dict]:
+    if not fields:
+        return None
+
+    cfg = dict(nodes=[])
+    for key, value in fields.items():
+        key = decode(key)
+        if key.startswith(REPLICA_FIELD.format('')):
+            cfg['nodes'].append(json.loads(value))
+        else:
+            cfg[key] = json.loads(value)
+    return cfg
+
+
+class RegistryBatch(object):
+    """
+    Collects field level updates of service configurations and executes them in one MULTI transaction (one round
+    trip). Every update is a single server side operation on the hash of the service, so concurrent updates of
+    different replicas of the same service don't overwrite each other.
+    """
+
+    def __init__(self, registry: 'ServiceRegistry'):
+        self._registry = registry
+        self._pipe = registry._redis.pipeline(transaction=True)
+        self._changes = []
+        self._records = []
+
+    def __enter__(self) -> 'RegistryBatch':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.execute()
+
+    def set_fields(self, alias: str, **fields) -> 'RegistryBatch':
+        """
+        Sets top level attributes (except `nodes`) of service configuration.
+        """
+        fields = dict(fields, name=alias)
+        self._pipe.hset(SERVICE_KEY.format(alias), mapping={k: json.dumps(v) for k, v in fields.items()})
+        self._changes.append((alias, lambda cfg: cfg.update(fields)))
+        self._records.append(('updated', alias, fields))
+        return self
+
+    def add_replicas(self, alias: str, replicas: typing.List[dict]) -> 'RegistryBatch':
+        if not replicas:
+            return self
+
+        mapping = {REPLICA_FIELD.format(r['name']): json.dumps(r) for r in replicas}
+        mapping['name'] = json.dumps(alias)
+        self._pipe.hset(SERVICE_KEY.format(alias), mapping=mapping)
+        for r in replicas:
+            self._pipe.sadd(NODE_KEY.format(r['name']), alias)
+
+        def change(cfg):
+            added = node_names(dict(nodes=replicas))
+            cfg['nodes'] = [n for n in cfg['nodes'] if n['name'] not in added] + copy.deepcopy(replicas)
+
+        self._changes.append((alias, change))
+        self._records += [('replica_added', alias, r) for r in replicas]
+        return self
+
+    def remove_replica(self, alias: str, node_name: str) -> 'RegistryBatch':
+        self._pipe.hdel(SERVICE_KEY.format(alias), REPLICA_FIELD.format(node_name))
+        self._pipe.srem(NODE_KEY.format(node_name), alias)
+
+        def change(cfg):
+            cfg['nodes'] = [n for n in cfg['nodes'] if n['name'] != node_name]
+
+        self._changes.append((alias, change))
+        self._records.append(('replica_removed', alias, dict(name=node_name)))
+        return self
+
+    def execute(self):
+        if not self._changes:
+            return
+
+        aliases = list(dict.fromkeys(alias for alias, _ in self._changes))
+        for alias in aliases:
+            self._pipe.publish(CHANNEL, alias)
+        self._registry._record(self._pipe, self._records)
+        self._pipe.execute()
+
+        self._registry._apply(self._changes)
+        self._changes = []
+        self._records = []
+
+
+class ServiceRegistry(object):
+    """
+    Facade over Redis which stores configuration of services.
+
+    Reads are served from in-process cache which is loaded once and kept coherent with Redis. Own writes update the
+    cache directly, every write (own ones too) is then re-read from pub/sub messages published on every write.
+    Cached configurations are never mutated in place, every write replaces the whole entry.
+
+    With `changes` every write is also recorded in the state change log in the same transaction.
+    """
+
+    def __init__(self, redis_: redis.Redis, watch: bool = True, changes=None):
+        self._redis = redis_
+        self._watch = watch
+        self._changes = changes
+        self._cache = None
+        self._pubsub = None
+        self._lock = threading.RLock()
+
+    def _load(self) -> dict:
+        return dict(self.scan())
+
+    def scan(self, batch: int = SCAN_BATCH) -> typing.Iterator[typing.Tuple[str, dict]]:
+        """
+        Yields (alias, configuration) of all services straight from Redis.
+
+        Keys are iterated with cursor based SCAN in batches of about `batch` keys. HGETALL of every key of a batch is
+        pipelined with the next SCAN step, so every batch costs one round trip and Redis is never blocked for the whole
+        keyspace. SCAN may return a key more than once.
+        """
+        match = SERVICE_KEY.format('*')
+        prefix_len = len(SERVICE_KEY.format(''))
+
+        cursor, keys = self._redis.scan(0, match=match, count=batch)
+
+        while True:
+            if not keys:
+                if not int(cursor):
+                    return
+                cursor, keys = self._redis.scan(cursor, match=match, count=batch)
+                continue
+
+            pipe = self._redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.hgetall(key)
+            if int(cursor):
+                pipe.scan(cursor, match=match, count=batch)
+            res = pipe.execute()
+
+            for key, fields in zip(keys, res):
+                cfg = decode_config(fields)
+                if cfg:
+                    yield decode(key)[prefix_len:], cfg
+
+            if not int(cursor):
+                return
+            cursor, keys = res[-1]
+
+    def _start_watcher(self):
+        # Subscribe before loading the cache so that no change between load and subscribe is lost.
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(CHANNEL)
+        self._pubsub = pubsub
+
+        threading.Thread(target=self._watch_changes, args=(pubsub,), name='registry-watcher', daemon=True).start()
+
+    def _watch_changes(self, pubsub):
+        try:
+            for message in pubsub.listen():
+                # Own writes are refreshed too. Refresh of a foreign write read before an own write may land after
+                # it, the refresh of the own write (published after it) overwrites that stale entry again.
+                self._refresh(decode(message['data']))
+        except Exception as error:
+            logging.warning('Service registry watcher stopped: {}'.format(error))
+        finally:
+            # Without notifications cache can't be trusted anymore. Next read reloads it.
+            with self._lock:
+                if self._pubsub is pubsub:
+                    self._cache = None
+                    self._pubsub = None
+            pubsub.close()
+
+    def _refresh(self, alias: str):
+        cfg = decode_config(self._redis.hgetall(SERVICE_KEY.format(alias)))
+        with self._lock:
+            if self._cache is None:
+                return
+            if cfg:
+                self._cache[alias] = cfg
+            else:
+                self._cache.pop(alias, None)
+
+    def _apply(self, changes: typing.List[typing.Tuple[str, typing.Callable[[dict], None]]]):
+        # Apply own writes to copies of cached configurations and swap them in.
+        with self._lock:
+            if self._cache is None:
+                return
+            updated = {}
+            for alias, change in changes:
+                if alias not in updated:
+                    updated[alias] = copy.deepcopy(self._cache.get(alias) or dict(name=alias, nodes=[]))
+                change(updated[alias])
+            self._cache.update(updated)
+
+    def _record(self, pipe, records: typing.List[typing.Tuple[str, str, typing.Any]]):
+        if self._changes:
+            for action, alias, data in records:
+                self._changes.record('service', action, alias, data, client=pipe)
+
+    @property
+    def cache(self) -> dict:
+        with self._lock:
+            if self._cache is None:
+                if self._watch and self._pubsub is None:
+                    self._start_watcher()
+                self._cache = self._load()
+            return self._cache
+
+    def all(self) -> typing.List[dict]:
+        """
+        Returns configurations of all services. Returned configurations must not be modified.
+        """
+        return list(self.cache.values())
+
+    def get(self, alias: str) -> typing.Optional[dict]:
+        cfg = self.cache.get(alias)
+        return copy.deepcopy(cfg) if cfg is not None else None
+
+    def node_services(self, node_name: str) -> typing.List[dict]:
+        """
+        Returns configurations of services which have replicas on node `node_name`.
+        """
+        cache = self.cache
+        aliases = sorted(map(decode, self._redis.smembers(NODE_KEY.format(node_name))))
+        return [cache[alias] for alias in aliases if alias in cache]
+
+    def node_names(self) -> typing.Set[str]:
+        """
+        Returns names of nodes which have replicas of any service according to reverse index.
+        """
+        prefix_len = len(NODE_KEY.format(''))
+        return {decode(key)[prefix_len:] for key in self._redis.scan_iter(match=NODE_KEY.format('*'), count=SCAN_BATCH)}
+
+    def batch(self) -> RegistryBatch:
+        return RegistryBatch(self)
+
+    def remove_replica(self, alias: str, node_name: str):
+        with self.batch() as batch:
+            batch.remove_replica(alias, node_name)
+
+    def close(self):
+        with self._lock:
+            pubsub, self._pubsub, self._cache = self._pubsub, None, None
+        if pubsub:
+            pubsub.close()
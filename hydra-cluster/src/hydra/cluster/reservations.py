@@ -0,0 +1,67 @@
+import redis
+import typing
+import uuid
+
+# Reservation of service slot on a node (HAProxy backend server <alias>/nodeN).
+SLOT_KEY = 'hydra:slot:{}:{}'
+
+# Safety net for reservations of crashed deploys (seconds).
+RESERVATION_TTL = 600
+
+# Reservations of placed replicas are kept a bit longer than HAProxy stats snapshot lives (haproxy.STATS_TTL), so
+# other API processes with stale snapshot don't pick the same slot (milliseconds).
+RESERVATION_LINGER = 5000
+
+# Delete (or let expire after ARGV[2] milliseconds) reservation only if it's still held by the given owner.
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    if tonumber(ARGV[2]) > 0 then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class SlotReservations(object):
+    """
+    Atomic reservation table of (service alias, node name) slots used during placement.
+
+    Reservation is taken with SET NX, so two replicas of a service can never be placed on the same node slot, not
+    even by different API processes. Reservation is held until replica is recorded in service registry.
+    """
+
+    def __init__(self, redis_: redis.Redis, ttl: int = RESERVATION_TTL):
+        self._redis = redis_
+        self._ttl = ttl
+        self._owner = uuid.uuid4().hex
+        self._release = redis_.register_script(RELEASE_SCRIPT)
+
+    def reserve(self, alias: str, node_names: typing.List[str], count: int) -> typing.List[str]:
+        """
+        Reserves up to `count` slots of service `alias` on nodes `node_names` (in given order of preference).
+        Returns names of reserved nodes.
+        """
+        reserved = []
+        candidates = list(node_names)
+
+        while candidates and len(reserved) < count:
+            batch, candidates = candidates[:count - len(reserved)], candidates[count - len(reserved):]
+
+            pipe = self._redis.pipeline(transaction=False)
+            for name in batch:
+                pipe.set(SLOT_KEY.format(alias, name), self._owner, nx=True, ex=self._ttl)
+
+            reserved.extend(name for name, ok in zip(batch, pipe.execute()) if ok)
+
+        return reserved
+
+    def release(self, alias: str, node_names: typing.Iterable[str], linger: int = 0):
+        """
+        Releases reservations. With `linger` (milliseconds) reservations expire after a while instead.
+        """
+        pipe = self._redis.pipeline(transaction=False)
+        for name in node_names:
+            self._release(keys=[SLOT_KEY.format(alias, name)], args=[self._owner, linger], client=pipe)
+        pipe.execute()
@@ -0,0 +1,316 @@
+import logging
+import os
+import redis
+import time
+import typing
+import uuid
+
+from .registry import decode
+from .reservations import RESERVATION_TTL
+
+# Capacity of every node. Read from Docker of the node (`docker info`) if not set.
+NODE_CPUS = float(os.environ.get('HYDRA_NODE_CPUS', 0))
+NODE_MEMORY = os.environ.get('HYDRA_NODE_MEMORY', '')
+
+MEMORY_UNITS = {'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+# Holds of placements in progress on a node, field is service alias, value `<owner> <cpus> <memory> <deadline ms>`.
+HOLDS_KEY = 'hydra:holds:{}'
+
+# Check that request fits next to registered replicas (ARGV[7], ARGV[8]) and live holds of other services, then hold
+# it. Holds of services in ARGV[11] are already counted as registered replicas. Expired holds are dropped.
+HOLD_SCRIPT = """
+local now = tonumber(ARGV[9])
+local registered = {}
+for alias in string.gmatch(ARGV[11], '%S+') do
+    registered[alias] = true
+end
+local cpus = tonumber(ARGV[7]) + tonumber(ARGV[3])
+local memory = tonumber(ARGV[8]) + tonumber(ARGV[4])
+local holds = redis.call('hgetall', KEYS[1])
+for i = 1, #holds, 2 do
+    local alias = holds[i]
+    local _, c, m, deadline = string.match(holds[i + 1], '(%S+) (%S+) (%S+) (%S+)')
+    if tonumber(deadline) < now then
+        redis.call('hdel', KEYS[1], alias)
+    elseif alias ~= ARGV[1] and not registered[alias] then
+        cpus = cpus + tonumber(c)
+        memory = memory + tonumber(m)
+    end
+end
+local cap_cpus, cap_memory = tonumber(ARGV[5]), tonumber(ARGV[6])
+if (cap_cpus > 0 and cpus > cap_cpus + 1e-9) or (cap_memory > 0 and memory > cap_memory) then
+    return 0
+end
+local deadline = now + tonumber(ARGV[10])
+redis.call('hset', KEYS[1], ARGV[1], ARGV[2] .. ' ' .. ARGV[3] .. ' ' .. ARGV[4] .. ' ' .. deadline)
+redis.call('pexpire', KEYS[1], ARGV[10])
+return 1
+"""
+
+# Drop hold of service ARGV[1] if it's held by owner ARGV[2], or with linger ARGV[3] (ms) let it expire later.
+UNHOLD_SCRIPT = """
+local hold = redis.call('hget', KEYS[1], ARGV[1])
+if not hold then
+    return 0
+end
+local owner, c, m = string.match(hold, '(%S+) (%S+) (%S+)')
+if owner ~= ARGV[2] then
+    return 0
+end
+if tonumber(ARGV[3]) > 0 then
+    local deadline = tonumber(ARGV[4]) + tonumber(ARGV[3])
+    redis.call('hset', KEYS[1], ARGV[1], owner .. ' ' .. c .. ' ' .. m .. ' ' .. deadline)
+    return 1
+end
+return redis.call('hdel', KEYS[1], ARGV[1])
+"""
+
+
+def parse_memory(value) -> int:
+    """
+    Bytes of memory given as integer or string with Docker unit suffix (b, k, m, g), e.g. '256m'.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        size = int(value)
+    elif isinstance(value, str) and value.strip():
+        text = value.strip().lower()
+        unit = MEMORY_UNITS.get(text[-1])
+        try:
+            size = int(float(text[:-1]) * unit) if unit else int(text)
+        except ValueError:
+            raise ValueError('Invalid memory size {!r}.'.format(value))
+    else:
+        raise ValueError('Invalid memory size {!r}.'.format(value))
+
+    if size <= 0:
+        raise ValueError('Memory size has to be greater than 0.')
+    return size
+
+
+def parse_cpus(value) -> float:
+    try:
+        cpus = float(value)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid count of CPUs {!r}.'.format(value))
+    if cpus <= 0:
+        raise ValueError('Count of CPUs has to be greater than 0.')
+    return cpus
+
+
+class Resources(object):
+    """
+    CPUs and bytes of memory.
+    """
+
+    def __init__(self, cpus: float = 0.0, memory: int = 0):
+        self.cpus = cpus
+        self.memory = memory
+
+    def __add__(self, other: 'Resources') -> 'Resources':
+        return Resources(self.cpus + other.cpus, self.memory + other.memory)
+
+    def __bool__(self) -> bool:
+        return bool(self.cpus or self.memory)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Resources) and (self.cpus, self.memory) == (other.cpus, other.memory)
+
+    def __repr__(self) -> str:
+        return 'Resources(cpus={}, memory={})'.format(self.cpus, self.memory)
+
+    def fits(self, capacity: 'Resources') -> bool:
+        # Capacity of 0 (unknown dimension) doesn't limit.
+        return (not capacity.cpus or self.cpus <= capacity.cpus + 1e-9) and \
+            (not capacity.memory or self.memory <= capacity.memory)
+
+    def to_dict(self) -> dict:
+        return dict(cpus=round(self.cpus, 3), memory=self.memory)
+
+
+def parse_resources(limits: dict = None, reservations: dict = None) -> typing.Optional[dict]:
+    """
+    Validates and normalizes resources of service as given to API. Returns None if there are none.
+    """
+    resources = {}
+    for kind, values in (('limits', limits), ('reservations', reservations)):
+        values = {k: v for k, v in (values or {}).items() if v is not None}
+        unknown = set(values) - {'cpus', 'memory'}
+        if unknown:
+            raise ValueError('Unknown {} {}.'.format(kind, ', '.join(sorted(unknown))))
+        parsed = {}
+        if 'cpus' in values:
+            parsed['cpus'] = parse_cpus(values['cpus'])
+        if 'memory' in values:
+            parsed['memory'] = parse_memory(values['memory'])
+        if parsed:
+            resources[kind] = parsed
+
+    limits, reservations = resources.get('limits', {}), resources.get('reservations', {})
+    for key in ('cpus', 'memory'):
+        if key in limits and key in reservations and reservations[key] > limits[key]:
+            raise ValueError('Reservation of {} is greater than its limit.'.format(key))
+
+    return resources or None
+
+
+def requested(resources: typing.Optional[dict]) -> Resources:
+    """
+    Resources counted against node capacity, reservation or limit if there's no reservation.
+    """
+    resources = resources or {}
+    merged = dict(resources.get('limits', {}), **resources.get('reservations', {}))
+    return Resources(merged.get('cpus', 0.0), merged.get('memory', 0))
+
+
+def docker_args(resources: typing.Optional[dict]) -> typing.List[str]:
+    """
+    Options of `docker run` for resources. CPU reservation is expressed as relative CPU shares.
+    """
+    resources = resources or {}
+    limits, reservations = resources.get('limits', {}), resources.get('reservations', {})
+    args = []
+    if 'cpus' in limits:
+        args += ['--cpus', str(limits['cpus'])]
+    if 'memory' in limits:
+        args += ['--memory', str(limits['memory'])]
+    if 'cpus' in reservations:
+        args += ['--cpu-shares', str(max(int(reservations['cpus'] * 1024), 2))]
+    if 'memory' in reservations:
+        args += ['--memory-reservation', str(reservations['memory'])]
+    return args
+
+
+def node_capacity(node) -> typing.Optional[Resources]:
+    """
+    Capacity of node from configuration or Docker daemon of the node. None if it can't be read.
+    """
+    if NODE_CPUS and NODE_MEMORY:
+        return Resources(NODE_CPUS, parse_memory(NODE_MEMORY))
+
+    exit_code, output = node.exec_run(['docker', 'info', '--format', '{{.NCPU}} {{.MemTotal}}'])
+    if exit_code > 0:
+        logging.warning('Could not read capacity of node {}: {}'.format(node.name, output))
+        return None
+
+    cpus, memory = output.decode().split()
+    return Resources(NODE_CPUS or float(cpus), parse_memory(NODE_MEMORY) if NODE_MEMORY else int(memory))
+
+
+class CapacityTracker(object):
+    """
+    Accounting of node resources requested by replicas against node capacity.
+
+    Allocation of node is the sum of requests of replicas recorded in service registry plus holds of placements in
+    progress. Holds are kept in Redis, so deploys running in different API processes see each other's holds.
+    Placement takes a hold with an atomic check-and-hold script before replicas are started and releases it once
+    replicas are in the registry, with a linger so that registry caches of other processes catch up. Hold of a
+    service which the registry already has on the node is the same replica and isn't counted twice.
+    """
+
+    def __init__(self, registry, redis_: redis.Redis, capacity_of: typing.Callable = node_capacity,
+                 ttl: int = RESERVATION_TTL):
+        self._registry = registry
+        self._redis = redis_
+        self._capacity_of = capacity_of
+        self._ttl = ttl
+        self._owner = uuid.uuid4().hex
+        self._capacities = {}
+        self._hold = redis_.register_script(HOLD_SCRIPT)
+        self._unhold = redis_.register_script(UNHOLD_SCRIPT)
+
+    def capacity(self, node) -> typing.Optional[Resources]:
+        key = (node.name, getattr(node, 'id', None))
+        if key not in self._capacities:
+            try:
+                self._capacities[key] = self._capacity_of(node)
+            except Exception as error:
+                logging.warning('Could not read capacity of node {}: {}'.format(node.name, error))
+                return None
+        return self._capacities[key]
+
+    def cached_capacity(self, name: str) -> typing.Optional[Resources]:
+        return next((c for (n, _), c in self._capacities.items() if n == name and c), None)
+
+    def _registered(self) -> typing.Tuple[typing.Dict[str, Resources], typing.Dict[str, typing.Set[str]]]:
+        # Allocation and aliases of replicas per node according to registry.
+        allocated, aliases = {}, {}
+        for cfg in self._registry.all():
+            for replica in cfg.get('nodes', []):
+                name = replica['name']
+                allocated[name] = allocated.get(name, Resources()) + requested(replica.get('resources'))
+                aliases.setdefault(name, set()).add(cfg['name'])
+        return allocated, aliases
+
+    def _holds(self, names: typing.Optional[typing.List[str]] = None) -> typing.Dict[str, typing.Dict[str, Resources]]:
+        # Live holds {node name: {alias: request}} of `names` or of all nodes.
+        if names is None:
+            prefix_len = len(HOLDS_KEY.format(''))
+            names = [decode(k)[prefix_len:] for k in self._redis.scan_iter(match=HOLDS_KEY.format('*'), count=100)]
+        if not names:
+            return {}
+
+        pipe = self._redis.pipeline(transaction=False)
+        for name in names:
+            pipe.hgetall(HOLDS_KEY.format(name))
+        now = int(time.time() * 1000)
+
+        holds = {}
+        for name, fields in zip(names, pipe.execute()):
+            for alias, value in fields.items():
+                _, cpus, memory, deadline = decode(value).split()
+                if int(deadline) >= now:
+                    holds.setdefault(name, {})[decode(alias)] = Resources(float(cpus), int(memory))
+        return holds
+
+    def allocated(self, names: typing.Optional[typing.List[str]] = None) -> typing.Dict[str, Resources]:
+        allocated, aliases = self._registered()
+        for name, holds in self._holds(names).items():
+            for alias, request in holds.items():
+                if alias not in aliases.get(name, ()):
+                    allocated[name] = allocated.get(name, Resources()) + request
+        return allocated
+
+    def fits(self, nodes: list, request: Resources) -> list:
+        """
+        Returns nodes of `nodes` which have room for `request`.
+        """
+        if not request:
+            return list(nodes)
+
+        allocated = self.allocated([n.name for n in nodes])
+        fitting = []
+        for n in nodes:
+            capacity = self.capacity(n)
+            if capacity and (allocated.get(n.name, Resources()) + request).fits(capacity):
+                fitting.append(n)
+            else:
+                logging.info('Node {} has no room for {!r} (allocated {!r}, capacity {!r}).'.format(
+                    n.name, request, allocated.get(n.name), capacity))
+        return fitting
+
+    def hold(self, alias: str, node, request: Resources) -> bool:
+        """
+        Holds `request` on `node` for a replica of `alias` if it still fits there, also with holds of other
+        processes.
+        """
+        if not request:
+            return True
+
+        capacity = self.capacity(node)
+        if not capacity:
+            return False
+        allocated, aliases = self._registered()
+        base = allocated.get(node.name, Resources())
+        held = self._hold(keys=[HOLDS_KEY.format(node.name)], args=[
+            alias, self._owner, repr(float(request.cpus)), int(request.memory),
+            repr(float(capacity.cpus)), int(capacity.memory), repr(float(base.cpus)), int(base.memory),
+            int(time.time() * 1000), self._ttl * 1000, ' '.join(sorted(aliases.get(node.name, ())))
+        ])
+        return bool(held)
+
+    def release(self, alias: str, node_name: str, linger: int = 0):
+        """
+        Releases hold. With `linger` (milliseconds) hold expires after a while instead.
+        """
+        self._unhold(keys=[HOLDS_KEY.format(node_name)], args=[alias, self._owner, linger, int(time.time() * 1000)])
@@ -0,0 +1,121 @@
+import logging
+import os
+import random
+import typing
+
+# Placement strategy of services which don't ask for any.
+DEFAULT_STRATEGY = os.environ.get('HYDRA_SCHEDULER', 'spread')
+
+
+class NodeLoad(object):
+    """
+    Decision input of scheduler for one node. `cpu` is percent of one CPU, `memory` fraction of memory limit of node
+    container, both None if Docker stats weren't collected.
+    """
+
+    def __init__(self, name: str, replicas: int = 0, cpu: float = None, memory: float = None):
+        self.name = name
+        self.replicas = replicas
+        self.cpu = cpu
+        self.memory = memory
+
+    def __repr__(self) -> str:
+        return 'NodeLoad({}, replicas={}, cpu={}, memory={})'.format(self.name, self.replicas, self.cpu, self.memory)
+
+
+def cpu_percent(stats: dict) -> float:
+    """
+    CPU usage of container between two samples of one `docker stats` reading, same as `docker stats` CLI shows.
+    """
+    cpu, pre = stats.get('cpu_stats', {}), stats.get('precpu_stats', {})
+    cpu_delta = cpu.get('cpu_usage', {}).get('total_usage', 0) - pre.get('cpu_usage', {}).get('total_usage', 0)
+    system_delta = cpu.get('system_cpu_usage', 0) - pre.get('system_cpu_usage', 0)
+    cpus = cpu.get('online_cpus') or len(cpu.get('cpu_usage', {}).get('percpu_usage') or []) or 1
+
+    if cpu_delta <= 0 or system_delta <= 0:
+        return 0.0
+    return cpu_delta / system_delta * cpus * 100.0
+
+
+def memory_fraction(stats: dict) -> float:
+    memory = stats.get('memory_stats', {})
+    limit = memory.get('limit') or 0
+    return memory.get('usage', 0) / limit if limit else 0.0
+
+
+class Scheduler(object):
+    """
+    Placement strategy. Nodes with lower score are preferred.
+    """
+
+    name = None
+
+    # Whether scheduler needs CPU and memory usage of nodes (Docker stats, slow to collect).
+    needs_stats = False
+
+    def score(self, load: NodeLoad) -> float:
+        raise NotImplementedError()
+
+    def rank(self, alias: str, nodes: list, loads: typing.Dict[str, NodeLoad]) -> list:
+        """
+        Returns `nodes` ordered by preference for a replica of service `alias`. Ties are broken randomly.
+        """
+        scored = [(self.score(loads.get(n.name) or NodeLoad(n.name)), random.random(), n) for n in nodes]
+        scored.sort(key=lambda s: s[:2])
+
+        logging.info('Scheduler {} for {!r}: {}'.format(
+            self.name, alias, ', '.join('{}={:.3f} ({!r})'.format(n.name, s, loads.get(n.name)) for s, _, n in scored)))
+
+        return [n for _, _, n in scored]
+
+
+class RandomScheduler(Scheduler):
+
+    name = 'random'
+
+    def score(self, load: NodeLoad) -> float:
+        return 0.0
+
+
+class SpreadScheduler(Scheduler):
+    """
+    Prefers nodes with the least replicas of all services.
+    """
+
+    name = 'spread'
+
+    def score(self, load: NodeLoad) -> float:
+        return float(load.replicas)
+
+
+class LeastLoadedScheduler(Scheduler):
+    """
+    Prefers nodes with the lowest CPU and memory usage.
+    """
+
+    name = 'least-loaded'
+    needs_stats = True
+
+    def score(self, load: NodeLoad) -> float:
+        return (load.cpu or 0.0) / 100.0 + (load.memory or 0.0)
+
+
+class BinpackScheduler(Scheduler):
+    """
+    Fills the busiest nodes first, so that whole nodes stay free.
+    """
+
+    name = 'binpack'
+
+    def score(self, load: NodeLoad) -> float:
+        return -float(load.replicas)
+
+
+SCHEDULERS = {s.name: s for s in (RandomScheduler, SpreadScheduler, LeastLoadedScheduler, BinpackScheduler)}
+
+
+def get_scheduler(name: typing.Optional[str] = None) -> Scheduler:
+    name = name or DEFAULT_STRATEGY
+    if name not in SCHEDULERS:
+        raise ValueError('Unknown placement strategy {!r}, use one of {}.'.format(name, ', '.join(sorted(SCHEDULERS))))
+    return SCHEDULERS[name]()
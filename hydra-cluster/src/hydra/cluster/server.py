@@ -0,0 +1,46 @@
+import logging
+import os
+import typing
+
+# Production server of API: pre-forked workers, each serving requests on a pool of threads.
+API_BIND = os.environ.get('HYDRA_API_BIND', '0.0.0.0:8080')
+API_WORKERS = int(os.environ.get('HYDRA_API_WORKERS', 2))
+API_THREADS = int(os.environ.get('HYDRA_API_THREADS', 8))
+
+# Requests taking longer than that (seconds) get their worker restarted. Long operations run as jobs.
+API_TIMEOUT = int(os.environ.get('HYDRA_API_TIMEOUT', 60))
+
+
+def options(get_cluster: typing.Callable, workers: int = API_WORKERS, threads: int = API_THREADS) -> dict:
+    """
+    Gunicorn settings. Cluster is created in every worker after fork and its controllers are elected among workers.
+    """
+    def post_worker_init(worker):
+        logging.info('Worker {} started, monitoring cluster.'.format(os.getpid()))
+        get_cluster().start_monitoring(elect=True)
+
+    return dict(
+        bind=API_BIND,
+        workers=max(workers, 1),
+        threads=max(threads, 1),
+        worker_class='gthread',
+        timeout=API_TIMEOUT,
+        accesslog='-',
+        errorlog='-',
+        post_worker_init=post_worker_init
+    )
+
+
+def serve(app, get_cluster: typing.Callable, **kwargs):
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+
+        def load_config(self):
+            for key, value in options(get_cluster, **kwargs).items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Server().run()
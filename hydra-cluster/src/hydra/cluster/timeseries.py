@@ -0,0 +1,195 @@
+import array
+import logging
+import math
+import os
+import threading
+import time
+import typing
+
+from .haproxy import HAProxy
+
+# How often (seconds) HAProxy stats are sampled and how many samples are kept per service and replica.
+STATS_INTERVAL = float(os.environ.get('HYDRA_STATS_INTERVAL', 5))
+STATS_SAMPLES = int(os.environ.get('HYDRA_STATS_SAMPLES', 720))
+
+# Default window (seconds) of aggregates.
+STATS_WINDOW = float(os.environ.get('HYDRA_STATS_WINDOW', 60))
+
+# `show stat` of backends (2) and servers (4) of all proxies.
+SHOW_STAT_BACKENDS = 'show stat -1 6 -1'
+
+# Sampled gauges: queued and current sessions, average response and total time (ms). `req_rate` of HAProxy is a
+# frontend stat, it's empty on backend and server rows.
+GAUGES = ('qcur', 'scur', 'rtime', 'ttime')
+
+# Sampled counters: total HTTP requests and 5xx responses of backend or server.
+COUNTERS = ('req_tot', 'hrsp_5xx')
+
+# Counters reported with average and maximum rate per second between samples, e.g. `req_rate` from `req_tot`. Others
+# are reported as average rate `<counter>_rate`.
+RATES = {'req_tot': 'req_rate'}
+
+FIELDS = GAUGES + COUNTERS
+COLUMNS = ('pxname', 'svname', 'status') + FIELDS
+
+# Proxies of HAProxy itself, not services.
+IGNORED_PROXIES = {'stats'}
+
+
+def number(value: str) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def percentile(ordered: typing.Sequence[float], q: float) -> typing.Optional[float]:
+    """
+    Nearest-rank percentile `q` (0-100) of sorted values.
+    """
+    if not ordered:
+        return None
+    return ordered[max(int(math.ceil(q / 100.0 * len(ordered))) - 1, 0)]
+
+
+class RingBuffer(object):
+    """
+    Fixed size series of samples of FIELDS, one preallocated array of doubles per field plus timestamps. Missing
+    values are NaN.
+    """
+
+    def __init__(self, capacity: int = STATS_SAMPLES):
+        self.capacity = capacity
+        self.status = None
+        self._times = array.array('d', bytes(8 * capacity))
+        self._fields = {f: array.array('d', bytes(8 * capacity)) for f in FIELDS}
+        self._next = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, timestamp: float, row: dict):
+        i = self._next
+        self._times[i] = timestamp
+        for f, values in self._fields.items():
+            values[i] = number(row.get(f))
+        self.status = row.get('status')
+        self._next = (i + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def window(self, since: float) -> typing.Tuple[typing.List[float], typing.Dict[str, typing.List[float]]]:
+        """
+        Returns timestamps and values of samples taken at or after `since`, oldest first.
+        """
+        start = (self._next - self._count) % self.capacity
+        order = [(start + k) % self.capacity for k in range(self._count)]
+        # Timestamps grow, so samples in the window are a suffix.
+        first = next((k for k, i in enumerate(order) if self._times[i] >= since), len(order))
+        order = order[first:]
+        return [self._times[i] for i in order], {f: [v[i] for i in order] for f, v in self._fields.items()}
+
+
+def aggregate(status: str, times: typing.List[float], values: typing.Dict[str, typing.List[float]]) -> dict:
+    """
+    Aggregates of samples of a window: average and maximum of gauges, p50/p95/p99 of response and total time, rate
+    of counters per second (average over the window, maximum between two samples).
+    """
+    result = dict(status=status, samples=len(times))
+
+    for f in GAUGES:
+        present = sorted(v for v in values[f] if not math.isnan(v))
+        result[f] = dict(
+            avg=round(sum(present) / len(present), 3) if present else None,
+            max=present[-1] if present else None
+        )
+        if f in ('rtime', 'ttime'):
+            result[f].update({'p{}'.format(q): percentile(present, q) for q in (50, 95, 99)})
+
+    for f in COUNTERS:
+        rate, peak = None, None
+        pairs = [(t, v) for t, v in zip(times, values[f]) if not math.isnan(v)]
+        if len(pairs) > 1 and pairs[-1][0] > pairs[0][0]:
+            # Counter restarts from 0 when HAProxy reloads.
+            increases = [(tb - ta, b - a if b >= a else b) for (ta, a), (tb, b) in zip(pairs, pairs[1:])]
+            rate = round(sum(i for _, i in increases) / (pairs[-1][0] - pairs[0][0]), 3)
+            peak = round(max(i / d for d, i in increases if d > 0), 3)
+        if f in RATES:
+            result[RATES[f]] = dict(avg=rate, max=peak)
+        else:
+            result[f + '_rate'] = rate
+
+    return result
+
+
+class StatsCollector(object):
+    """
+    Samples HAProxy stats of every service backend and its replicas (servers) into ring buffers at fixed interval.
+    Servers in maintenance (free slots) are not sampled, series of replicas which left are dropped.
+    """
+
+    def __init__(self, haproxy: HAProxy, interval: float = STATS_INTERVAL, capacity: int = STATS_SAMPLES):
+        self._haproxy = haproxy
+        self.interval = interval
+        self._capacity = capacity
+        self._series = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._thread or self.interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._run, name='stats-collector', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            started = time.monotonic()
+            try:
+                self.sample()
+            except Exception as error:
+                logging.warning('Could not sample HAProxy stats: {}'.format(error))
+            self._stopped.wait(max(self.interval - (time.monotonic() - started), 0))
+
+    def sample(self, timestamp: float = None):
+        timestamp = time.time() if timestamp is None else timestamp
+        rows = [
+            r for r in self._haproxy.stat_rows(COLUMNS, SHOW_STAT_BACKENDS)
+            if r['pxname'] not in IGNORED_PROXIES and r['status'] != 'MAINT'
+        ]
+
+        with self._lock:
+            seen = set()
+            for row in rows:
+                key = (row['pxname'], row['svname'])
+                seen.add(key)
+                if key not in self._series:
+                    self._series[key] = RingBuffer(self._capacity)
+                self._series[key].append(timestamp, row)
+            for key in set(self._series) - seen:
+                del self._series[key]
+
+    def aggregates(self, window: float = STATS_WINDOW, service: typing.Callable[[str], bool] = None) -> list:
+        """
+        Returns aggregates of every service (BACKEND row) over the last `window` seconds with its replicas.
+        """
+        since = time.time() - window
+        with self._lock:
+            windows = {
+                key: (s.status,) + s.window(since)
+                for key, s in self._series.items() if not service or service(key[0])
+            }
+
+        services = {}
+        for (pxname, svname), w in sorted(windows.items()):
+            entry = services.setdefault(pxname, dict(name=pxname, replicas=[]))
+            if svname == 'BACKEND':
+                entry.update(aggregate(*w))
+            else:
+                entry['replicas'].append(dict(aggregate(*w), name=svname))
+
+        return [services[name] for name in sorted(services)]
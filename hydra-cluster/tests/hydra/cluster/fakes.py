@@ -0,0 +1,99 @@
+import concurrent.futures
+import fakeredis
+import queue
+import redis
+
+from hydra.cluster.registry import SERVICE_KEY, encode_config
+
+
+class FakeExecutor(object):
+    """
+    Runs submitted functions right away in the calling thread.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+    def map(self, fn, *iterables):
+        return map(fn, *iterables)
+
+
+class FakePubSub(object):
+
+    def __init__(self, messages: queue.Queue):
+        self._messages = messages
+        self.channels = []
+
+    def subscribe(self, channel):
+        self.channels.append(channel)
+
+    def listen(self):
+        while True:
+            message = self._messages.get()
+            if message is None:
+                return
+            yield message
+
+    def close(self):
+        pass
+
+
+class FakePipeline(redis.client.Pipeline):
+    """
+    Pipeline of FakeRedis, its round trip is recorded as one call. Published messages are only recorded.
+    """
+
+    def __init__(self, redis_, transaction: bool):
+        super().__init__(redis_.connection_pool, redis_.response_callbacks, transaction, None)
+        self._calls = redis_.calls
+        self._published = redis_.published
+
+    def publish(self, channel, message, **kwargs):
+        self._published.append((channel, message))
+        return self
+
+    def execute(self, raise_on_error=True):
+        self._calls.append('pipeline')
+        return super().execute(raise_on_error)
+
+
+class FakeRedis(fakeredis.FakeRedis):
+    """
+    In-memory Redis which runs Lua scripts for real. Records round trips of registry reads (`calls`) and published
+    messages, which are delivered through `messages` by the test itself.
+    """
+
+    def __init__(self, data: dict = None):
+        super().__init__(server=fakeredis.FakeServer())
+        self.messages = queue.Queue()
+        self.published = []
+        self.calls = []
+        for alias, cfg in (data or {}).items():
+            super().hset(SERVICE_KEY.format(alias), mapping=encode_config(cfg))
+
+    def scan(self, *args, **kwargs):
+        self.calls.append('scan')
+        return super().scan(*args, **kwargs)
+
+    def hgetall(self, name):
+        self.calls.append('hgetall')
+        return super().hgetall(name)
+
+    def smembers(self, name):
+        self.calls.append('smembers')
+        return super().smembers(name)
+
+    def publish(self, channel, message, **kwargs):
+        self.published.append((channel, message))
+        return 0
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return FakePipeline(self, transaction)
+
+    def pubsub(self, **kwargs):
+        return FakePubSub(self.messages)
@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+
+from hydra.cluster import api
+
+
+def test_changes_rejects_watchers_over_limit(mocker):
+    cluster = mocker.MagicMock()
+    cluster.changes.since.return_value = (7, [])
+    mocker.patch.object(api, 'get_cluster', return_value=cluster)
+    mocker.patch.object(api, '_watchers', threading.BoundedSemaphore(1))
+    client = api.api.test_client()
+
+    api._watchers.acquire()
+    response = client.get('/changes?since=7')
+    assert response.status_code == 503
+    assert response.headers['Retry-After']
+    cluster.changes.since.assert_not_called()
+
+    api._watchers.release()
+    response = client.get('/changes?since=7')
+    assert response.status_code == 200
+    assert response.get_json() == dict(version=7, changes=[])
+
+    response = client.get('/changes?since=7', headers={'Accept': 'text/event-stream'})
+    assert response.status_code == 200
+    response.close()
+    assert api._watchers.acquire(blocking=False)
+
+
+def test_node_rejects_boolean_count(mocker):
+    cluster = mocker.MagicMock()
+    mocker.patch.object(api, 'get_cluster', return_value=cluster)
+    client = api.api.test_client()
+
+    response = client.post('/node', json=dict(count=True))
+
+    assert response.status_code == 400
+    cluster.jobs.submit.assert_not_called()
+
+
+@pytest.mark.parametrize('replicas', [0, -1, '2', True, None, 1.5])
+@pytest.mark.parametrize('autoscale', [None, dict(min=1, max=4, req_rate=50)])
+def test_service_rejects_invalid_replicas(mocker, replicas, autoscale):
+    cluster = mocker.MagicMock()
+    mocker.patch.object(api, 'get_cluster', return_value=cluster)
+    client = api.api.test_client()
+
+    response = client.post('/service', json=dict(
+        alias='hello1', image='img', node_port=8001, service_port=8000, replicas=replicas, autoscale=autoscale))
+
+    assert response.status_code == 400
+    assert response.get_json() == dict(error='Count of replicas must be positive integer.')
+    cluster.jobs.submit.assert_not_called()
+
+
+def test_service_queues_deploy(mocker):
+    cluster = mocker.MagicMock()
+    cluster.jobs.submit.return_value = dict(id='1', status='queued')
+    mocker.patch.object(api, 'get_cluster', return_value=cluster)
+    client = api.api.test_client()
+
+    response = client.post('/service', json=dict(
+        alias='hello1', image='img', node_port=8001, service_port=8000, replicas=2, autoscale=dict(min=1, max=4, req_rate=50)))
+
+    assert response.status_code == 202
+    assert cluster.jobs.submit.call_args[0][2:] == ('hello1', 'img', 8001, 8000, 2)
+
+
+def test_capacity_is_not_validated_by_state_version(mocker):
+    cluster = mocker.MagicMock()
+    nodes = [mocker.MagicMock(), mocker.MagicMock()]
+    nodes[0].name, nodes[1].name = 'node-2.test', 'node-10.test'
+    cluster.inventory.nodes.return_value = nodes
+    cluster.node_allocation.side_effect = lambda ns: (dict(name=n.name) for n in ns)
+    mocker.patch.object(api, 'get_cluster', return_value=cluster)
+    client = api.api.test_client()
+
+    response = client.get('/capacity', headers={'If-None-Match': '"7"'})
+
+    assert response.status_code == 200
+    assert 'ETag' not in response.headers
+    assert response.get_json() == dict(nodes=[dict(name='node-2.test'), dict(name='node-10.test')])
+    cluster.changes.version.assert_not_called()
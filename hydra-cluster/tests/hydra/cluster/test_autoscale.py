@@ -0,0 +1,128 @@
+import time
+
+import pytest
+
+from hydra.cluster.autoscale import Autoscaler, desired_replicas, parse_policy
+from hydra.cluster.haproxy import FIELDNAMES, parse_stat
+from hydra.cluster.timeseries import COLUMNS, StatsCollector
+
+
+def stats(**averages) -> dict:
+    return dict(samples=12, **{k: dict(avg=v) for k, v in averages.items()})
+
+
+def test_parse_policy_defaults():
+    policy = parse_policy(dict(max=4, req_rate=100))
+
+    assert policy == dict(min=1, max=4, req_rate=100, cooldown_up=60, cooldown_down=300, window=60)
+    assert parse_policy(None) is None
+
+
+@pytest.mark.parametrize('policy', [
+    dict(req_rate=100),
+    dict(max=4),
+    dict(max=2, min=3, req_rate=100),
+    dict(max=0, min=0, req_rate=100),
+    dict(max=2.5, req_rate=100),
+    dict(max=4, req_rate='fast'),
+    dict(max=4, req_rate=100, window=0),
+    dict(max=4, req_rate=100, latency=10),
+    [4],
+])
+def test_parse_policy_invalid(policy):
+    with pytest.raises(ValueError):
+        parse_policy(policy)
+
+
+def test_desired_replicas_per_replica_rate():
+    policy = parse_policy(dict(max=10, req_rate=100))
+
+    # 2 replicas serving 500 req/s need 5.
+    assert desired_replicas(policy, 2, stats(req_rate=500)) == 5
+    assert desired_replicas(policy, 4, stats(req_rate=100)) == 1
+    # Within tolerance.
+    assert desired_replicas(policy, 2, stats(req_rate=210)) == 2
+
+
+def test_desired_replicas_largest_target_wins_within_bounds():
+    policy = parse_policy(dict(min=2, max=6, req_rate=100, rtime=50))
+
+    assert desired_replicas(policy, 2, stats(req_rate=100, rtime=100)) == 4
+    assert desired_replicas(policy, 4, stats(req_rate=1000, rtime=10)) == 6
+    assert desired_replicas(policy, 4, stats(req_rate=0, rtime=0)) == 2
+
+
+def test_desired_replicas_without_stats_keeps_bounds():
+    policy = parse_policy(dict(min=2, max=3, qcur=5))
+
+    assert desired_replicas(policy, 2, None) == 2
+    assert desired_replicas(policy, 1, stats()) == 2
+    assert desired_replicas(policy, 5, dict(samples=0)) == 3
+
+
+def test_autoscaler_cooldowns(mocker):
+    policy = parse_policy(dict(max=10, req_rate=100, cooldown_up=60, cooldown_down=300))
+    service = dict(name='hello1', autoscale=policy, nodes=[dict(name='node-1.test')])
+    observed = dict(req_rate=300)
+    scale = mocker.MagicMock()
+    autoscaler = Autoscaler(lambda: [service, dict(name='hello2', nodes=[])], lambda a, w: stats(**observed), scale)
+
+    assert autoscaler.evaluate(now=1000) == dict(hello1=3)
+    scale.assert_called_once_with('hello1', 3)
+
+    service['nodes'] = [dict(name='node-{}.test'.format(i)) for i in range(3)]
+    observed['req_rate'] = 600
+    # Up again only after cooldown.
+    assert autoscaler.evaluate(now=1030) == {}
+    assert autoscaler.evaluate(now=1060) == dict(hello1=6)
+
+    service['nodes'] = [dict(name='node-{}.test'.format(i)) for i in range(6)]
+    observed['req_rate'] = 100
+    # Down waits for cooldown since any scaling.
+    assert autoscaler.evaluate(now=1200) == {}
+    assert autoscaler.evaluate(now=1360) == dict(hello1=1)
+
+
+def test_autoscaler_survives_failed_scaling(mocker):
+    policy = parse_policy(dict(max=3, req_rate=100))
+    service = dict(name='hello1', autoscale=policy, nodes=[dict(name='node-1.test')])
+    autoscaler = Autoscaler(
+        lambda: [service], lambda a, w: stats(req_rate=300), mocker.MagicMock(side_effect=RuntimeError('no nodes')))
+
+    assert autoscaler.evaluate(now=0) == {}
+
+
+def show_stat(req_tot: int) -> list:
+    """
+    `show stat -1 6 -1` of service with two replicas. `req_rate` is empty as HAProxy leaves it on backends and servers.
+    """
+    names = [f.lstrip('# ') for f in FIELDNAMES]
+
+    def line(**values):
+        return ','.join(str(values.get(name, '')) for name in names)
+
+    return [
+        ','.join(FIELDNAMES),
+        line(pxname='hello1', svname='node1', status='UP', req_tot=req_tot // 2, qcur=0, scur=3, rtime=12, type=2),
+        line(pxname='hello1', svname='node2', status='UP', req_tot=req_tot // 2, qcur=0, scur=2, rtime=14, type=2),
+        line(pxname='hello1', svname='node3', status='MAINT', req_tot=0, type=2),
+        line(pxname='hello1', svname='BACKEND', status='UP', req_tot=req_tot, qcur=0, scur=5, rtime=13, type=1),
+        '',
+    ]
+
+
+def test_desired_replicas_from_sampled_show_stat(mocker):
+    haproxy = mocker.MagicMock()
+    haproxy.stat_rows = mocker.MagicMock(side_effect=[
+        parse_stat(show_stat(req_tot), COLUMNS) for req_tot in (10000, 13000, 16000)])
+    collector = StatsCollector(haproxy, capacity=4)
+    now = time.time()
+    for i in range(3):
+        collector.sample(now - 10 + i * 5)
+
+    stats = collector.aggregates(window=60)[0]
+    policy = parse_policy(dict(max=10, req_rate=200))
+
+    # 600 req/s of 2 replicas is 300 per replica.
+    assert stats['req_rate'] == dict(avg=600.0, max=600.0)
+    assert desired_replicas(policy, 2, stats) == 3
@@ -0,0 +1,34 @@
+import pytest
+
+from hydra.cluster.changes import STREAM_KEY, StateChanges, VersionGone
+from tests.hydra.cluster.fakes import FakeRedis
+
+
+def test_state_changes_versions():
+    changes = StateChanges(FakeRedis())
+    assert changes.version() == 0
+    assert changes.since(0) == (0, [])
+
+    changes.record('node', 'added', 'node-1.test', dict(name='node-1.test', ip='10.0.0.1'))
+    changes.record('node', 'removed', 'node-1.test')
+
+    assert changes.version() == 2
+    version, delta = changes.since(1)
+    assert version == 2
+    assert delta == [dict(version=2, kind='node', action='removed', name='node-1.test', data=None)]
+    assert changes.since(2) == (2, [])
+
+
+def test_state_changes_gone_when_trimmed():
+    r = FakeRedis()
+    changes = StateChanges(r, maxlen=2)
+    for i in range(4):
+        changes.record('service', 'updated', 'hello{}'.format(i))
+    # MAXLEN ~ trims whole stream nodes only, as Redis would once the stream is long.
+    r.xtrim(STREAM_KEY, maxlen=2, approximate=False)
+
+    assert [c['version'] for c in changes.since(2)[1]] == [3, 4]
+    with pytest.raises(VersionGone):
+        changes.since(1)
+    with pytest.raises(VersionGone):
+        changes.since(7)
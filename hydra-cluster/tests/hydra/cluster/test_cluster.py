@@ -1,21 +1,41 @@
+import concurrent.futures
+import copy
 import docker
 import json
 import pytest
 import redis
+import threading
 
 import hydra.cluster.haproxy as haproxy
-from hydra.cluster import HydraCluster
+from hydra.cluster import NODE_NAME_KEY, ClusterError, HydraCluster, NotEnoughNodes
+from hydra.cluster.inventory import NodeInventory
+from hydra.cluster.registry import ServiceRegistry
+from hydra.cluster.reservations import SlotReservations
+from hydra.cluster.resources import CapacityTracker, Resources
+from tests.hydra.cluster.fakes import FakeRedis
 from tests.conftest import random_str
 
 
+def node(mocker, i: int, cluster_name: str = 'test'):
+    n = mocker.MagicMock(
+        attrs=dict(NetworkSettings=dict(Networks={cluster_name: dict(IPAddress='10.0.0.{}'.format(i))})),
+        status='running'
+    )
+    n.name = 'node-{}.{}'.format(i, cluster_name)
+    return n
+
+
+def register(clstr: HydraCluster, alias: str, replicas: list):
+    with clstr.registry.batch() as batch:
+        batch.add_replicas(alias, replicas)
+
+
 @pytest.fixture
 def nodes(mocker):
-    n1 = mocker.MagicMock()
-    n1.name = 'node-1.test'
+    n1 = node(mocker, 1)
     n1.exec_run = mocker.MagicMock(return_value=(0, random_str(),))
 
-    n2 = mocker.MagicMock()
-    n2.name = 'node-2.test'
+    n2 = node(mocker, 2)
     n2.exec_run = n1.exec_run
 
     return [n1, n2]
@@ -111,52 +131,72 @@ def test_hydra_cluster_haproxy(mocker):
 
 
 def test_hydra_cluster_services(mocker):
-    service = {random_str(): random_str()}
-    mget_ret_val = [json.dumps(service)]
+    service = dict(name='hello1', nodes=[dict(name='node-1.test')])
+    hgetall_ret_val = {b'name': b'"hello1"', b'node:node-1.test': json.dumps(dict(name='node-1.test')).encode()}
     mocker.patch.object(
         HydraCluster,
         HydraCluster.service_registry.fget.__name__,
         new_callable=mocker.PropertyMock,
         return_value=mocker.MagicMock(
-            mget=mocker.MagicMock(return_value=mget_ret_val),
-            keys=mocker.MagicMock(return_value=[])
+            scan=mocker.MagicMock(return_value=(0, [b'hydra:service:hello1'])),
+            pipeline=mocker.MagicMock(return_value=mocker.MagicMock(
+                execute=mocker.MagicMock(return_value=[hgetall_ret_val])
+            ))
         )
     )
 
     clstr = HydraCluster()
+    clstr._registry = ServiceRegistry(clstr.service_registry, watch=False)
     services = clstr.services
 
     assert list(services) == [service]
+    # Second read is served from cache.
+    assert list(clstr.services) == [service]
+    clstr.service_registry.scan.assert_called_once()
 
 
-def test_hydra_cluster_next_node_name(mocker, nodes):
+def test_hydra_cluster_allocate_node_names(mocker, nodes):
     clstr = sut(mocker, nodes, [])
 
-    assert clstr.next_node_name() == 'node-3.test'
+    assert clstr.allocate_node_names(2) == ['node-3.test', 'node-4.test']
+    # Names are claimed until their nodes show up in inventory.
+    assert clstr.allocate_node_names(1) == ['node-5.test']
 
 
 def test_hydra_cluster_get_free_nodes(mocker, nodes):
     haproxy_nodes = [dict(svname='node1')]
 
     clstr = sut(mocker, nodes, haproxy_nodes)
-    nodes = list(clstr.get_free_nodes(random_str()))
+    nodes = list(clstr.get_free_nodes('hello1'))
 
-    assert len(nodes) == 1
+    assert len(nodes) == 2
     assert nodes[0].name in [n.name for n in nodes]
 
+    stats = haproxy.HAProxyStats([
+        dict(pxname='hello1', svname='node1', status='MAINT'), dict(pxname='hello1', svname='node2', status='UP')])
+    assert [n.name for n in clstr.get_free_nodes('hello1', stats=stats)] == ['node-1.test']
+    # Service not on proxy yet.
+    assert len(list(clstr.get_free_nodes('hello2', stats=stats))) == 2
 
-def test_hydra_cluster_create_node(mocker, nodes):
-    mocker.patch.object(
-        HydraCluster,
-        HydraCluster.node_down_monitor.__name__
-    )
 
+def test_hydra_cluster_commit_replicas_ensures_proxy_slots(mocker, nodes):
+    clstr = sut(mocker, nodes, [])
+    replica = dict(name='node-2.test', service_image='img', node_port=8001, service_port=8000)
+
+    clstr.commit_replicas([('hello4', replica)])
+
+    clstr.haproxy.ensure_slots.assert_called_once_with([('hello4', 'node-2.test')])
+    clstr.haproxy.register.assert_called_once_with([('hello4', 'node-2.test', 8001, '10.0.0.2')])
+
+
+def test_hydra_cluster_create_node(mocker, nodes):
     expected_node_name = 'node-3.test'
     expected_network_name = 'test'
 
     clstr = sut(mocker, nodes, [])
+    clstr._docker_client.containers.run = mocker.MagicMock(return_value=node(mocker, 3))
 
-    node = clstr.create_node()
+    clstr.create_node()
 
     clstr._docker_client.containers.run.assert_called_once_with(
         HydraCluster.NODE_IMAGE,
@@ -168,14 +208,120 @@ def test_hydra_cluster_create_node(mocker, nodes):
             tty=True,
             stdin_open=True,
             detach=True,
-            remove=True
+            remove=True,
+            command=None
         )
     )
-    clstr.node_down_monitor.assert_called_once_with(
-        node.name,
-        [clstr.migrate_services],
-        HydraCluster.NODE_DOWN_EVENTS
-    )
+    # New node is known without listing containers again.
+    assert [n.name for n in clstr.nodes] == ['node-1.test', 'node-2.test', 'node-3.test']
+    assert clstr.allocate_node_names(1) == ['node-4.test']
+    clstr._docker_client.containers.list.assert_called_once()
+
+
+def test_hydra_cluster_create_nodes(mocker, nodes):
+    clstr = sut(mocker, nodes, [])
+    clstr._docker_client.containers.run = mocker.MagicMock(
+        side_effect=lambda image, name, **kwargs: node(mocker, int(name.split('.')[0].split('-')[1])))
+
+    started, failed = clstr.create_nodes(3)
+
+    assert sorted(n.name for n in started) == ['node-3.test', 'node-4.test', 'node-5.test']
+    assert failed == []
+    assert clstr._docker_client.containers.run.call_count == 3
+    assert clstr.allocate_node_names(1) == ['node-6.test']
+
+
+def test_hydra_cluster_create_nodes_reports_failures(mocker, nodes):
+    clstr = sut(mocker, nodes, [])
+
+    def run(image, name, **kwargs):
+        if name == 'node-4.test':
+            raise docker.errors.APIError('no space left')
+        return node(mocker, int(name.split('.')[0].split('-')[1]))
+
+    clstr._docker_client.containers.run = mocker.MagicMock(side_effect=run)
+
+    started, failed = clstr.create_nodes(2)
+
+    assert [n.name for n in started] == ['node-3.test']
+    assert failed == [dict(name='node-4.test', error='no space left')]
+    # Name of the failed node is free again.
+    assert clstr.service_registry.exists(NODE_NAME_KEY.format('node-3.test'))
+    assert not clstr.service_registry.exists(NODE_NAME_KEY.format('node-4.test'))
+
+
+def test_hydra_cluster_create_nodes_none_started(mocker, nodes):
+    clstr = sut(mocker, nodes, [])
+    clstr._docker_client.containers.run = mocker.MagicMock(side_effect=Exception('daemon unavailable'))
+
+    with pytest.raises(ClusterError):
+        clstr.create_nodes(2)
+
+    with pytest.raises(ValueError):
+        clstr.create_nodes(0)
+
+
+def test_hydra_cluster_create_node_from_warm_pool(mocker, nodes):
+    clstr = sut(mocker, nodes, [])
+    clstr._pool = mocker.MagicMock(size=1, acquire=mocker.MagicMock(return_value=node(mocker, 3)))
+
+    assert clstr.create_node().name == 'node-3.test'
+
+    clstr._pool.acquire.assert_called_once_with('node-3.test')
+    clstr._docker_client.containers.run.assert_not_called()
+    assert clstr.allocate_node_names(1) == ['node-4.test']
+
+
+def test_hydra_cluster_on_node_down_handles_first_event(mocker, nodes):
+    clstr = sut(mocker, nodes, [])
+    clstr.migrate_services = mocker.MagicMock()
+    clstr.start_controllers = mocker.MagicMock()
+    event = dict(id='abc', Action='kill', Actor=dict(Attributes=dict(name='node-1.test')))
+
+    # Only controller process handles node down.
+    clstr.on_node_down(event)
+    clstr.migrate_services.assert_not_called()
+
+    clstr._controller.set()
+    clstr.on_node_down(event)
+    clstr.on_node_down(dict(event, Action='die'))
+
+    clstr.migrate_services.assert_called_once_with('kill', 'node-1.test')
+
+
+def test_hydra_cluster_start_monitoring_elects_controller(mocker, nodes):
+    clstr = sut(mocker, nodes, [])
+    clstr._events = mocker.MagicMock()
+    clstr._collector = mocker.MagicMock()
+    clstr._autoscaler = mocker.MagicMock()
+    election = mocker.patch('hydra.cluster.LeaderElection')
+
+    clstr.start_monitoring(elect=True)
+
+    assert not clstr.is_controller
+    election.assert_called_once_with(clstr.service_registry, clstr.start_controllers, clstr.stop_controllers)
+    election.return_value.start.assert_called_once()
+    clstr._events.start.assert_called_once()
+
+
+def test_hydra_cluster_start_monitoring(mocker, nodes):
+    clstr = sut(mocker, nodes, [])
+    clstr._events = mocker.MagicMock()
+    clstr._collector = mocker.MagicMock()
+    clstr._autoscaler = mocker.MagicMock()
+    clstr._registry = mocker.MagicMock(node_names=mocker.MagicMock(return_value={'node-1.test', 'node-9.test'}))
+
+    clstr.start_monitoring()
+
+    assert clstr.is_controller
+    clstr._events.subscribe.assert_any_call(HydraCluster.NODE_DOWN_EVENTS, clstr.on_node_down, clstr.is_node)
+    clstr._events.subscribe.assert_any_call(
+        NodeInventory.START_EVENTS + NodeInventory.STOP_EVENTS, clstr.inventory.on_event, clstr.is_node, inline=True)
+    clstr._events.start.assert_called_once()
+    clstr._collector.start.assert_called_once()
+    clstr._autoscaler.start.assert_called_once()
+    # Node which disappeared while API was down.
+    clstr._events.submit.assert_called_once_with(clstr.migrate_services, 'missing', 'node-9.test')
 
 
 def test_hydra_cluster_deploy_service(mocker, nodes):
@@ -183,7 +329,7 @@ def test_hydra_cluster_deploy_service(mocker, nodes):
 
     clstr = sut(mocker, nodes, haproxy_nodes)
 
-    srv_name = random_str()
+    srv_name = 'hello1'
     img_name = random_str()
     srv_port = 10000
     node_port = 10001
@@ -203,7 +349,270 @@ def test_hydra_cluster_deploy_service(mocker, nodes):
     assert srv_cfg.get('nodes')[0].get('service_port') == srv_port
 
 
-def sut(mocker, docker_nodes: list, haproxy_nodes: list, cluster_name: str = 'test') -> HydraCluster:
+def test_hydra_cluster_deploy_service_registers_replicas_in_one_batch(mocker, nodes):
+    haproxy_nodes = [dict(svname='node1'), dict(svname='node2')]
+
+    clstr = sut(mocker, nodes, haproxy_nodes)
+    clstr.get_service_config = mocker.MagicMock(return_value=dict(name='hello1', nodes=[]))
+
+    srv_cfg = clstr.deploy_service('hello1', random_str(), 10001, 10000, replicas=2)
+
+    clstr.haproxy.register.assert_called_once()
+    replicas = clstr.haproxy.register.call_args[0][0]
+    assert sorted(replicas) == sorted(
+        ('hello1', n['name'], 10001, '10.0.0.{}'.format(n['name'][5])) for n in srv_cfg['nodes'])
+
+
+def test_hydra_cluster_start_replicas_seeds_images_first(mocker, nodes):
+    clstr = sut(mocker, nodes, [])
+    clstr._seeder = mocker.MagicMock()
+    spec = dict(service_image='img', node_port=8001, service_port=8000)
+
+    clstr.start_replicas([('hello1', nodes[0], spec), ('hello2', nodes[0], spec), ('hello1', nodes[1], spec)])
+
+    clstr._seeder.seed.assert_called_once_with('img', nodes)
+
+
+def test_hydra_cluster_start_replicas_removes_timed_out_replica(mocker, nodes):
+    mocker.patch('hydra.cluster.DEPLOY_TIMEOUT', 0.05)
+    clstr = sut(mocker, nodes, [])
+    clstr._seeder = mocker.MagicMock()
+    clstr._deploy_executor = concurrent.futures.ThreadPoolExecutor(1)
+    done = threading.Event()
+    clstr.start_replica = mocker.MagicMock(side_effect=lambda *args: done.wait(1) and dict(name='node-1.test'))
+    assert clstr.reservations.reserve('hello1', ['node-1.test'], 1) == ['node-1.test']
+
+    started, failed = clstr.start_replicas(
+        [('hello1', nodes[0], dict(service_image='img', node_port=8001, service_port=8000))])
+    clstr.release_placement([('hello1', nodes[0])], started)
+
+    assert started == []
+    assert failed[0]['error'].startswith('Timed out')
+    # Slot is kept while `docker run` is still in progress.
+    assert clstr.reservations.reserve('hello1', ['node-1.test'], 1) == []
+
+    done.set()
+    clstr._deploy_executor.shutdown(wait=True)
+
+    nodes[0].exec_run.assert_called_with(['docker', 'rm', '-f', 'hello1.node-1.test'])
+    assert clstr.reservations.reserve('hello1', ['node-1.test'], 1) == ['node-1.test']
+
+
+def test_hydra_cluster_deploy_service_binpack(mocker, nodes):
+    clstr = sut(mocker, nodes, [dict(svname='node1'), dict(svname='node2')], pxnames=['hello1', 'hello2'])
+    register(clstr, 'hello2', [dict(name='node-2.test', service_image='img', node_port=1, service_port=1)])
+
+    srv_cfg = clstr.deploy_service('hello1', random_str(), 10001, 10000, strategy='binpack')
+
+    assert [n['name'] for n in srv_cfg['nodes']] == ['node-2.test']
+    assert clstr.registry.get('hello1')['strategy'] == 'binpack'
+
+
+def test_hydra_cluster_deploy_service_unknown_strategy(mocker, nodes):
+    clstr = sut(mocker, nodes, [dict(svname='node1')])
+
+    with pytest.raises(ValueError):
+        clstr.deploy_service('hello1', random_str(), 10001, 10000, strategy='fastest')
+
+
+def test_hydra_cluster_node_loads_with_stats(mocker, nodes):
+    clstr = sut(mocker, nodes, [])
+    nodes[0].stats = mocker.MagicMock(return_value=dict(memory_stats=dict(usage=1, limit=4)))
+    nodes[1].stats = mocker.MagicMock(side_effect=Exception('gone'))
+
+    loads = clstr.node_loads(nodes, with_stats=True)
+
+    assert loads['node-1.test'].memory == 0.25
+    assert loads['node-2.test'].memory is None
+    nodes[0].stats.assert_called_once_with(stream=False)
+
+
+def test_hydra_cluster_deploy_service_with_resources(mocker, nodes):
+    clstr = sut(mocker, nodes, [dict(svname='node1'), dict(svname='node2')], pxnames=['hello1', 'hello2'])
+    clstr._capacity = CapacityTracker(
+        clstr.registry, clstr._reservations._redis, lambda node: Resources(1.0, 1024 ** 3))
+    clstr.get_service_config = mocker.MagicMock(return_value=dict(name='hello1', nodes=[]))
+
+    srv_cfg = clstr.deploy_service(
+        'hello1', 'img', 10001, 10000, replicas=2, resources=dict(limits=dict(cpus=1, memory='512m')))
+
+    cmd = nodes[0].exec_run.call_args[0][0]
+    assert cmd[cmd.index('--cpus') + 1] == '1.0'
+    assert cmd[cmd.index('--memory') + 1] == str(512 * 1024 ** 2)
+    assert srv_cfg['nodes'][0]['resources'] == dict(limits=dict(cpus=1.0, memory=512 * 1024 ** 2))
+    # Replicas are in the registry, holds are released.
+    assert clstr.capacity.allocated()['node-1.test'] == Resources(1.0, 512 * 1024 ** 2)
+    assert list(clstr.node_allocation(clstr.inventory.nodes()))[0] == dict(
+        name='node-1.test', allocated=Resources(1.0, 512 * 1024 ** 2).to_dict(),
+        capacity=Resources(1.0, 1024 ** 3).to_dict())
+    assert 'allocated' not in next(clstr.node_state)
+
+    # Nodes are full now, services without resources still fit.
+    with pytest.raises(NotEnoughNodes):
+        clstr.deploy_service('hello2', 'img', 10002, 10000, resources=dict(reservations=dict(cpus=0.5)))
+    assert clstr.deploy_service('hello2', 'img', 10002, 10000)['deploy']['started'] == 1
+
+
+def test_hydra_cluster_allocate_node_names_unique_across_processes(mocker, nodes):
+    first = sut(mocker, nodes, [])
+    # Another API process (server worker) with the same inventory, sharing Redis.
+    second = copy.copy(first)
+    barrier = threading.Barrier(2)
+
+    def allocate(clstr):
+        barrier.wait()
+        return clstr.allocate_node_names(3)
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        names = [n for names in executor.map(allocate, [first, second]) for n in names]
+
+    assert sorted(names) == ['node-{}.test'.format(i) for i in range(3, 9)]
+
+
+def test_hydra_cluster_deploy_service_not_enough_free_slots(mocker, nodes):
+    haproxy_nodes = [dict(svname='node1'), dict(svname='node2')]
+    clstr = sut(mocker, nodes, haproxy_nodes)
+    other = SlotReservations(clstr._reservations._redis)
+    other.reserve('hello1', ['node-1.test'], 1)
+
+    with pytest.raises(NotEnoughNodes):
+        clstr.deploy_service('hello1', random_str(), 10001, 10000, replicas=2)
+
+    # Reservation of the failed deploy is released, the one of the other deploy is kept.
+    assert clstr.reservations.reserve('hello1', ['node-1.test', 'node-2.test'], 2) == ['node-2.test']
+
+
+def test_hydra_cluster_deploy_service_reports_partial_success(mocker, nodes):
+    nodes[1].exec_run = mocker.MagicMock(return_value=(1, b'no such image'))
+    clstr = sut(mocker, nodes, [dict(svname='node1'), dict(svname='node2')])
+    clstr.get_service_config = mocker.MagicMock(return_value=dict(name='hello1', nodes=[]))
+
+    srv_cfg = clstr.deploy_service('hello1', random_str(), 10001, 10000, replicas=2)
+
+    assert [n['name'] for n in srv_cfg['nodes']] == ['node-1.test']
+    assert srv_cfg['deploy']['requested'] == 2
+    assert srv_cfg['deploy']['started'] == 1
+    assert srv_cfg['deploy']['failed'] == [dict(name='node-2.test', error=str(b'no such image'))]
+    clstr.haproxy.register.assert_called_once_with([('hello1', 'node-1.test', 10001, '10.0.0.1')])
+
+
+def test_hydra_cluster_deploy_service_all_replicas_failed(mocker, nodes):
+    nodes[0].exec_run = mocker.MagicMock(side_effect=Exception('daemon unavailable'))
+    clstr = sut(mocker, nodes, [dict(svname='node1')])
+    clstr.haproxy.stats.return_value = haproxy.HAProxyStats([
+        dict(pxname='hello1', svname='node1', status='MAINT'), dict(pxname='hello1', svname='node2', status='UP')])
+
+    with pytest.raises(ClusterError):
+        clstr.deploy_service('hello1', random_str(), 10001, 10000)
+
+    clstr.haproxy.register.assert_not_called()
+    assert clstr.reservations.reserve('hello1', ['node-1.test'], 1) == ['node-1.test']
+
+
+def test_hydra_cluster_migrate_services_plans_all_replicas_at_once(mocker, nodes):
+    n3 = node(mocker, 3)
+    n3.exec_run = mocker.MagicMock(return_value=(0, b''))
+    nodes.append(n3)
+    haproxy_nodes = [dict(svname='node2'), dict(svname='node3')]
+    clstr = sut(mocker, nodes, haproxy_nodes, pxnames=['hello1', 'hello2'])
+
+    def replica(name):
+        return dict(name=name, service_image='img', node_port=8001, service_port=8000)
+
+    register(clstr, 'hello1', [replica('node-1.test'), replica('node-2.test')])
+    register(clstr, 'hello2', [replica('node-1.test')])
+    clstr._registry.node_services = mocker.MagicMock(return_value=clstr.registry.all())
+    register(clstr, 'hello3', [replica('node-3.test')])
+    clstr.deploy_service = mocker.MagicMock()
+
+    report = clstr.migrate_services('die', 'node-1.test')
+
+    clstr._registry.node_services.assert_called_once_with('node-1.test')
+    clstr.deploy_service.assert_not_called()
+    started = [
+        c[0][0][7] for c in nodes[0].exec_run.call_args_list + n3.exec_run.call_args_list if c[0][0][1] == 'run']
+    assert sorted(started) == ['hello1.node-3.test', 'hello2.node-2.test']
+    assert report['displaced'] == 2
+    assert report['recovered'] == 2
+    assert report['failed'] == []
+
+    # hello1 was on node-2 already, so it can go only to node-3. hello2 is spread to node-2 which has less replicas.
+    registered = sorted(clstr.haproxy.register.call_args[0][0])
+    assert registered == [('hello1', 'node-3.test', 8001, '10.0.0.3'), ('hello2', 'node-2.test', 8001, '10.0.0.2')]
+    assert sorted(n['name'] for n in clstr.registry.get('hello1')['nodes']) == ['node-2.test', 'node-3.test']
+    assert [n['name'] for n in clstr.registry.get('hello2')['nodes']] == ['node-2.test']
+
+
+def test_hydra_cluster_migrate_services_reports_unplaced(mocker, nodes):
+    clstr = sut(mocker, nodes, [])
+    # Slot of the other node is taken.
+    clstr.haproxy.stats.return_value = haproxy.HAProxyStats([dict(pxname='hello1', svname='node2', status='UP')])
+    replica = dict(name='node-1.test', service_image='img', node_port=8001, service_port=8000)
+    register(clstr, 'hello1', [replica])
+    clstr._registry.node_services = mocker.MagicMock(return_value=clstr.registry.all())
+
+    report = clstr.migrate_services('die', 'node-1.test')
+
+    assert report['recovered'] == 0
+    assert report['failed'] == [dict(service='hello1', error='No free node.')]
+    assert clstr.registry.get('hello1')['nodes'] == []
+
+
+def test_hydra_cluster_scale_service_up(mocker, nodes):
+    clstr = sut(mocker, nodes, [dict(svname='node2')])
+    replica = dict(name='node-1.test', service_image='img', node_port=8001, service_port=8000)
+    register(clstr, 'hello1', [replica])
+
+    report = clstr.scale_service('hello1', 3)
+
+    # Only one free node.
+    assert report == dict(service='hello1', replicas=2, added=['node-2.test'], removed=[])
+    assert sorted(n['name'] for n in clstr.registry.get('hello1')['nodes']) == ['node-1.test', 'node-2.test']
+
+
+def test_hydra_cluster_scale_service_down(mocker, nodes):
+    clstr = sut(mocker, nodes, [])
+    register(clstr, 'hello1', [
+        dict(name=n.name, service_image='img', node_port=8001, service_port=8000) for n in nodes])
+    clstr.haproxy.unregister = mocker.MagicMock()
+
+    report = clstr.scale_service('hello1', 1)
+
+    assert report['replicas'] == 1
+    assert len(report['removed']) == 1
+    clstr.haproxy.unregister.assert_called_once_with([('hello1', report['removed'][0])])
+    assert [n['name'] for n in clstr.registry.get('hello1')['nodes']] != report['removed']
+    nodes[0].exec_run.assert_any_call(['docker', 'rm', '-f', 'hello1.{}'.format(report['removed'][0])])
+
+
+def test_hydra_cluster_set_autoscale(mocker, nodes):
+    clstr = sut(mocker, nodes, [])
+    register(clstr, 'hello1', [dict(name='node-1.test')])
+
+    policy = clstr.set_autoscale('hello1', dict(max=3, req_rate=50))
+
+    assert policy['max'] == 3 and policy['min'] == 1
+    assert clstr.registry.get('hello1')['autoscale'] == policy
+    with pytest.raises(KeyError):
+        clstr.set_autoscale('hello2', dict(max=3, req_rate=50))
+
+
+def test_hydra_cluster_commit_replicas_stops_replicas_if_proxy_fails(mocker, nodes):
+    clstr = sut(mocker, nodes, [])
+    clstr.haproxy.ensure_slots.side_effect = haproxy.HAProxyError('Proxy did not reload within 30s.')
+    replica = dict(name='node-2.test', service_image='img', node_port=8001, service_port=8000)
+
+    with pytest.raises(haproxy.HAProxyError):
+        clstr.commit_replicas([('hello4', replica)])
+
+    nodes[1].exec_run.assert_called_with(['docker', 'rm', '-f', 'hello4.node-2.test'])
+    clstr.haproxy.register.assert_not_called()
+    assert clstr.registry.get('hello4') is None
+
+
+def sut(
+        mocker, docker_nodes: list, haproxy_nodes: list, cluster_name: str = 'test',
+        pxnames: list = ('hello1',)) -> HydraCluster:
     # Mock docker
     mock_docker = mocker.MagicMock()
     mock_docker.containers = mocker.MagicMock()
@@ -219,20 +628,19 @@ def sut(mocker, docker_nodes: list, haproxy_nodes: list, cluster_name: str = 'te
     mock_node.name = cluster_name
     mock_docker.containers.get = lambda x: mock_node
     mock_docker.containers.list = mocker.MagicMock(return_value=docker_nodes)
+    mock_docker.images.get = mocker.MagicMock(side_effect=docker.errors.ImageNotFound('not on host'))
     mock_docker.networks = mocker.MagicMock()
     mock_network = mocker.MagicMock()
     mock_network.name = cluster_name
     mock_docker.networks.get = mocker.MagicMock(return_value=mock_network)
 
-    # Mock Redis
-    mock_redis = mocker.MagicMock()
-    mock_redis.get = mocker.MagicMock(return_value={'name': random_str(), 'nodes': docker_nodes})
-
     # Mock HAProxy
     mocker.patch.object(
         haproxy.HAProxy,
-        haproxy.HAProxy.get_free_nodes.__name__,
-        return_value=iter(haproxy_nodes)
+        haproxy.HAProxy.stats.__name__,
+        return_value=haproxy.HAProxyStats(
+            [dict(pxname=px, svname=n['svname'], status='MAINT') for px in pxnames for n in haproxy_nodes]
+        )
     )
     mocker.patch.object(
         haproxy.HAProxy,
@@ -242,10 +650,18 @@ def sut(mocker, docker_nodes: list, haproxy_nodes: list, cluster_name: str = 'te
     )
     mocker.patch.object(
         haproxy.HAProxy,
-        haproxy.HAProxy.register_service.__name__
+        haproxy.HAProxy.register.__name__
+    )
+    mocker.patch.object(
+        haproxy.HAProxy,
+        haproxy.HAProxy.ensure_slots.__name__
     )
 
     clstr = HydraCluster()
     clstr._docker_client = mock_docker
-    clstr._service_registry = mock_redis
+    fake_redis = FakeRedis()
+    clstr._service_registry = fake_redis
+    clstr._registry = ServiceRegistry(fake_redis, watch=False)
+    clstr._reservations = SlotReservations(fake_redis)
+    clstr._capacity = CapacityTracker(clstr._registry, fake_redis)
     return clstr
\ No newline at end of file
@@ -0,0 +1,69 @@
+import threading
+
+from hydra.cluster.events import EventWatcher
+
+
+def event(name, action, id_='abc'):
+    return dict(id=id_, Action=action, time=1, Actor=dict(Attributes=dict(name=name)))
+
+
+def test_event_watcher_dispatches_matching_events(mocker):
+    watcher = EventWatcher(mocker.MagicMock(), workers=1)
+    handled = []
+    done = threading.Event()
+
+    def handler(e):
+        handled.append(e)
+        done.set()
+
+    watcher.subscribe(['die'], handler, lambda name: name.startswith('node-'))
+
+    watcher.dispatch(event('redis.test', 'die'))
+    watcher.dispatch(event('node-1.test', 'start'))
+    watcher.dispatch(event('node-1.test', 'die'))
+
+    assert done.wait(1)
+    watcher.stop()
+    assert [e['Actor']['Attributes']['name'] for e in handled] == ['node-1.test']
+
+
+def test_event_watcher_single_stream_for_all_nodes(mocker):
+    stream = mocker.MagicMock()
+    stream.__iter__ = lambda _: iter([event('node-1.test', 'die', 'a'), event('node-2.test', 'die', 'b')])
+    client = mocker.MagicMock(events=mocker.MagicMock(return_value=stream))
+    watcher = EventWatcher(client, workers=2)
+    handled = []
+    watcher.subscribe(['die', 'kill'], handled.append, lambda name: True)
+
+    # Run one iteration of the loop in the current thread.
+    watcher._stopped = mocker.MagicMock(is_set=mocker.MagicMock(side_effect=[False, True, True]))
+    watcher._run()
+    watcher._executor.shutdown(wait=True)
+
+    client.events.assert_called_once_with(decode=True, since=None, filters={'type': 'container', 'event': ['die', 'kill']})
+    assert sorted(e['id'] for e in handled) == ['a', 'b']
+    assert watcher.backlog == 0
+
+
+def test_event_watcher_runs_inline_handlers_without_waiting_for_pool(mocker):
+    watcher = EventWatcher(mocker.MagicMock(), workers=1)
+    migrating = threading.Event()
+    release = threading.Event()
+    removed = []
+
+    def migrate(e):
+        migrating.set()
+        release.wait(1)
+
+    watcher.subscribe(['die'], migrate, lambda name: True)
+    watcher.subscribe(['die'], lambda e: removed.append(e['id']), lambda name: True, inline=True)
+
+    # Migration of the first dead node occupies the only worker.
+    watcher.dispatch(event('node-1.test', 'die', 'a'))
+    assert migrating.wait(1)
+    watcher.dispatch(event('node-2.test', 'die', 'b'))
+
+    assert removed == ['a', 'b']
+    assert watcher.backlog == 2
+    release.set()
+    watcher.stop()
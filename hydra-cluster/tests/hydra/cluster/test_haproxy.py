@@ -0,0 +1,366 @@
+import io
+import os
+import socket
+import tarfile
+import tempfile
+import threading
+
+import pytest
+
+from hydra.cluster.haproxy import (
+    CONFIG_FILE, FIELDNAMES, SERVICES_MARKER, STATE_FILE, HAProxy, HAProxyError, HAProxyRuntime, HAProxyStats, PROMPT,
+    parse_stat, render_config, tar_file, untar_file)
+
+
+class FakeRuntimeAPI(object):
+    """
+    Minimal HAProxy runtime API speaking `prompt` mode over UNIX socket.
+    """
+
+    def __init__(self, path, replies=None):
+        self.path = path
+        self.replies = replies or {}
+        self.commands = []
+        self.connections = 0
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen(5)
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self._session, args=(conn,), daemon=True).start()
+
+    def _session(self, conn):
+        with conn, conn.makefile('rb') as lines:
+            for line in lines:
+                cmd = line.decode('ascii').rstrip('\n')
+                self.commands.append(cmd)
+                reply = '' if cmd == 'prompt' else self.replies.get(cmd, '')
+                if reply is None:
+                    # Stalled.
+                    continue
+                conn.sendall(reply.encode('ascii') + PROMPT)
+
+    def close(self):
+        self._server.close()
+
+
+@pytest.fixture
+def runtime_api():
+    with tempfile.TemporaryDirectory() as tmp:
+        api = FakeRuntimeAPI(os.path.join(tmp, 'admin.sock'), {'show info': 'Name: HAProxy\n'})
+        yield api
+        api.close()
+
+
+def test_haproxy_runtime_reuses_session(runtime_api):
+    runtime = HAProxyRuntime(runtime_api.path)
+
+    assert runtime.execute('show info') == ['Name: HAProxy\n']
+    assert runtime.execute('show info') == ['Name: HAProxy\n']
+    assert runtime_api.connections == 1
+    assert runtime_api.commands == ['prompt', 'show info', 'show info']
+
+    runtime.close()
+
+
+def test_haproxy_runtime_closes_stalled_session(runtime_api):
+    runtime_api.replies['show stall'] = None
+    runtime = HAProxyRuntime(runtime_api.path, timeout=0.2)
+
+    with pytest.raises(HAProxyError):
+        runtime.execute('show stall')
+
+    assert runtime.execute('show info') == ['Name: HAProxy\n']
+    assert runtime_api.connections == 2
+    # Not retried.
+    assert runtime_api.commands.count('show stall') == 1
+
+    runtime.close()
+
+
+def test_haproxy_runtime_pipelines_batch(runtime_api):
+    runtime = HAProxyRuntime(runtime_api.path)
+
+    replies = runtime.execute('set server a/node1 state ready', 'show info', 'set server a/node2 state ready')
+
+    assert replies == ['', 'Name: HAProxy\n', '']
+    assert runtime_api.commands[1:] == ['set server a/node1 state ready', 'show info', 'set server a/node2 state ready']
+
+    runtime.close()
+
+
+def test_haproxy_runtime_reconnects_after_idle_timeout(runtime_api):
+    runtime = HAProxyRuntime(runtime_api.path, idle_timeout=0)
+
+    runtime.execute('show info')
+    runtime.execute('show info')
+
+    assert runtime_api.connections == 2
+
+    runtime.close()
+
+
+def test_haproxy_register(mocker):
+    mocker.patch.object(socket, socket.gethostbyname.__name__, side_effect=lambda n: '10.0.0.{}'.format(n[5]))
+    proxy = HAProxy('haproxy.test', mocker.MagicMock())
+    proxy.send_batch = mocker.MagicMock(side_effect=lambda cmds: [''] * len(cmds))
+
+    proxy.register([('hello1', 'node-1.test', 8001), ('hello1', 'node-2.test', 8001, '10.0.0.12')])
+
+    proxy.send_batch.assert_called_once_with([
+        'set server hello1/node1 addr 10.0.0.1 port 8001',
+        'set server hello1/node1 state ready',
+        'set server hello1/node2 addr 10.0.0.12 port 8001',
+        'set server hello1/node2 state ready',
+    ])
+
+
+def test_haproxy_unregister(mocker):
+    proxy = HAProxy('haproxy.test', mocker.MagicMock())
+    proxy.send_batch = mocker.MagicMock(side_effect=lambda cmds: [''] * len(cmds))
+
+    proxy.unregister([('hello1', 'node-1.test'), ('hello1', 'node-12.test')])
+
+    proxy.send_batch.assert_called_once_with([
+        'set server hello1/node1 state maint',
+        'set server hello1/node12 state maint',
+    ])
+
+
+def stat_line(**values) -> str:
+    return ','.join(str(values.get(f.lstrip('# '), '')) for f in FIELDNAMES) + '\n'
+
+
+STAT = ''.join([
+    ','.join(FIELDNAMES) + '\n',
+    stat_line(pxname='hello1', svname='FRONTEND', status='OPEN'),
+    stat_line(pxname='hello1', svname='node1', status='MAINT'),
+    stat_line(pxname='hello1', svname='node2', status='UP'),
+    stat_line(pxname='hello1', svname='node3', status='MAINT'),
+    stat_line(pxname='hello2', svname='node1', status='UP'),
+    '\n'
+])
+
+
+def stat_proxy(mocker, **kwargs):
+    proxy = HAProxy('haproxy.test', mocker.MagicMock(), **kwargs)
+    proxy._runtime = mocker.MagicMock(
+        execute=mocker.MagicMock(side_effect=lambda *cmds: [''] * len(cmds)),
+        stream=mocker.MagicMock(side_effect=lambda cmd: iter(STAT.split('\n')))
+    )
+    return proxy
+
+
+def test_haproxy_stats_indexes(mocker):
+    stats = stat_proxy(mocker).stats()
+
+    assert stats.servers('hello1', 'MAINT') == {'node1', 'node3'}
+    assert stats.servers('hello2', 'MAINT') == set()
+    assert stats.get('hello1', 'node2')['status'] == 'UP'
+    assert stats.get('hello3', 'node1') is None
+
+
+def test_haproxy_stats_cached_until_set_server(mocker):
+    proxy = stat_proxy(mocker, stats_ttl=60)
+
+    assert proxy.stats() is proxy.stats()
+    assert proxy._runtime.stream.call_count == 1
+
+    proxy.send('show info')
+    proxy.stats()
+    assert proxy._runtime.stream.call_count == 1
+
+    proxy.send('set server hello1/node1 state ready')
+    proxy.stats()
+    assert proxy._runtime.stream.call_count == 2
+
+
+def test_parse_stat_selects_columns_by_header():
+    lines = ['# svname,pxname,status,rtime', 'node1,hello1,UP,12', '', 'node2,hello1,MAINT,0']
+
+    rows = list(parse_stat(lines, ['pxname', 'rtime']))
+
+    assert rows == [dict(pxname='hello1', rtime='12'), dict(pxname='hello1', rtime='0')]
+
+
+def test_parse_stat_without_header_uses_fieldnames():
+    rows = parse_stat(STAT.split('\n')[1:], ['svname', 'status'])
+
+    assert next(rows) == dict(svname='FRONTEND', status='OPEN')
+
+
+def test_haproxy_runtime_streams_reply_larger_than_buffer(runtime_api):
+    runtime_api.replies['show stat -1 4 -1'] = STAT
+    runtime = HAProxyRuntime(runtime_api.path, buffer_size=16)
+
+    rows = list(parse_stat(runtime.stream('show stat -1 4 -1'), ['pxname', 'svname', 'status']))
+
+    assert len(rows) == 5
+    assert rows[1] == dict(pxname='hello1', svname='node1', status='MAINT')
+
+    # Session stays usable after streaming.
+    assert runtime.execute('show info') == ['Name: HAProxy\n']
+
+    runtime.close()
+
+
+def test_haproxy_runtime_stream_drains_unread_reply(runtime_api):
+    runtime_api.replies['show stat -1 4 -1'] = STAT
+    runtime = HAProxyRuntime(runtime_api.path, buffer_size=16)
+
+    lines = runtime.stream('show stat -1 4 -1')
+    next(lines)
+    lines.close()
+
+    assert runtime.execute('show info') == ['Name: HAProxy\n']
+
+    runtime.close()
+
+
+STATIC_CONFIG = 'global\n\tstats socket /run/haproxy/admin.sock level admin expose-fd listeners\n'
+
+
+def slots(pxname: str, count: int, used: int = 0) -> list:
+    return [dict(pxname=pxname, svname='node{}'.format(i), status='UP' if i <= used else 'MAINT')
+            for i in range(1, count + 1)]
+
+
+def test_render_config_keeps_static_part():
+    current = STATIC_CONFIG + SERVICES_MARKER + '\nfrontend fe_main\n\tbind *:8888\n'
+
+    config = render_config(current, {'hello2': 12, 'hello1': 0})
+
+    assert config.startswith(STATIC_CONFIG + SERVICES_MARKER)
+    assert config.count('frontend fe_main') == 1
+    assert '\tacl hello1 path /hello1\n\tacl hello1 path_beg /hello1/\n\tuse_backend hello1 if hello1\n' in config
+    assert 'backend hello1\n' in config and 'server-template node 1-10 0.0.0.0:8888' in config
+    assert config.index('backend hello1') < config.index('backend hello2')
+    assert 'server-template node 1-20 0.0.0.0:8888' in config
+
+    with pytest.raises(HAProxyError):
+        render_config(STATIC_CONFIG, {})
+
+
+def test_tar_file_round_trip():
+    assert untar_file([tar_file(CONFIG_FILE, 'global\n')], CONFIG_FILE) == 'global\n'
+
+
+def test_haproxy_ensure_slots_existing(mocker):
+    proxy = HAProxy('haproxy.test', mocker.MagicMock())
+    proxy.stats = mocker.MagicMock(return_value=HAProxyStats(slots('hello1', 10)))
+    proxy.send_batch = mocker.MagicMock()
+
+    proxy.ensure_slots([('hello1', 'node-3.test')])
+
+    proxy.send_batch.assert_not_called()
+
+
+def test_haproxy_ensure_slots_adds_servers(mocker):
+    proxy = HAProxy('haproxy.test', mocker.MagicMock())
+    proxy.stats = mocker.MagicMock(return_value=HAProxyStats(slots('hello1', 10)))
+    proxy.send_batch = mocker.MagicMock(side_effect=lambda cmds: ['New server registered.', ''] * (len(cmds) // 2))
+    proxy.reload = mocker.MagicMock()
+
+    proxy.ensure_slots([('hello1', 'node-12.test'), ('hello1', 'node-2.test')])
+
+    proxy.send_batch.assert_called_once_with([
+        'add server hello1/node12 0.0.0.0:8888 check',
+        'enable health hello1/node12',
+    ])
+    proxy.reload.assert_not_called()
+
+
+def test_haproxy_ensure_slots_tolerates_existing_servers(mocker):
+    proxy = HAProxy('haproxy.test', mocker.MagicMock())
+    proxy.stats = mocker.MagicMock(return_value=HAProxyStats(slots('hello1', 10)))
+    proxy.send_batch = mocker.MagicMock(return_value=['Already exists a server with the same name in backend.', ''])
+    proxy.reload = mocker.MagicMock()
+
+    proxy.ensure_slots([('hello1', 'node-12.test')])
+
+    proxy.reload.assert_not_called()
+
+
+def test_haproxy_ensure_slots_reloads_without_dynamic_servers(mocker):
+    proxy = HAProxy('haproxy.test', mocker.MagicMock())
+    proxy.stats = mocker.MagicMock(return_value=HAProxyStats(slots('hello1', 10)))
+    proxy.send_batch = mocker.MagicMock(side_effect=lambda cmds: ['Unknown command.'] * len(cmds))
+    proxy.reload = mocker.MagicMock()
+
+    proxy.ensure_slots([('hello1', 'node-12.test'), ('hello1', 'node-2.test')])
+
+    proxy.reload.assert_called_once_with({'hello1'}, dict(hello1=12))
+
+    # Runtime API isn't tried again.
+    proxy.send_batch.reset_mock()
+    proxy.ensure_slots([('hello1', 'node-13.test')])
+    proxy.send_batch.assert_not_called()
+
+
+def test_haproxy_ensure_slots_new_backend_reloads(mocker):
+    proxy = HAProxy('haproxy.test', mocker.MagicMock())
+    proxy.stats = mocker.MagicMock(return_value=HAProxyStats(slots('hello1', 10)))
+    proxy.send_batch = mocker.MagicMock()
+    proxy.reload = mocker.MagicMock()
+
+    proxy.ensure_slots([('hello4', 'node-1.test'), ('hello1', 'node-11.test')])
+
+    # Slot of existing backend is rendered by the same reload.
+    proxy.send_batch.assert_not_called()
+    proxy.reload.assert_called_once_with({'hello1', 'hello4'}, dict(hello1=11, hello4=1))
+
+
+def test_haproxy_reload(mocker):
+    current = STATIC_CONFIG + SERVICES_MARKER + '\n'
+    container = mocker.MagicMock()
+    container.get_archive = mocker.MagicMock(return_value=([tar_file(CONFIG_FILE, current)], {}))
+    container.exec_run = mocker.MagicMock(return_value=(0, b''))
+    docker_client = mocker.MagicMock()
+    docker_client.containers.get = mocker.MagicMock(return_value=container)
+
+    proxy = HAProxy('haproxy.test', docker_client)
+    proxy._runtime = mocker.MagicMock()
+    before = HAProxyStats(slots('hello1', 10, used=2) + slots('stats', 0))
+    after = HAProxyStats(slots('hello1', 10, used=2) + slots('hello2', 20))
+    proxy.stats = mocker.MagicMock(side_effect=[before, before, after])
+    proxy.send = mocker.MagicMock(return_value='1\n# be_id be_name srv_id srv_name srv_addr')
+
+    proxy.reload({'hello2'}, dict(hello2=14))
+
+    written = {}
+    for (directory, data), _ in container.put_archive.call_args_list:
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            member = tar.getmembers()[0]
+            written[os.path.join(directory, member.name)] = tar.extractfile(member).read().decode()
+    config = written[CONFIG_FILE + '.new']
+    assert config.startswith(current)
+    assert 'backend hello1' in config and 'backend hello2' in config and 'backend stats' not in config
+    assert 'server-template node 1-20' in config
+    assert written[STATE_FILE].startswith('1\n')
+    container.exec_run.assert_any_call(['haproxy', '-c', '-f', CONFIG_FILE + '.new'])
+    container.exec_run.assert_any_call(['mv', CONFIG_FILE + '.new', CONFIG_FILE])
+    container.kill.assert_called_once_with(signal='SIGUSR2')
+    proxy._runtime.close.assert_called_once()
+
+
+def test_haproxy_reload_invalid_config(mocker):
+    container = mocker.MagicMock()
+    container.get_archive = mocker.MagicMock(return_value=([tar_file(CONFIG_FILE, SERVICES_MARKER)], {}))
+    container.exec_run = mocker.MagicMock(return_value=(1, b'[ALERT] parsing error'))
+    docker_client = mocker.MagicMock()
+    docker_client.containers.get = mocker.MagicMock(return_value=container)
+
+    proxy = HAProxy('haproxy.test', docker_client)
+    proxy.stats = mocker.MagicMock(return_value=HAProxyStats([]))
+
+    with pytest.raises(HAProxyError):
+        proxy.reload({'hello1'})
+
+    container.kill.assert_not_called()
@@ -0,0 +1,102 @@
+import docker.errors
+import io
+import os
+import pytest
+import tarfile
+import tempfile
+
+from hydra.cluster.images import ImageSeeder, mirror_args
+from tests.hydra.cluster.fakes import FakeExecutor
+
+
+@pytest.fixture(autouse=True)
+def saved_images(monkeypatch, tmp_path):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+
+
+def node(mocker, name, has_image=False):
+    n = mocker.MagicMock()
+    n.name = name
+    n.exec_run = mocker.MagicMock(
+        side_effect=lambda cmd: (0 if has_image or cmd[:3] != ['docker', 'image', 'inspect'] else 1, b''))
+    return n
+
+
+def seeder(mocker, host_image=None):
+    client = mocker.MagicMock()
+    if host_image:
+        client.images.get = mocker.MagicMock(return_value=host_image)
+    else:
+        client.images.get = mocker.MagicMock(side_effect=docker.errors.ImageNotFound('not on host'))
+    return ImageSeeder(client, FakeExecutor())
+
+
+def test_mirror_args():
+    assert mirror_args(None) == []
+    assert mirror_args('http://registry.test:5000') == [
+        '--registry-mirror', 'http://registry.test:5000', '--insecure-registry', 'registry.test:5000']
+
+
+def test_image_seeder_pulls_on_nodes_without_image(mocker):
+    n1, n2 = node(mocker, 'node-1.test'), node(mocker, 'node-2.test', has_image=True)
+
+    assert seeder(mocker).seed('hello', [n1, n2]) == []
+
+    n1.exec_run.assert_called_with(['docker', 'pull', 'hello'])
+    n2.exec_run.assert_called_once_with(['docker', 'image', 'inspect', 'hello'])
+
+
+def host_image(mocker, image_id='sha256:1'):
+    return mocker.MagicMock(id=image_id, save=mocker.MagicMock(side_effect=lambda named: iter([b'layer', b'data'])))
+
+
+def uploaded(n) -> tarfile.TarFile:
+    path, archive = n.put_archive.call_args[0]
+    return tarfile.open(fileobj=io.BytesIO(b''.join(archive)))
+
+
+def test_image_seeder_loads_host_image_once(mocker):
+    image = host_image(mocker)
+    nodes = [node(mocker, 'node-1.test'), node(mocker, 'node-2.test')]
+
+    assert seeder(mocker, image).seed('hello:local', nodes) == []
+
+    image.save.assert_called_once_with(named=True)
+    names = set()
+    for n in nodes:
+        with uploaded(n) as tar:
+            member = tar.getmembers()[0]
+            assert tar.extractfile(member).read() == b'layerdata'
+        names.add(member.name)
+        assert n.exec_run.call_args[0][0][:2] == ['sh', '-c']
+        assert '{}/{}'.format(n.put_archive.call_args[0][0], member.name) in n.exec_run.call_args[0][0][2]
+    # Every upload has its own name.
+    assert len(names) == 2
+
+
+def test_image_seeder_reuses_saved_image(mocker):
+    image = host_image(mocker)
+    s = seeder(mocker, image)
+    s._cache_size = 1
+
+    s.seed('hello:local', [node(mocker, 'node-1.test')])
+    s.seed('hello:local', [node(mocker, 'node-2.test')])
+    assert image.save.call_count == 1
+    saved = s.save('hello:local')
+
+    # Tag now points to a new build, the old save is dropped.
+    image.id = 'sha256:2'
+    n3 = node(mocker, 'node-3.test')
+    s.seed('hello:local', [n3])
+
+    assert image.save.call_count == 2
+    assert not os.path.exists(saved.path)
+    with uploaded(n3) as tar:
+        assert tar.extractfile(tar.getmembers()[0]).read() == b'layerdata'
+
+
+def test_image_seeder_reports_failures(mocker):
+    n1 = node(mocker, 'node-1.test')
+    n1.exec_run = mocker.MagicMock(side_effect=[(1, b''), (1, b'pull access denied')])
+
+    assert seeder(mocker).seed('hello', [n1]) == [dict(name='node-1.test', error=str(b'pull access denied'))]
@@ -0,0 +1,79 @@
+import docker.errors
+
+from hydra.cluster.inventory import NodeInventory
+
+
+def container(mocker, name, ip='10.0.0.1'):
+    c = mocker.MagicMock(attrs=dict(NetworkSettings=dict(Networks=dict(test=dict(IPAddress=ip)))), status='running')
+    c.name = name
+    return c
+
+
+def event(name, action, id_='abc'):
+    return dict(id=id_, Action=action, time=1, Actor=dict(Attributes=dict(name=name)))
+
+
+def inventory(mocker, containers):
+    client = mocker.MagicMock()
+    client.containers.list = mocker.MagicMock(return_value=containers)
+    return NodeInventory(client, 'test', lambda name: name.startswith('node-') and name.endswith('.test'))
+
+
+def test_node_inventory_loads_once(mocker):
+    inv = inventory(mocker, [container(mocker, 'node-10.test'), container(mocker, 'node-2.test', '10.0.0.2'),
+                             container(mocker, 'redis.test')])
+
+    assert [n.name for n in inv.nodes()] == ['node-2.test', 'node-10.test']
+    assert inv.get('node-2.test').state() == dict(name='node-2.test', ip='10.0.0.2')
+    assert inv.get('redis.test') is None
+
+    inv._docker_client.containers.list.assert_called_once_with(filters={'network': 'test'})
+
+
+def test_node_inventory_follows_events(mocker):
+    inv = inventory(mocker, [container(mocker, 'node-1.test')])
+    inv._docker_client.containers.get = mocker.MagicMock(return_value=container(mocker, 'node-2.test', '10.0.0.2'))
+    inv.nodes()
+
+    inv.on_event(event('node-2.test', 'start'))
+    inv.on_event(event('node-1.test', 'die'))
+
+    assert [n.state() for n in inv.nodes()] == [dict(name='node-2.test', ip='10.0.0.2')]
+    inv._docker_client.containers.get.assert_called_once_with('abc')
+    inv._docker_client.containers.list.assert_called_once()
+
+
+def test_node_inventory_ignores_vanished_container(mocker):
+    inv = inventory(mocker, [])
+    inv._docker_client.containers.get = mocker.MagicMock(side_effect=docker.errors.NotFound('gone'))
+
+    inv.on_event(event('node-1.test', 'start'))
+
+    assert inv.nodes() == []
+
+
+def test_node_inventory_reset(mocker):
+    inv = inventory(mocker, [container(mocker, 'node-1.test')])
+    inv.nodes()
+
+    inv.reset()
+    inv.nodes()
+
+    assert inv._docker_client.containers.list.call_count == 2
+
+
+def test_node_inventory_reports_changes_once(mocker):
+    inv = inventory(mocker, [container(mocker, 'node-1.test')])
+    inv._on_change = mocker.MagicMock()
+    inv._docker_client.containers.get = mocker.MagicMock(return_value=container(mocker, 'node-2.test', '10.0.0.2'))
+    inv.nodes()
+
+    inv.on_event(event('node-2.test', 'start'))
+    inv.on_event(event('node-2.test', 'start'))
+    for action in NodeInventory.STOP_EVENTS:
+        inv.on_event(event('node-1.test', action))
+
+    assert inv._on_change.call_args_list == [
+        mocker.call('added', dict(name='node-2.test', ip='10.0.0.2')),
+        mocker.call('removed', dict(name='node-1.test', ip='10.0.0.1'))
+    ]
@@ -0,0 +1,93 @@
+import time
+
+import pytest
+
+from hydra.cluster.jobs import JOB_KEY, JobQueue, step
+from tests.hydra.cluster.fakes import FakeExecutor, FakeRedis
+
+
+class NoRoom(Exception):
+    pass
+
+
+def queue():
+    q = JobQueue(FakeRedis(), ttl=60, client_errors=(ValueError, NoRoom), heartbeat=0, lease=30)
+    q._executor = FakeExecutor()
+    return q
+
+
+def test_job_succeeds_with_steps():
+    q = queue()
+
+    def deploy(alias, replicas=1):
+        with step('place'):
+            pass
+        with step('start'):
+            pass
+        return dict(name=alias, replicas=replicas)
+
+    record = q.submit('deploy_service', deploy, 'hello1', replicas=2)
+    job = q.get(record['id'])
+
+    assert record['status'] == 'queued'
+    assert job['status'] == 'succeeded'
+    assert job['code'] == 200
+    assert job['result'] == dict(name='hello1', replicas=2)
+    assert [(s['name'], s['status']) for s in job['steps']] == [('place', 'done'), ('start', 'done')]
+    assert all(s['seconds'] >= 0 for s in job['steps'])
+    assert 59 <= q._redis.ttl(JOB_KEY.format(record['id'])) <= 60
+
+
+@pytest.mark.parametrize('error, code', [(ValueError('bad'), 400), (NoRoom('full'), 400), (Exception('boom'), 500)])
+def test_job_fails(error, code):
+    q = queue()
+
+    def deploy():
+        with step('place'):
+            raise error
+
+    job = q.get(q.submit('deploy_service', deploy)['id'])
+
+    assert job['status'] == 'failed'
+    assert job['code'] == code
+    assert job['error'] == str(error)
+    assert job['steps'][0]['status'] == 'failed'
+
+
+def test_job_heartbeat():
+    q = queue()
+    beats = []
+
+    def deploy():
+        running, = q._active
+        q.beat()
+        beats.append(q.get(running)['heartbeat'])
+
+    job_id = q.submit('deploy_service', deploy)['id']
+    job = q.get(job_id)
+
+    assert job['status'] == 'succeeded'
+    assert job['owner'] and job['heartbeat'] == beats[0]
+    assert not q._active
+
+
+def test_job_of_stopped_process_fails():
+    q = queue()
+    q.save('old', id='old', kind='deploy_service', status='running', submitted=time.time() - 120, owner='api.7',
+           heartbeat=time.time() - 31, steps=[])
+
+    job = q.get('old')
+
+    assert job['status'] == 'failed'
+    assert job['code'] == 500
+    assert 'api.7' in job['error']
+    assert q.get('old')['finished'] == job['finished']
+
+
+def test_step_outside_of_job():
+    with step('place'):
+        pass
+
+
+def test_unknown_job():
+    assert queue().get('nope') is None
@@ -0,0 +1,45 @@
+from hydra.cluster.leader import LEADER_KEY, LeaderElection
+from tests.hydra.cluster.fakes import FakeRedis
+
+
+def election(mocker, redis_):
+    return LeaderElection(redis_, mocker.MagicMock(), mocker.MagicMock(), ttl=3000)
+
+
+def test_leader_election_single_leader(mocker):
+    redis_ = FakeRedis()
+    first, second = election(mocker, redis_), election(mocker, redis_)
+
+    first.campaign()
+    second.campaign()
+    first.campaign()
+
+    assert first.is_leader and not second.is_leader
+    first._on_elected.assert_called_once()
+    second._on_elected.assert_not_called()
+    assert 2900 < redis_.pttl(LEADER_KEY) <= 3000
+
+
+def test_leader_election_lost_lease(mocker):
+    redis_ = FakeRedis()
+    first, second = election(mocker, redis_), election(mocker, redis_)
+    first.campaign()
+
+    # Lease expired while leader was stalled and was taken over.
+    redis_.delete(LEADER_KEY)
+    second.campaign()
+    first.campaign()
+
+    assert second.is_leader and not first.is_leader
+    first._on_lost.assert_called_once()
+
+
+def test_leader_election_stop_releases_lease(mocker):
+    redis_ = FakeRedis()
+    first = election(mocker, redis_)
+    first.campaign()
+
+    first.stop()
+
+    assert not first.is_leader
+    assert redis_.pttl(LEADER_KEY) <= 1
@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+from hydra.cluster.inventory import ordinal
+from hydra.cluster.listing import Page, json_array, json_object, parse_fields, parse_limit
+
+
+def names(*ordinals):
+    return [dict(name='node-{}.test'.format(i)) for i in ordinals]
+
+
+def test_page_follows_cursor():
+    items = names(10, 1, 3, 2)
+
+    first = Page(items, lambda i: i['name'], ordinal, limit=2)
+    assert list(first) == names(1, 2)
+    assert first.next == 'node-2.test'
+
+    # Node of cursor is gone, page continues after it.
+    second = Page(names(10, 1, 3), lambda i: i['name'], ordinal, cursor=first.next, limit=2)
+    assert list(second) == names(3, 10)
+    assert second.next is None
+
+
+def test_page_invalid_cursor():
+    with pytest.raises(ValueError):
+        Page(names(1), lambda i: i['name'], ordinal, cursor='redis.test')
+
+
+def test_parse_fields():
+    assert parse_fields('') is None
+    assert parse_fields('name,nodes.name,nodes.ip,services') == dict(name=None, nodes={'name', 'ip'}, services=None)
+    assert parse_fields('nodes,nodes.name') == dict(nodes=None)
+
+
+def test_parse_limit():
+    assert parse_limit(None, default=5) == 5
+    assert parse_limit('100000') == 1000
+    with pytest.raises(ValueError):
+        parse_limit('0')
+
+
+def test_json_streams_lazily():
+    built = []
+
+    def items():
+        built.append(True)
+        yield dict(name='hello1', image='hello')
+
+    chunks = json_object([('version', 1), ('items', lambda: json_array(items(), {'name'}))])
+    assert next(chunks) == '{'
+    assert not built
+
+    assert json.loads('{' + ''.join(chunks)) == dict(version=1, items=[dict(name='hello1')])
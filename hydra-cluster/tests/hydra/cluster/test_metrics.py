@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+from hydra.cluster.metrics import METRICS_KEY, MetricsRegistry, docker_call, instrument_redis, locked
+from tests.hydra.cluster.fakes import FakeRedis
+
+
+def test_histogram_buckets_and_render():
+    registry = MetricsRegistry()
+    h = registry.histogram('test_seconds', 'Test.', buckets=(0.1, 1.0))
+
+    for value in (0.05, 0.1, 0.5, 5):
+        h.observe(value, call='a')
+
+    text = registry.render()
+    assert '# TYPE test_seconds histogram' in text
+    assert 'test_seconds_bucket{call="a",le="0.1"} 2' in text
+    assert 'test_seconds_bucket{call="a",le="1"} 3' in text
+    assert 'test_seconds_bucket{call="a",le="+Inf"} 4' in text
+    assert 'test_seconds_count{call="a"} 4' in text
+    assert 'test_seconds_sum{call="a"} 5.65' in text
+
+
+def test_counter_and_gauge():
+    registry = MetricsRegistry()
+    c = registry.counter('test_total', 'Test.')
+    registry.gauge('test_backlog', 'Test.', lambda: 3)
+
+    c.inc(result='ok')
+    c.inc(2, result='ok')
+
+    text = registry.render()
+    assert 'test_total{result="ok"} 3' in text
+    assert 'test_backlog 3' in text
+
+
+def test_collect_sums_other_processes():
+    redis_ = FakeRedis()
+    other, own = MetricsRegistry(), MetricsRegistry()
+    for registry in (other, own):
+        registry.counter('test_total', 'Test.').inc(result='ok')
+        registry.histogram('test_seconds', 'Test.', buckets=(1.0,)).observe(0.5)
+    redis_.set(METRICS_KEY.format('other'), json.dumps(other.snapshot()))
+
+    text = own.render(redis_)
+
+    assert 'test_total{result="ok"} 2' in text
+    assert 'test_seconds_bucket{le="1"} 2' in text
+
+
+def test_locked_records_wait(mocker):
+    registry = MetricsRegistry()
+    lock = mocker.MagicMock()
+    wait = mocker.patch('hydra.cluster.metrics.LOCK_WAIT_SECONDS', registry.histogram('wait', 'Test.'))
+
+    with locked(lock, 'service'):
+        lock.__enter__.assert_called_once()
+
+    assert wait.snapshot()['[["lock", "service"]]'][-2] == 1
+
+
+def test_instrument_redis_times_commands(mocker):
+    client = mocker.MagicMock()
+    seconds = mocker.patch('hydra.cluster.metrics.REDIS_SECONDS', MetricsRegistry().histogram('redis', 'Test.'))
+
+    instrument_redis(client)
+    client.execute_command('GET', 'key')
+    client.pipeline().execute()
+
+    assert sorted(seconds.snapshot()) == ['[["command", "GET"]]', '[["command", "PIPELINE"]]']
+
+
+@pytest.mark.parametrize('method,url,call', [
+    ('GET', 'http+docker://localhost/v1.41/containers/json?all=1', 'GET containers/json'),
+    ('POST', 'http+docker://localhost/v1.41/containers/abc/start', 'POST containers/{id}/start'),
+    ('POST', 'http+docker://localhost/v1.41/exec/abc/start', 'POST exec/{id}/start'),
+    ('GET', 'http+docker://localhost/v1.41/images/library/redis/json', 'GET images/{id}/json'),
+    ('DELETE', 'http+docker://localhost/v1.41/containers/abc', 'DELETE containers/{id}'),
+])
+def test_docker_call(method, url, call):
+    assert docker_call(method, url) == call
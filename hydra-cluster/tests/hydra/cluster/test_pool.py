@@ -0,0 +1,138 @@
+import docker.errors
+import pytest
+
+from hydra.cluster.pool import WarmPool, wait_ready
+from tests.hydra.cluster.fakes import FakeExecutor, FakeRedis
+
+
+def standby(mocker, name, ready=True):
+    c = mocker.MagicMock(exec_run=mocker.MagicMock(return_value=(0 if ready else 1, b'')))
+    c.name = name
+
+    def rename(new_name):
+        c.name = new_name
+
+    c.rename = mocker.MagicMock(side_effect=rename)
+    return c
+
+
+def pool(mocker, size=2, containers=(), redis_=None):
+    client = mocker.MagicMock()
+    client.containers.list = mocker.MagicMock(return_value=list(containers))
+    run_node = mocker.MagicMock(side_effect=lambda name: standby(mocker, name))
+    p = WarmPool(client, 'test', 'test', run_node, size=size, redis_=redis_)
+    p._executor = FakeExecutor()
+    return p
+
+
+def test_warm_pool_fills_up_on_start(mocker):
+    p = pool(mocker)
+
+    p.start()
+
+    assert p._run_node.call_count == 2
+    assert all(p.is_standby(c.name) for c in p._ready)
+    assert p.stats()['ready'] == 2
+    assert p.stats()['starting'] == 0
+
+
+def test_warm_pool_acquire_renames_and_refills(mocker):
+    p = pool(mocker)
+    p.start()
+
+    node = p.acquire('node-1.test')
+
+    assert node.name == 'node-1.test'
+    node.reload.assert_called_once()
+    assert p._run_node.call_count == 3
+    assert p.stats()['ready'] == 2
+    assert p.stats()['acquired'] == 1
+
+
+def test_warm_pool_stops_refilling_when_not_controller(mocker):
+    p = pool(mocker, size=1, redis_=FakeRedis())
+    p.start()
+    left = p._ready[0]
+    p._docker_client.containers.list.return_value = [left]
+
+    p.stop()
+    # Standby booted by this process is handed out from Docker like by any other process.
+    assert p.acquire('node-1.test') is left
+    assert p._run_node.call_count == 1
+
+    # Boot which was in flight when the role was lost isn't kept in the pool.
+    late = standby(mocker, 'standby-late.test')
+    p._boot(late.name, late)
+    assert p.stats()['ready'] == 0
+    late.remove.assert_called_once_with(force=True)
+
+
+def test_warm_pool_acquire_skips_dead_standby(mocker):
+    p = pool(mocker, size=1)
+    p.start()
+    p._ready[0].rename = mocker.MagicMock(side_effect=docker.errors.NotFound('gone'))
+    p._run_node = mocker.MagicMock(side_effect=Exception('no space left'))
+
+    assert p.acquire('node-1.test') is None
+    assert p.stats()['missed'] == 1
+    assert p.stats()['failed'] == 1
+
+
+def test_warm_pool_adopts_standby_nodes(mocker):
+    left = standby(mocker, 'standby-abc.test')
+    p = pool(mocker, size=1, containers=[left, standby(mocker, 'node-1.test')])
+
+    p.start()
+
+    assert p._ready == [left]
+    p._run_node.assert_not_called()
+
+
+def test_warm_pool_drops_standby_which_went_down(mocker):
+    p = pool(mocker, size=1)
+    p.start()
+    name = p._ready[0].name
+
+    p.on_event(dict(id=p._ready[0].id, Action='die', Actor=dict(Attributes=dict(name=name))))
+
+    assert p._run_node.call_count == 2
+    assert [c.name for c in p._ready] != [name]
+
+
+def test_warm_pool_drops_standby_acquired_by_other_process(mocker):
+    p = pool(mocker, size=1)
+    p.start()
+    taken = p._ready[0]
+
+    p.on_event(dict(id=taken.id, Action='rename', Actor=dict(Attributes=dict(name='node-1.test'))))
+
+    assert taken not in p._ready
+    assert p._run_node.call_count == 2
+
+
+def test_warm_pool_acquire_from_other_process(mocker):
+    redis_ = FakeRedis()
+    claimed, free = standby(mocker, 'standby-abc.test'), standby(mocker, 'standby-def.test')
+    redis_.set('hydra:standby:{}'.format(claimed.id), 'standby-abc.test')
+    p = pool(mocker, size=2, containers=[claimed, free], redis_=redis_)
+
+    node = p.acquire('node-1.test')
+
+    assert node is free
+    assert node.name == 'node-1.test'
+    p._run_node.assert_not_called()
+    assert p.acquire('node-2.test') is None
+
+
+def test_warm_pool_disabled(mocker):
+    p = pool(mocker, size=0)
+
+    p.start()
+
+    p._run_node.assert_not_called()
+    assert p.stats()['size'] == 0
+
+
+def test_wait_ready_timeout(mocker):
+    with pytest.raises(TimeoutError):
+        wait_ready(standby(mocker, 'standby-abc.test', ready=False), timeout=0.01, interval=0.001)
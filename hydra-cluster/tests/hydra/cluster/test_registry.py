@@ -0,0 +1,161 @@
+import json
+import time
+
+from hydra.cluster.changes import StateChanges
+from hydra.cluster.registry import CHANNEL, SERVICE_KEY, ServiceRegistry, encode_config
+from tests.hydra.cluster.fakes import FakeRedis
+
+
+def test_service_registry_reads_from_cache():
+    r = FakeRedis(dict(hello1=dict(name='hello1', nodes=[])))
+    registry = ServiceRegistry(r, watch=False)
+
+    assert registry.all() == [dict(name='hello1', nodes=[])]
+    assert registry.get('hello1') == dict(name='hello1', nodes=[])
+    assert registry.get('hello2') is None
+    assert r.calls == ['scan', 'pipeline']
+
+
+def test_service_registry_get_returns_copy():
+    registry = ServiceRegistry(FakeRedis(dict(hello1=dict(name='hello1', nodes=[]))), watch=False)
+
+    registry.get('hello1')['nodes'].append('node-1')
+
+    assert registry.get('hello1')['nodes'] == []
+
+
+def test_service_registry_batch_writes_through_and_publishes():
+    r = FakeRedis()
+    registry = ServiceRegistry(r, watch=False)
+    registry.all()
+
+    with registry.batch() as batch:
+        batch.set_fields('hello1', strategy='spread')
+
+    assert r.hgetall(SERVICE_KEY.format('hello1')) == {b'name': b'"hello1"', b'strategy': b'"spread"'}
+    assert registry.get('hello1') == dict(name='hello1', strategy='spread', nodes=[])
+    assert r.published == [(CHANNEL, 'hello1')]
+
+
+def wait_for(condition, timeout=1.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_service_registry_refreshes_on_foreign_write():
+    r = FakeRedis()
+    registry = ServiceRegistry(r)
+    assert registry.all() == []
+
+    r.hset(SERVICE_KEY.format('hello1'), mapping=encode_config(dict(name='hello1', nodes=[])))
+    r.messages.put(dict(data=b'hello1'))
+
+    assert wait_for(lambda: registry.get('hello1') is not None)
+    assert registry.get('hello1') == dict(name='hello1', nodes=[])
+
+    r.messages.put(None)
+
+
+def test_service_registry_refreshes_on_own_writes():
+    r = FakeRedis()
+    registry = ServiceRegistry(r)
+    registry.all()
+
+    r.hset(SERVICE_KEY.format('hello1'), mapping=encode_config(dict(name='hello1', nodes=[dict(name='node-1')])))
+    # Stale refresh of a foreign write landed after own write.
+    registry._cache['hello1'] = dict(name='hello1', nodes=[])
+    r.messages.put(dict(data=b'hello1'))
+
+    assert wait_for(lambda: registry.get('hello1')['nodes'] == [dict(name='node-1')])
+
+    r.messages.put(None)
+    # Watcher exits after the last message and drops the cache.
+    assert wait_for(lambda: registry._cache is None)
+
+
+def test_service_registry_maintains_node_index():
+    r = FakeRedis()
+    registry = ServiceRegistry(r, watch=False)
+    with registry.batch() as batch:
+        batch.add_replicas('hello1', [dict(name='node-1.test'), dict(name='node-2.test')])
+        batch.add_replicas('hello2', [dict(name='node-2.test')])
+
+    assert [s['name'] for s in registry.node_services('node-2.test')] == ['hello1', 'hello2']
+
+    registry.remove_replica('hello1', 'node-2.test')
+
+    assert [s['name'] for s in registry.node_services('node-2.test')] == ['hello2']
+    assert [s['name'] for s in registry.node_services('node-1.test')] == ['hello1']
+    assert registry.node_services('node-3.test') == []
+
+
+def test_service_registry_scan_in_batches():
+    r = FakeRedis({'hello{}'.format(i): dict(name='hello{}'.format(i), nodes=[]) for i in range(7)})
+    r.sadd('hydra:node:node-1.test', 'hello1')
+    registry = ServiceRegistry(r, watch=False)
+
+    services = dict(registry.scan(batch=3))
+
+    assert sorted(services) == ['hello{}'.format(i) for i in range(7)]
+    assert services['hello3'] == dict(name='hello3', nodes=[])
+    # First SCAN is alone, the next ones are pipelined with MGET of previous batch.
+    assert r.calls == ['scan', 'pipeline', 'pipeline', 'pipeline']
+
+
+def test_service_registry_field_level_updates():
+    r = FakeRedis(dict(hello1=dict(name='hello1', nodes=[dict(name='node-1.test')])))
+    registry = ServiceRegistry(r, watch=False)
+
+    with registry.batch() as batch:
+        batch.set_fields('hello1', endpoints=['http://proxy/hello1'])
+        batch.add_replicas('hello1', [dict(name='node-2.test', node_port=8001)])
+
+    # Replica added meanwhile by another process is not overwritten.
+    r.hset(SERVICE_KEY.format('hello1'), 'node:node-3.test', json.dumps(dict(name='node-3.test')))
+    registry.remove_replica('hello1', 'node-1.test')
+
+    fields = r.hgetall(SERVICE_KEY.format('hello1'))
+    assert sorted(fields) == [b'endpoints', b'name', b'node:node-2.test', b'node:node-3.test']
+    assert json.loads(fields[b'node:node-2.test']) == dict(name='node-2.test', node_port=8001)
+    assert r.smembers('hydra:node:node-2.test') == {b'hello1'}
+    assert not r.exists('hydra:node:node-1.test')
+
+    cfg = registry.get('hello1')
+    assert cfg['endpoints'] == ['http://proxy/hello1']
+    assert 'node-1.test' not in [n['name'] for n in cfg['nodes']]
+
+
+def test_service_registry_batch_is_one_round_trip():
+    r = FakeRedis()
+    registry = ServiceRegistry(r, watch=False)
+    registry.all()
+
+    with registry.batch() as batch:
+        batch.add_replicas('hello1', [dict(name='node-1.test')])
+        batch.add_replicas('hello2', [dict(name='node-1.test')])
+        batch.remove_replica('hello3', 'node-1.test')
+
+    assert r.calls == ['scan', 'pipeline']
+    assert len(r.published) == 3
+    assert [s['name'] for s in registry.node_services('node-1.test')] == ['hello1', 'hello2']
+
+
+def test_service_registry_records_changes():
+    r = FakeRedis()
+    changes = StateChanges(r)
+    registry = ServiceRegistry(r, watch=False, changes=changes)
+
+    with registry.batch() as batch:
+        batch.set_fields('hello1', strategy='spread')
+        batch.add_replicas('hello1', [dict(name='node-1.test')])
+    registry.remove_replica('hello1', 'node-1.test')
+
+    version, delta = changes.since(0)
+    assert version == 3
+    assert [(c['action'], c['name'], c['data']) for c in delta] == [
+        ('updated', 'hello1', dict(strategy='spread', name='hello1')),
+        ('replica_added', 'hello1', dict(name='node-1.test')),
+        ('replica_removed', 'hello1', dict(name='node-1.test'))
+    ]
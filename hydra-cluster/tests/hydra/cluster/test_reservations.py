@@ -0,0 +1,48 @@
+from hydra.cluster.reservations import SLOT_KEY, SlotReservations
+from tests.hydra.cluster.fakes import FakeRedis
+
+
+def test_slot_reservations_reserve():
+    reservations = SlotReservations(FakeRedis())
+
+    assert reservations.reserve('hello1', ['node-1.test', 'node-2.test', 'node-3.test'], 2) == [
+        'node-1.test', 'node-2.test'
+    ]
+
+
+def test_slot_reservations_skip_taken_slots():
+    r = FakeRedis()
+    first = SlotReservations(r)
+    second = SlotReservations(r)
+
+    first.reserve('hello1', ['node-1.test'], 1)
+
+    assert second.reserve('hello1', ['node-1.test', 'node-2.test', 'node-3.test'], 2) == [
+        'node-2.test', 'node-3.test'
+    ]
+    # Same node, different service is a different slot.
+    assert second.reserve('hello2', ['node-1.test'], 1) == ['node-1.test']
+
+
+def test_slot_reservations_release_only_own():
+    r = FakeRedis()
+    first = SlotReservations(r)
+    second = SlotReservations(r)
+    first.reserve('hello1', ['node-1.test'], 1)
+
+    second.release('hello1', ['node-1.test'])
+    assert r.exists(SLOT_KEY.format('hello1', 'node-1.test'))
+
+    first.release('hello1', ['node-1.test'])
+    assert not r.exists(SLOT_KEY.format('hello1', 'node-1.test'))
+
+
+def test_slot_reservations_release_with_linger():
+    r = FakeRedis()
+    reservations = SlotReservations(r)
+    reservations.reserve('hello1', ['node-1.test'], 1)
+
+    reservations.release('hello1', ['node-1.test'], linger=5000)
+
+    assert r.exists(SLOT_KEY.format('hello1', 'node-1.test'))
+    assert 4900 < r.pttl(SLOT_KEY.format('hello1', 'node-1.test')) <= 5000
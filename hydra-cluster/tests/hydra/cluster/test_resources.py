@@ -0,0 +1,138 @@
+import time
+
+import pytest
+
+from hydra.cluster.resources import (
+    HOLDS_KEY, CapacityTracker, Resources, docker_args, parse_memory, parse_resources, requested
+)
+from tests.hydra.cluster.fakes import FakeRedis
+
+
+class Node(object):
+
+    def __init__(self, name, id_='abc'):
+        self.name = name
+        self.id = id_
+
+
+class Registry(object):
+
+    def __init__(self, services):
+        self.services = services
+
+    def all(self):
+        return self.services
+
+
+def replica(name, memory):
+    return dict(name=name, resources=dict(limits=dict(memory=memory)))
+
+
+def test_parse_memory():
+    assert parse_memory(1024) == 1024
+    assert parse_memory('512') == 512
+    assert parse_memory('256m') == 256 * 1024 ** 2
+    assert parse_memory('1.5G') == int(1.5 * 1024 ** 3)
+
+    for value in ('', 'lots', '-1m', 0, True, None):
+        with pytest.raises(ValueError):
+            parse_memory(value)
+
+
+def test_parse_resources():
+    assert parse_resources() is None
+    assert parse_resources(dict(cpus=None), {}) is None
+    assert parse_resources(dict(cpus='0.5', memory='1k'), dict(memory=512)) == dict(
+        limits=dict(cpus=0.5, memory=1024), reservations=dict(memory=512))
+
+    with pytest.raises(ValueError):
+        parse_resources(dict(gpus=1))
+    with pytest.raises(ValueError):
+        parse_resources(dict(memory=512), dict(memory=1024))
+
+
+def test_requested_prefers_reservation():
+    resources = dict(limits=dict(cpus=2.0, memory=1024), reservations=dict(memory=512))
+
+    assert requested(resources) == Resources(2.0, 512)
+    assert requested(None) == Resources()
+
+
+def test_docker_args():
+    resources = dict(limits=dict(cpus=0.5, memory=1024), reservations=dict(cpus=0.25, memory=512))
+
+    assert docker_args(resources) == [
+        '--cpus', '0.5', '--memory', '1024', '--cpu-shares', '256', '--memory-reservation', '512']
+    assert docker_args(None) == []
+
+
+def test_capacity_tracker_fits():
+    registry = Registry([dict(name='hello1', nodes=[replica('node-1.test', 768)])])
+    tracker = CapacityTracker(registry, FakeRedis(), lambda node: Resources(2.0, 1024))
+    nodes = [Node('node-1.test'), Node('node-2.test')]
+
+    assert [n.name for n in tracker.fits(nodes, Resources(memory=512))] == ['node-2.test']
+    assert tracker.fits(nodes, Resources()) == nodes
+
+
+def test_capacity_tracker_holds():
+    tracker = CapacityTracker(Registry([]), FakeRedis(), lambda node: Resources(1.0, 0))
+    node = Node('node-1.test')
+
+    assert tracker.hold('hello1', node, Resources(cpus=0.75))
+    assert not tracker.hold('hello2', node, Resources(cpus=0.5))
+    assert tracker.allocated()['node-1.test'] == Resources(cpus=0.75)
+
+    tracker.release('hello1', node.name)
+
+    assert tracker.hold('hello2', node, Resources(cpus=0.5))
+
+
+def test_capacity_tracker_unknown_capacity():
+    def capacity_of(node):
+        raise RuntimeError('daemon unavailable')
+
+    tracker = CapacityTracker(Registry([]), FakeRedis(), capacity_of)
+
+    assert tracker.fits([Node('node-1.test')], Resources(cpus=1.0)) == []
+    assert not tracker.hold('hello1', Node('node-1.test'), Resources(cpus=1.0))
+
+
+def test_capacity_tracker_holds_shared_by_processes():
+    r = FakeRedis()
+    services = []
+    tracker = CapacityTracker(Registry(services), r, lambda node: Resources(1.0, 0))
+    # Another API process with its own view of the registry.
+    other = CapacityTracker(Registry([]), r, lambda node: Resources(1.0, 0))
+    node = Node('node-1.test')
+
+    assert tracker.hold('hello1', node, Resources(cpus=0.75))
+    assert not other.hold('hello2', node, Resources(cpus=0.5))
+    assert other.fits([node], Resources(cpus=0.5)) == []
+
+    # Replica is registered, hold lingers for processes whose registry cache is behind.
+    services.append(dict(name='hello1', nodes=[dict(name='node-1.test', resources=dict(limits=dict(cpus=0.75)))]))
+    tracker.release('hello1', node.name, linger=5000)
+
+    assert tracker.allocated()['node-1.test'] == Resources(cpus=0.75)
+    assert not other.hold('hello2', node, Resources(cpus=0.5))
+
+    # Holds of other owners aren't released.
+    other.release('hello1', node.name)
+    assert r.hexists(HOLDS_KEY.format('node-1.test'), 'hello1')
+
+    tracker.release('hello1', node.name)
+    assert other.hold('hello2', node, Resources(cpus=0.5))
+
+
+def test_capacity_tracker_drops_expired_holds():
+    r = FakeRedis()
+    key = HOLDS_KEY.format('node-1.test')
+    # Hold of a process which died before releasing it.
+    r.hset(key, 'hello9', 'gone 1.0 0 {}'.format(int(time.time() * 1000) - 1))
+    tracker = CapacityTracker(Registry([]), r, lambda node: Resources(1.0, 0))
+
+    assert tracker.allocated() == {}
+    assert tracker.hold('hello1', Node('node-1.test'), Resources(cpus=1.0))
+    assert sorted(r.hkeys(key)) == [b'hello1']
+    assert 0 < r.pttl(key) <= tracker._ttl * 1000
@@ -0,0 +1,66 @@
+import pytest
+
+from hydra.cluster.scheduler import NodeLoad, cpu_percent, get_scheduler, memory_fraction
+
+
+class Node(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+NODES = [Node('node-1.test'), Node('node-2.test'), Node('node-3.test')]
+
+LOADS = {
+    'node-1.test': NodeLoad('node-1.test', replicas=3, cpu=5.0, memory=0.1),
+    'node-2.test': NodeLoad('node-2.test', replicas=1, cpu=90.0, memory=0.8),
+    'node-3.test': NodeLoad('node-3.test', replicas=2, cpu=20.0, memory=0.2),
+}
+
+
+def ranked(strategy):
+    return [n.name for n in get_scheduler(strategy).rank('hello1', NODES, LOADS)]
+
+
+def test_spread_prefers_nodes_with_least_replicas():
+    assert ranked('spread') == ['node-2.test', 'node-3.test', 'node-1.test']
+
+
+def test_binpack_prefers_busiest_nodes():
+    assert ranked('binpack') == ['node-1.test', 'node-3.test', 'node-2.test']
+
+
+def test_least_loaded_prefers_idle_nodes():
+    assert get_scheduler('least-loaded').needs_stats
+    assert ranked('least-loaded') == ['node-1.test', 'node-3.test', 'node-2.test']
+
+
+def test_random_ranks_all_nodes():
+    assert sorted(ranked('random')) == [n.name for n in NODES]
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        get_scheduler('fastest')
+
+
+def test_default_strategy():
+    assert get_scheduler().name == 'spread'
+
+
+def test_node_without_load_ranks_as_empty():
+    assert [n.name for n in get_scheduler('spread').rank('hello1', NODES + [Node('node-4.test')], LOADS)][0] == \
+        'node-4.test'
+
+
+def test_docker_stats_usage():
+    stats = dict(
+        cpu_stats=dict(cpu_usage=dict(total_usage=300), system_cpu_usage=2000, online_cpus=2),
+        precpu_stats=dict(cpu_usage=dict(total_usage=100), system_cpu_usage=1000),
+        memory_stats=dict(usage=256, limit=1024)
+    )
+
+    assert cpu_percent(stats) == 40.0
+    assert memory_fraction(stats) == 0.25
+    assert cpu_percent({}) == 0.0
+    assert memory_fraction({}) == 0.0
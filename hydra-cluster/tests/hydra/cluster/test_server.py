@@ -0,0 +1,13 @@
+from hydra.cluster.server import options
+
+
+def test_server_options(mocker):
+    cluster = mocker.MagicMock()
+
+    opts = options(lambda: cluster, workers=4, threads=0)
+
+    assert opts['worker_class'] == 'gthread'
+    assert (opts['workers'], opts['threads']) == (4, 1)
+
+    opts['post_worker_init'](mocker.MagicMock())
+    cluster.start_monitoring.assert_called_once_with(elect=True)
@@ -0,0 +1,81 @@
+import time
+
+from hydra.cluster.timeseries import RingBuffer, StatsCollector, percentile
+
+
+def row(pxname, svname, status='UP', req_tot='0', rtime='0', hrsp_5xx='0', **fields):
+    # Like `show stat` of backends and servers, `req_rate` is a frontend stat and empty here.
+    return dict(pxname=pxname, svname=svname, status=status, req_rate='', req_tot=req_tot, qcur=fields.get('qcur', '0'),
+                scur=fields.get('scur', '0'), rtime=rtime, ttime=fields.get('ttime', ''), hrsp_5xx=hrsp_5xx)
+
+
+def collector(mocker, samples):
+    haproxy = mocker.MagicMock()
+    haproxy.stat_rows = mocker.MagicMock(side_effect=samples)
+    return StatsCollector(haproxy, capacity=4)
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile(list(range(1, 101)), 50) == 50
+    assert percentile(list(range(1, 101)), 99) == 99
+    assert percentile([7.0], 95) == 7.0
+
+
+def test_ring_buffer_keeps_latest_samples():
+    buffer = RingBuffer(capacity=3)
+    for i in range(5):
+        buffer.append(float(i), dict(req_tot=str(i)))
+
+    times, values = buffer.window(0)
+    assert len(buffer) == 3
+    assert times == [2.0, 3.0, 4.0]
+    assert values['req_tot'] == [2.0, 3.0, 4.0]
+    assert buffer.window(3.5)[0] == [4.0]
+
+
+def test_stats_collector_aggregates(mocker):
+    now = time.time()
+    c = collector(mocker, [
+        [row('hello1', 'BACKEND', req_tot='1000', rtime='20', hrsp_5xx='100'),
+         row('hello1', 'node1', req_tot='1000', rtime='20'), row('hello1', 'node2', status='MAINT'),
+         row('stats', 'BACKEND')],
+        [row('hello1', 'BACKEND', req_tot='1300', rtime='40', hrsp_5xx='110'),
+         row('hello1', 'node1', req_tot='1300', rtime='40')],
+        # HAProxy reloaded, counters start over.
+        [row('hello1', 'BACKEND', req_tot='100', rtime='100', hrsp_5xx='5')],
+    ])
+    for i in range(3):
+        c.sample(now - 20 + i * 10)
+
+    services = c.aggregates(window=60)
+
+    assert [s['name'] for s in services] == ['hello1']
+    hello1 = services[0]
+    assert hello1['samples'] == 3
+    assert hello1['req_rate'] == dict(avg=20.0, max=30.0)
+    assert hello1['scur'] == dict(avg=0.0, max=0.0)
+    assert hello1['rtime']['p50'] == 40.0
+    assert hello1['rtime']['p99'] == 100.0
+    assert hello1['ttime'] == dict(avg=None, max=None, p50=None, p95=None, p99=None)
+    assert hello1['hrsp_5xx_rate'] == 0.75
+    # Replica left the backend.
+    assert hello1['replicas'] == []
+
+
+def test_stats_collector_window_and_filter(mocker):
+    now = time.time()
+    c = collector(mocker, [
+        [row('hello1', 'BACKEND', req_tot='10'), row('hello2', 'BACKEND', req_tot='1')],
+        [row('hello1', 'BACKEND', req_tot='30'), row('hello2', 'BACKEND', req_tot='1')],
+        [row('hello1', 'BACKEND', req_tot='60'), row('hello2', 'BACKEND', req_tot='1')],
+    ])
+    c.sample(now - 100)
+    c.sample(now - 10)
+    c.sample(now - 5)
+
+    services = c.aggregates(window=20, service=lambda name: name == 'hello1')
+
+    assert [s['name'] for s in services] == ['hello1']
+    assert services[0]['samples'] == 2
+    assert services[0]['req_rate'] == dict(avg=6.0, max=6.0)
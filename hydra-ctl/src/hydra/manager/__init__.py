@@ -2,8 +2,10 @@ from .cluster import HydraCluster
 from .cluster import HydraDockerCluster
 
 
-def start_cluster(name: str, port: int, proxy_port: int, stats_port: int) -> HydraCluster:
-    clstr = HydraDockerCluster(name, port, proxy_port, stats_port)
+def start_cluster(
+        name: str, port: int, proxy_port: int, stats_port: int, warm_pool: int = 0,
+        registry_mirror: bool = False) -> HydraCluster:
+    clstr = HydraDockerCluster(name, port, proxy_port, stats_port, warm_pool, registry_mirror)
     clstr.start()
     return clstr
 
@@ -14,11 +16,16 @@ def destroy_cluster(name: str) -> HydraCluster:
     return clstr
 
 
-def add_node(cluster_name: str) -> dict:
+def add_node(cluster_name: str, count: int = None, wait: bool = True) -> dict:
     clstr = HydraDockerCluster(cluster_name)
-    return clstr.add_node()
+    return clstr.add_node(count, wait=wait)
 
 
-def add_service(cluster_name: str, alias: str, image: str, node_port: int, service_port: int, replicas: int) -> dict:
+def add_service(
+        cluster_name: str, alias: str, image: str, node_port: int, service_port: int, replicas: int,
+        strategy: str = None, limits: dict = None, reservations: dict = None, autoscale: dict = None,
+        wait: bool = True) -> dict:
     clstr = HydraDockerCluster(cluster_name)
-    return clstr.add_service(alias, image, node_port, service_port, replicas)
+    return clstr.add_service(
+        alias, image, node_port, service_port, replicas,
+        strategy=strategy, limits=limits, reservations=reservations, autoscale=autoscale, wait=wait)
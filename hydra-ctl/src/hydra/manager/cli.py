@@ -1,6 +1,7 @@
 import argparse
 import json
 import sys
+import typing
 
 import hydra.manager as hydra
 
@@ -16,7 +17,7 @@ def hydra_error(func):
 
 @hydra_error
 def start_cluster(args):
-    hydra.start_cluster(args.name, args.port, args.proxy_port, args.stats_port)
+    hydra.start_cluster(args.name, args.port, args.proxy_port, args.stats_port, args.warm_pool, args.registry_mirror)
 
 
 @hydra_error
@@ -26,15 +27,48 @@ def destroy_cluster(args):
 
 @hydra_error
 def add_node(args):
-    node = hydra.add_node(args.cluster)
+    node = hydra.add_node(args.cluster, args.count, wait=args.wait)
     print(json.dumps(node, indent=2))
 
 
+def resources(cpus, memory) -> dict:
+    return {k: v for k, v in dict(cpus=cpus, memory=memory).items() if v is not None}
+
+
+def autoscale(args) -> dict:
+    policy = dict(min=args.min_replicas, max=args.max_replicas, req_rate=args.target_req_rate,
+                  qcur=args.target_queue, rtime=args.target_rtime)
+    policy = {k: v for k, v in policy.items() if v is not None}
+    return policy if args.max_replicas else {}
+
+
+def autoscale_error(args) -> typing.Optional[str]:
+    """
+    Usage error of autoscaling options, same rules as the policy validation of API.
+    """
+    targets = [args.target_req_rate, args.target_queue, args.target_rtime]
+    if args.max_replicas is None:
+        if args.min_replicas is not None or any(t is not None for t in targets):
+            return 'autoscaling options need --max-replicas'
+        return None
+    if not any(targets):
+        return 'autoscaling needs one of --target-req-rate, --target-queue, --target-rtime'
+    minimum = 1 if args.min_replicas is None else args.min_replicas
+    if minimum < 1 or args.max_replicas < minimum:
+        return 'autoscaling needs 1 <= --min-replicas <= --max-replicas'
+    if any(t is not None and t < 0 for t in targets):
+        return 'autoscaling targets must be non-negative'
+    return None
+
+
 @hydra_error
 def add_service(args):
     srv = hydra.add_service(
         args.cluster, args.alias, args.image,
-        args.node_port, args.service_port, args.replicas)
+        args.node_port, args.service_port, args.replicas, strategy=args.strategy,
+        limits=resources(args.cpus, args.memory),
+        reservations=resources(args.cpu_reservation, args.memory_reservation),
+        autoscale=autoscale(args), wait=args.wait)
 
     print(json.dumps(srv, indent=2))
 
@@ -54,6 +88,8 @@ def main():
     parser_start_cluster.add_argument('--port', required=True, dest='port', type=int)
     parser_start_cluster.add_argument('--proxy-port', dest='proxy_port', type=int, default=8888)
     parser_start_cluster.add_argument('--stats-port', dest='stats_port', type=int, default=9999)
+    parser_start_cluster.add_argument('--warm-pool', dest='warm_pool', type=int, default=0)
+    parser_start_cluster.add_argument('--registry-mirror', dest='registry_mirror', action='store_true')
     parser_start_cluster.set_defaults(func=start_cluster)
 
     # cluster destroy
@@ -68,6 +104,9 @@ def main():
     # node add
     parser_add_node = subparsers_node.add_parser('add')
     parser_add_node.add_argument('--cluster', required=True)
+    parser_add_node.add_argument('--count', type=int)
+    parser_add_node.add_argument(
+        '--no-wait', dest='wait', action='store_false', help='Print job of API instead of waiting for it.')
     parser_add_node.set_defaults(func=add_node)
 
     # service
@@ -82,7 +121,32 @@ def main():
     parser_add_service.add_argument('--node-port', required=True, dest='node_port', type=int)
     parser_add_service.add_argument('--service-port', required=True, dest='service_port', type=int)
     parser_add_service.add_argument('--replicas', default=1, type=int)
+    parser_add_service.add_argument(
+        '--strategy', choices=['spread', 'least-loaded', 'binpack', 'random'],
+        help='Placement strategy, cluster default if not given.')
+    parser_add_service.add_argument('--cpus', type=float, help='CPU limit of every replica.')
+    parser_add_service.add_argument('--memory', help='Memory limit of every replica, e.g. 256m.')
+    parser_add_service.add_argument(
+        '--cpu-reservation', dest='cpu_reservation', type=float, help='CPUs reserved on node for every replica.')
+    parser_add_service.add_argument(
+        '--memory-reservation', dest='memory_reservation', help='Memory reserved on node for every replica.')
+    parser_add_service.add_argument(
+        '--max-replicas', dest='max_replicas', type=int, help='Turns autoscaling on, upper bound of replicas.')
+    parser_add_service.add_argument(
+        '--min-replicas', dest='min_replicas', type=int, help='Lower bound of replicas of autoscaling (1).')
+    parser_add_service.add_argument(
+        '--target-req-rate', dest='target_req_rate', type=float, help='Autoscaling target of requests/s per replica.')
+    parser_add_service.add_argument(
+        '--target-queue', dest='target_queue', type=float, help='Autoscaling target of queued requests per replica.')
+    parser_add_service.add_argument(
+        '--target-rtime', dest='target_rtime', type=float, help='Autoscaling target of average response time (ms).')
+    parser_add_service.add_argument(
+        '--no-wait', dest='wait', action='store_false', help='Print job of API instead of waiting for it.')
     parser_add_service.set_defaults(func=add_service)
 
     args = parser.parse_args()
+    if getattr(args, 'func', None) is add_service:
+        error = autoscale_error(args)
+        if error:
+            parser_add_service.error(error)
     args.func(args)
@@ -2,9 +2,14 @@ import docker
 import docker.errors
 import json
 import requests
+import time
 
 CONTENT_TYPE_APPLICATION_JSON = {'Content-Type': 'application/json'}
 
+# How long (seconds) to wait for job of API and how often to poll it.
+JOB_TIMEOUT = 900
+JOB_POLL_INTERVAL = 1.0
+
 
 class ClusterError(Exception):
     pass
@@ -24,10 +29,12 @@ class HydraCluster(object):
     def start(self):
         raise NotImplementedError()
 
-    def add_node(self):
+    def add_node(self, count: int = None, wait: bool = True):
         raise NotImplementedError()
 
-    def add_service(self, alias: str, name: str, node_port: int, service_port: int, replicas: int = 1):
+    def add_service(
+            self, alias: str, name: str, node_port: int, service_port: int, replicas: int = 1, strategy: str = None,
+            limits: dict = None, reservations: dict = None, autoscale: dict = None, wait: bool = True):
         raise NotImplementedError()
 
     def destroy(self):
@@ -36,7 +43,9 @@ class HydraCluster(object):
 
 class HydraDockerCluster(HydraCluster):
 
-    def __init__(self, name: str, port: int = None, proxy_port: int = 8888, stats_port: int = 9999):
+    def __init__(
+            self, name: str, port: int = None, proxy_port: int = 8888, stats_port: int = 9999, warm_pool: int = 0,
+            registry_mirror: bool = False):
         super().__init__(name, port)
 
         self._docker_client = docker.from_env()
@@ -47,6 +56,8 @@ class HydraDockerCluster(HydraCluster):
         self._api_node_name = 'api.{}'.format(self.name)
         self._api_image = 'hydra-cluster'
         self._api_port = 8080
+        # Count of booted standby nodes API keeps ready for `node add`.
+        self._api_warm_pool = warm_pool
 
         self._lb_node_name = 'haproxy.{}'.format(self.name)
         self._lb_image = 'hydra-haproxy'
@@ -58,6 +69,17 @@ class HydraDockerCluster(HydraCluster):
         self._redis_node_name = 'redis.{}'.format(self.name)
         self._redis_image = 'redis'
 
+        # Optional pull-through cache of Docker Hub shared by all nodes.
+        self._registry_mirror = registry_mirror
+        self._registry_node_name = 'registry.{}'.format(self.name)
+        self._registry_image = 'registry:2'
+        self._registry_port = 5000
+        self._registry_remote_url = 'https://registry-1.docker.io'
+
+    @property
+    def registry_mirror_url(self):
+        return 'http://{}:{}'.format(self._registry_node_name, self._registry_port) if self._registry_mirror else ''
+
     @property
     def api_url(self):
         ip = self.api_server.attrs['NetworkSettings']['Ports']['{}/tcp'.format(self._api_port)][0]['HostIp']
@@ -78,11 +100,12 @@ class HydraDockerCluster(HydraCluster):
         except docker.errors.NotFound as error:
             raise ClusterError(error)
 
-    def add_node(self) -> dict:
+    def add_node(self, count: int = None, wait: bool = True) -> dict:
         if self.destroyed:
             raise ClusterError('Cluster is destroyed. Can\'t add node.')
 
-        payload = {}
+        # With count nodes are started concurrently by API.
+        payload = {} if count is None else dict(count=count)
 
         r = requests.post(
             self.api_url + '/node',
@@ -90,12 +113,12 @@ class HydraDockerCluster(HydraCluster):
             data=json.dumps(payload)
         )
 
-        res = json.loads(r.text or '{}')
-        res.update(dict(status_code=r.status_code))
-
-        return res
+        return self._response(r, wait)
 
-    def add_service(self, alias: str, image: str, node_port: int = 0, service_port: int = 0, replicas: int = 1) -> dict:
+    def add_service(
+            self, alias: str, image: str, node_port: int = 0, service_port: int = 0, replicas: int = 1,
+            strategy: str = None, limits: dict = None, reservations: dict = None, autoscale: dict = None,
+            wait: bool = True) -> dict:
         if self.destroyed:
             raise ClusterError('Cluster is destroyed. Can\'t add service.')
         if not self.api_server:
@@ -112,6 +135,16 @@ class HydraDockerCluster(HydraCluster):
             'node_port': node_port,
             'service_port': service_port
         }
+        if strategy:
+            payload['strategy'] = strategy
+        # Resources as {'cpus': float, 'memory': bytes or size with unit like '256m'}.
+        if limits:
+            payload['limits'] = limits
+        if reservations:
+            payload['reservations'] = reservations
+        # Policy as {'min': int, 'max': int, 'req_rate' / 'qcur' / 'rtime': target}.
+        if autoscale:
+            payload['autoscale'] = autoscale
 
         r = requests.post(
             self.api_url + '/service',
@@ -119,11 +152,42 @@ class HydraDockerCluster(HydraCluster):
             data=json.dumps(payload)
         )
 
+        return self._response(r, wait)
+
+    def _response(self, r: requests.Response, wait: bool) -> dict:
         res = json.loads(r.text or '{}')
         res.update(dict(status_code=r.status_code))
 
+        # Operation runs as a job on API.
+        if r.status_code == 202 and wait:
+            return self.wait_job(res['id'])
         return res
 
+    def wait_job(self, job_id: str, timeout: float = JOB_TIMEOUT, interval: float = JOB_POLL_INTERVAL) -> dict:
+        """
+        Polls job until it's finished. Returns result of the job (or its error) with HTTP status of the operation and
+        job summary.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            r = requests.get(self.api_url + '/jobs/' + job_id)
+            job = json.loads(r.text or '{}')
+            if r.status_code != 200:
+                job.update(dict(status_code=r.status_code))
+                return job
+
+            if job.get('status') in ('succeeded', 'failed'):
+                res = dict(job.get('result') or {}) if job['status'] == 'succeeded' else dict(error=job.get('error'))
+                res.update(dict(
+                    status_code=job.get('code'),
+                    job=dict(id=job_id, status=job['status'], seconds=job.get('seconds'), steps=job.get('steps'))
+                ))
+                return res
+
+            if time.monotonic() >= deadline:
+                raise ClusterError('Job {} not finished after {}s.'.format(job_id, timeout))
+            time.sleep(interval)
+
     def destroy(self) -> bool:
         if self.api_server:
             print('Stopping cluster {} ...'.format(self.name))
@@ -154,6 +218,8 @@ class HydraDockerCluster(HydraCluster):
         try:
             self._start_network()
             self._start_redis()
+            if self._registry_mirror:
+                self._start_registry_mirror()
             self._start_load_balancer()
             self._start_api_server()
         except Exception as error:
@@ -177,6 +243,20 @@ class HydraDockerCluster(HydraCluster):
             hostname=self._redis_node_name
         )
 
+    def _start_registry_mirror(self):
+        print('Starting registry mirror at {} ...'.format(self.registry_mirror_url))
+        self._docker_client.containers.run(
+            self._registry_image,
+            environment={'REGISTRY_PROXY_REMOTEURL': self._registry_remote_url},
+            name=self._registry_node_name,
+            network=self._network,
+            tty=True,
+            stdin_open=True,
+            detach=True,
+            remove=True,
+            hostname=self._registry_node_name
+        )
+
     def _start_api_server(self):
         print('Starting cluster API at http://localhost:{} '.format(self.port))
         self._docker_client.containers.run(
@@ -186,6 +266,10 @@ class HydraDockerCluster(HydraCluster):
                 '/var/run/docker.sock': {'bind': '/var/run/docker.sock', 'mode': 'rw'}
             },
             volumes_from=[self._lb_node_name],
+            environment={
+                'HYDRA_WARM_POOL_SIZE': str(self._api_warm_pool),
+                'HYDRA_REGISTRY_MIRROR': self.registry_mirror_url
+            },
             name=self._api_node_name,
             network=self._network,
             tty=True,
@@ -0,0 +1,37 @@
+import sys
+
+import pytest
+
+import hydra.manager as hydra
+from hydra.manager import cli
+
+
+def run(mocker, *argv):
+    mocker.patch.object(sys, 'argv', [
+        'hydra-ctl', 'service', 'add', 'hello1', '--image', 'img', '--cluster', 'test', '--node-port', '8001',
+        '--service-port', '8000', *argv])
+    return mocker.patch.object(hydra, hydra.add_service.__name__, return_value={})
+
+
+def test_cli_add_service_autoscale(mocker):
+    add_service = run(mocker, '--max-replicas', '4', '--target-req-rate', '100')
+
+    cli.main()
+
+    assert add_service.call_args[1]['autoscale'] == dict(max=4, req_rate=100.0)
+
+
+@pytest.mark.parametrize('argv', [
+    ['--target-req-rate', '100'],
+    ['--min-replicas', '2'],
+    ['--max-replicas', '4'],
+    ['--max-replicas', '2', '--min-replicas', '3', '--target-queue', '5'],
+])
+def test_cli_add_service_autoscale_usage_error(mocker, capsys, argv):
+    add_service = run(mocker, *argv)
+
+    with pytest.raises(SystemExit):
+        cli.main()
+
+    assert 'autoscaling' in capsys.readouterr().err
+    add_service.assert_not_called()
@@ -1,6 +1,8 @@
 import docker
+import json
 import pytest
 import requests
+import time
 from hydra.manager.cluster import HydraCluster, HydraDockerCluster, ClusterError
 
 
@@ -106,6 +108,72 @@ def test_hydra_docker_cluster_add_node(mocker, random_str):
     assert clstr.add_node() == dict(status_code=200)
 
 
+def test_hydra_docker_cluster_add_nodes(mocker, random_str):
+    mocker.patch.object(docker, docker.from_env.__name__)
+    mocker.patch.object(
+        requests, requests.post.__name__,
+        return_value=mocker.MagicMock(text='{"nodes": [], "failed": []}', status_code=200)
+    )
+
+    clstr = HydraDockerCluster(random_str())
+
+    assert clstr.add_node(3) == dict(nodes=[], failed=[], status_code=200)
+    assert json.loads(requests.post.call_args[1]['data']) == dict(count=3)
+
+
+def test_hydra_docker_cluster_add_node_waits_for_job(mocker, random_str):
+    mocker.patch.object(docker, docker.from_env.__name__)
+    mocker.patch.object(
+        requests, requests.post.__name__,
+        return_value=mocker.MagicMock(text='{"id": "abc", "status": "queued"}', status_code=202)
+    )
+    running = json.dumps(dict(id='abc', status='running'))
+    done = json.dumps(dict(id='abc', status='succeeded', code=200, result=dict(name='node-1'), seconds=1.5, steps=[]))
+    mocker.patch.object(
+        requests, requests.get.__name__,
+        side_effect=[mocker.MagicMock(text=running, status_code=200), mocker.MagicMock(text=done, status_code=200)]
+    )
+
+    mocker.patch.object(time, time.sleep.__name__)
+
+    clstr = HydraDockerCluster(random_str())
+    res = clstr.add_node()
+
+    assert res['name'] == 'node-1'
+    assert res['status_code'] == 200
+    assert res['job'] == dict(id='abc', status='succeeded', seconds=1.5, steps=[])
+    assert requests.get.call_args[0][0].endswith('/jobs/abc')
+
+
+def test_hydra_docker_cluster_add_node_job_failed(mocker, random_str):
+    mocker.patch.object(docker, docker.from_env.__name__)
+    mocker.patch.object(
+        requests, requests.post.__name__,
+        return_value=mocker.MagicMock(text='{"id": "abc", "status": "queued"}', status_code=202)
+    )
+    failed = json.dumps(dict(id='abc', status='failed', code=500, error='No node started'))
+    mocker.patch.object(requests, requests.get.__name__, return_value=mocker.MagicMock(text=failed, status_code=200))
+
+    res = HydraDockerCluster(random_str()).add_node(3)
+
+    assert res['error'] == 'No node started'
+    assert res['status_code'] == 500
+
+
+def test_hydra_docker_cluster_add_node_no_wait(mocker, random_str):
+    mocker.patch.object(docker, docker.from_env.__name__)
+    mocker.patch.object(
+        requests, requests.post.__name__,
+        return_value=mocker.MagicMock(text='{"id": "abc", "status": "queued"}', status_code=202)
+    )
+    mocker.patch.object(requests, requests.get.__name__)
+
+    res = HydraDockerCluster(random_str()).add_node(wait=False)
+
+    assert res == dict(id='abc', status='queued', status_code=202)
+    requests.get.assert_not_called()
+
+
 def test_hydra_docker_cluster_add_service_cluster_destroyed(mocker, random_str):
     mocker.patch.object(docker, docker.from_env.__name__)
 
@@ -177,6 +245,48 @@ def test_hydra_docker_cluster_add_service(mocker, random_str, random_int):
         random_str(), random_str(), node_port=random_int(), service_port=random_int()) == dict(status_code=200)
 
 
+def test_hydra_docker_cluster_add_service_strategy(mocker, random_str, random_int):
+    mocker.patch.object(docker, docker.from_env.__name__)
+    mocker.patch.object(
+        requests, requests.post.__name__,
+        return_value=mocker.MagicMock(text='{}', status_code=200))
+
+    clstr = HydraDockerCluster(random_str())
+    clstr.add_service(random_str(), random_str(), node_port=random_int(), service_port=random_int(), strategy='binpack')
+
+    assert json.loads(requests.post.call_args[1]['data'])['strategy'] == 'binpack'
+
+
+def test_hydra_docker_cluster_add_service_resources(mocker, random_str, random_int):
+    mocker.patch.object(docker, docker.from_env.__name__)
+    mocker.patch.object(
+        requests, requests.post.__name__,
+        return_value=mocker.MagicMock(text='{}', status_code=200))
+
+    clstr = HydraDockerCluster(random_str())
+    clstr.add_service(
+        random_str(), random_str(), node_port=random_int(), service_port=random_int(),
+        limits=dict(cpus=0.5, memory='256m'), reservations=dict(memory='128m'))
+
+    payload = json.loads(requests.post.call_args[1]['data'])
+    assert payload['limits'] == dict(cpus=0.5, memory='256m')
+    assert payload['reservations'] == dict(memory='128m')
+
+
+def test_hydra_docker_cluster_add_service_autoscale(mocker, random_str, random_int):
+    mocker.patch.object(docker, docker.from_env.__name__)
+    mocker.patch.object(
+        requests, requests.post.__name__,
+        return_value=mocker.MagicMock(text='{}', status_code=200))
+
+    clstr = HydraDockerCluster(random_str())
+    clstr.add_service(
+        random_str(), random_str(), node_port=random_int(), service_port=random_int(),
+        autoscale=dict(min=1, max=4, req_rate=100))
+
+    assert json.loads(requests.post.call_args[1]['data'])['autoscale'] == dict(min=1, max=4, req_rate=100)
+
+
 def test_hydra_docker_cluster_destroy(mocker, random_str):
     attrs = {
         'NetworkSettings': {
@@ -215,6 +325,33 @@ def test_hydra_docker_cluster_start(mocker, random_str):
     clstr._start_load_balancer.assert_called_once()
 
 
+def test_hydra_docker_cluster_start_api_server_warm_pool(mocker, random_str, random_int):
+    mocker.patch.object(docker, docker.from_env.__name__)
+    warm_pool = random_int()
+
+    clstr = HydraDockerCluster(random_str(), random_int(), warm_pool=warm_pool)
+    clstr._start_api_server()
+
+    kwargs = clstr._docker_client.containers.run.call_args[1]
+    assert kwargs['environment'] == {'HYDRA_WARM_POOL_SIZE': str(warm_pool), 'HYDRA_REGISTRY_MIRROR': ''}
+
+
+def test_hydra_docker_cluster_start_registry_mirror(mocker, random_str):
+    mocker.patch.object(docker, docker.from_env.__name__)
+    for method in ('_start_network', '_start_redis', '_start_load_balancer', '_start_api_server'):
+        mocker.patch.object(HydraDockerCluster, method)
+    name = random_str()
+
+    clstr = HydraDockerCluster(name, registry_mirror=True)
+    clstr.start()
+
+    args, kwargs = clstr._docker_client.containers.run.call_args
+    assert args == ('registry:2',)
+    assert kwargs['name'] == 'registry.{}'.format(name)
+    assert kwargs['network'] == name
+    assert clstr.registry_mirror_url == 'http://registry.{}:5000'.format(name)
+
+
 def test_hydra_docker_cluster_start_fail_raises(mocker, random_str):
     mocker.patch.object(HydraDockerCluster, HydraDockerCluster._start_network.__name__, side_effect=Exception('Network exists!'))
     mocker.patch.object(HydraDockerCluster, HydraDockerCluster._start_redis.__name__)
@@ -46,4 +46,6 @@ def test_hydra_add_service(mocker, random_str, random_int):
 
         hydra.add_service(cluster_name, service_name, image, node_port, service_port, replicas)
 
-        HydraDockerCluster.add_service.assert_called_once_with(service_name, image, node_port, service_port, replicas)
+        HydraDockerCluster.add_service.assert_called_once_with(
+            service_name, image, node_port, service_port, replicas, strategy=None, limits=None, reservations=None,
+            autoscale=None, wait=True)